@@ -41,31 +41,432 @@ values of 'mode'. The 'shutdown()' method is called only once.
 """
 import onl.install.Plugin
 import platform
-from onl.platform.current import OnlPlatform
-import sys
 import os
 import json
-import argparse
-import subprocess
 import logging
 import time
 import httplib
 import socket
 import urlparse
-from httplib import HTTPConnection
+import random
+import bisect
+import hashlib
+import threading
+import collections
+import Queue
+
+# BEGIN shared plugin code: the same in onl_preinstall.py and onl_postinstall.py,
+# ztp_plugin_check.py fails when they differ
+# The ZTP exchange must not hold up the install for long. Every request made
+# by this plugin, retries included, has to finish within budget seconds of the
+# first one; after that the plugin gives up and the install carries on.
+budget          = 5.0
+connect_timeout = 1.0
+read_timeout    = 2.0
+max_attempts    = 4
+# ...and across all the requests of one exchange
+max_total       = 8
+backoff_base    = 0.25
+# shutdown() waits this much longer than the background report can take
+shutdown_grace  = 1.0
+# After a power event or a staged rollout every switch starts its exchange at
+# the same moment. Each first waits up to start_spread seconds, an amount
+# derived from its serial number, so the requests spread evenly and a switch
+# always gets the same slot.
+start_spread    = 2.0
+# Answers that mean "not now": retried after the Retry-After the server asks
+# for, if that fits in the budget
+throttle_codes  = [429, 503]
+# With several candidate ZTP servers, see ztp_candidates(), a connection to
+# the next one is started this long after the previous one
+race_stagger    = 0.25
+
+def start_delay(serial, spread=start_spread):
+  return spread * int(hashlib.md5(serial).hexdigest()[:8], 16) / float(1 << 32)
+
+def retry_after(value):
+  """Seconds from a Retry-After header (delta-seconds or HTTP-date), or None"""
+  if not value:
+    return None
+  try:
+    return max(0.0, float(value))
+  except ValueError:
+    import email.utils
+    date = email.utils.parsedate_tz(value)
+    return max(0.0, email.utils.mktime_tz(date) - time.time()) if date else None
+
+class Throttled(httplib.HTTPException):
+  """The ZTP server answered 429 or 503 until the attempts or the budget ran out"""
+  def __init__(self, status, reason, retry_after=None):
+    httplib.HTTPException.__init__(self, '{} {}'.format(status, reason))
+    self.retry_after = retry_after
+
+# The plugins used to switch on full wire dumps (HTTPConnection debuglevel,
+# logging at DEBUG) on every install. Instead the details of the exchange go
+# to a FlightRecorder: a ring buffer of the last flight_events events, kept
+# unformatted. They are only written out, to the installer log and appended
+# to flight_path, when the exchange fails or runs out of time, or on every
+# install with &ztp_debug=1 in onie_exec_url.
+flight_events = 256
+flight_level  = logging.DEBUG
+
+class FlightRecorder(object):
+  """Events are kept as (time, level, format, args). Below level, record() is
+  one comparison; formatting waits for dump()"""
+  def __init__(self, log, size=flight_events, level=flight_level):
+    self.log = log
+    self.level = level
+    self.events = collections.deque(maxlen=size)
+    self.recorded = 0
+
+  def record(self, level, fmt, *args):
+    if level >= self.level:
+      self.recorded += 1
+      self.events.append((time.time(), level, fmt, args))
+
+  def debug(self, fmt, *args):
+    self.record(logging.DEBUG, fmt, *args)
+
+  def dump(self, reason, path):
+    """Writes the buffered events to the installer log and appends them to path"""
+    events = list(self.events)
+    lines = ["ZTP flight recorder ({}): last {} of {} events".format(reason, len(events), self.recorded)]
+    for ts, level, fmt, args in events:
+      try:
+        text = fmt.format(*args)
+      except (IndexError, KeyError, ValueError) as e:
+        text = "{} {!r} ({})".format(fmt, args, e)
+      lines.append("{:.3f} {} {}".format(ts, logging.getLevelName(level), text))
+    for line in lines:
+      self.log.info(line)
+    try:
+      with open(path, 'a') as f:
+        f.write('\n'.join(lines) + '\n')
+    except (IOError, OSError) as e:
+      self.log.warn("Could not write the ZTP flight recorder to {}: {}".format(path, e))
+
+class BudgetedConnection(object):
+  """A kept-alive HTTPConnection to the ZTP server with connect/read timeouts,
+  retried with exponential backoff and jitter until the budget or
+  max_attempts (per request) or max_total (per connection) run out. A 429 or
+  503 is retried after its Retry-After, on the same server. url_base may be a
+  list of servers, see ring_nodes(): other retries go to the next one. The
+  phases of every request are kept in events, in ztp_metrics.py's format, and
+  with trace=True the requests themselves in trace, in ztp_trace.py's"""
+  def __init__(self, url_base, log, flight, budget=budget, trace=False):
+    self.servers = url_base if isinstance(url_base, list) else [url_base]
+    self.url_base = self.servers[0]
+    self.log = log
+    self.flight = flight
+    self.deadline = time.time() + budget
+    self.attempts = 0
+    self.conn = None
+    self.events = []
+    self.trace = [] if trace else None
+
+  def remaining(self):
+    return self.deadline - time.time()
+
+  def race(self, stagger=race_stagger):
+    """Happy eyeballs across the servers: connects to them in order, starting
+    the next one stagger seconds later or as soon as the previous one failed,
+    and keeps the first connection that succeeds. Its server goes first in
+    servers, the others stay as fallbacks. Raises socket.error if none answers"""
+    results = Queue.Queue()
+    def attempt(server):
+      host, _, port = server.rpartition(':')
+      try:
+        sock = socket.create_connection((host, int(port)), max(0.01, min(connect_timeout, self.remaining())))
+      except socket.error as e:
+        results.put((server, None, e))
+      else:
+        results.put((server, sock, None))
+    def close_late(count):
+      for _ in range(count):
+        server, sock, error = results.get()
+        if sock is not None:
+          sock.close()
+    started = time.time()
+    waiting = list(self.servers)
+    running = 0
+    while waiting or running:
+      if waiting:
+        worker = threading.Thread(target=attempt, args=(waiting.pop(0),))
+        worker.daemon = True
+        worker.start()
+        running += 1
+      try:
+        server, sock, error = results.get(timeout=stagger if waiting else max(0.01, self.remaining()))
+      except Queue.Empty:
+        if waiting:
+          continue
+        break
+      running -= 1
+      if sock is None:
+        self.flight.debug("Race: {} failed after {:.3f}s ({!r})", server, time.time() - started, error)
+        continue
+      self.flight.debug("Race: {} answered first, after {:.3f}s", server, time.time() - started)
+      if running:
+        closer = threading.Thread(target=close_late, args=(running,))
+        closer.daemon = True
+        closer.start()
+      self.servers = [server] + [other for other in self.servers if other != server]
+      self.url_base = server
+      self.close()
+      self.conn = httplib.HTTPConnection(server)
+      self.conn.sock = sock
+      return server
+    raise socket.error('none of the ZTP servers {} answered'.format(', '.join(self.servers)))
+
+  def connect(self):
+    self.conn = httplib.HTTPConnection(self.url_base, timeout=max(0.01, min(connect_timeout, self.remaining())))
+    self.conn.connect()
+    self.flight.debug("Connected to {}", self.url_base)
+    self.conn.sock.settimeout(max(0.01, min(read_timeout, self.remaining())))
+
+  def request(self, method, url, body=None, headers={}):
+    """Returns (status, reason, data). Raises socket.error or httplib.HTTPException
+    (Throttled for 429/503) once the attempts or the budget are used up"""
+    started = time.time()
+    event = dict(event='ztp_request', ts=started, method=method, path=url.split('?', 1)[0], status=None, retries=0)
+    for phase in metrics_phases:
+      event[phase] = None
+    self.events.append(event)
+    def timed(phase, since):
+      now = time.time()
+      event[phase] = (event[phase] or 0) + now - since
+      return now
+    attempt = 0
+    while True:
+      attempt += 1
+      self.attempts += 1
+      event['retries'] = attempt - 1
+      try:
+        if self.conn is None:
+          now = time.time()
+          self.connect()
+          timed('connect', now)
+        elif self.conn.sock:
+          self.conn.sock.settimeout(max(0.01, min(read_timeout, self.remaining())))
+        now = time.time()
+        self.flight.debug("send: {} http://{}{} {} {}", method, self.url_base, url, headers, body)
+        self.conn.request(method, url, body, headers)
+        now = timed('write', now)
+        r1 = self.conn.getresponse()
+        now = timed('ttfb', now)
+        data = r1.read()
+        timed('read', now)
+        event['status'] = r1.status
+        self.flight.debug("reply: {} {} after {:.3f}s {} {}", r1.status, r1.reason, now - started, r1.getheaders(), data)
+        if r1.status in throttle_codes:
+          raise Throttled(r1.status, r1.reason, retry_after(r1.getheader('Retry-After')))
+        event['total'] = time.time() - started
+        self.traced(event, url, body)
+        return r1.status, r1.reason, data
+      except (socket.error, httplib.HTTPException) as e:
+        self.close()
+        delay = random.uniform(0, backoff_base * 2 ** (attempt - 1))
+        if isinstance(e, Throttled) and e.retry_after is not None:
+          # Jittered, or every switch told the same comes back at once
+          delay = e.retry_after + delay
+        if attempt >= max_attempts or self.attempts >= max_total or self.remaining() < delay + 0.05:
+          event['error'] = '{}: {}'.format(type(e).__name__, e)
+          event['total'] = time.time() - started
+          self.traced(event, url, body)
+          raise
+        failed = self.url_base
+        if not isinstance(e, Throttled):
+          self.url_base = self.servers[(self.servers.index(self.url_base) + 1) % len(self.servers)]
+        self.flight.record(logging.WARNING, "{} {} to {} attempt {} failed ({!r}), retrying {} in {:.2f}s", method, url, failed, attempt, e, self.url_base, delay)
+        self.log.warn("ZTP {} {} to {} attempt {} failed ({}), retrying {} in {:.2f}s".format(method, url, failed, attempt, e, self.url_base, delay))
+        time.sleep(delay)
+
+  def traced(self, event, url, body):
+    if self.trace is not None:
+      record = dict(ts=round(event['ts'], 6), method=event['method'], url=url, body=body,
+                    status=event['status'], ms=round(1000.0 * event['total'], 3))
+      if event.get('error'):
+        record['error'] = event['error']
+      self.trace.append(record)
+
+  def decode(self, data):
+    """json.loads(data), timed as the decode phase of the latest request"""
+    now = time.time()
+    value = json.loads(data)
+    if self.events:
+      event = self.events[-1]
+      event['decode'] = (event['decode'] or 0) + time.time() - now
+      event['total'] += time.time() - now
+    return value
+
+  def save_metrics(self, path):
+    try:
+      with open(path, 'a') as f:
+        for event in self.events:
+          event = dict((k, round(v, 6) if isinstance(v, float) else v) for k, v in event.items())
+          f.write(json.dumps(event, sort_keys=True, separators=(',', ':')) + '\n')
+    except (IOError, OSError) as e:
+      self.log.warn("Could not write ZTP request timings to {}: {}".format(path, e))
+    self.events = []
+
+  def save_trace(self, path):
+    if not self.trace:
+      return
+    try:
+      with open(path, 'a') as f:
+        for record in self.trace:
+          f.write(json.dumps(record, sort_keys=True, separators=(',', ':')) + '\n')
+    except (IOError, OSError) as e:
+      self.log.warn("Could not write the ZTP request trace to {}: {}".format(path, e))
+    self.trace = []
+
+  def close(self):
+    if self.conn is not None:
+      self.conn.close()
+      self.conn = None
+
+# With ?ztp_servers=ztp1:8080,ztp2:8080 in onie_exec_url, devices are sharded
+# over several ZTP servers by consistent hashing on their IP (or serial number,
+# with &ztp_shard_key=serial). This must place devices exactly like
+# ztp_shards.Ring, so the ops scripts' --ztp_servers find them.
+shard_replicas = 64
+
+def ring_hash(value):
+  return int(hashlib.md5(value).hexdigest()[:16], 16)
+
+def ring_nodes(servers, key, replicas=shard_replicas):
+  """servers in ring order for key: the device's shard, then its fallbacks"""
+  points = sorted((ring_hash('{}#{}'.format(server, i)), server) for server in servers for i in range(replicas))
+  start = bisect.bisect([h for h, server in points], ring_hash(key))
+  order = []
+  for i in range(len(points)):
+    server = points[(start + i) % len(points)][1]
+    if server not in order:
+      order.append(server)
+  return order
+
+# Candidate ZTP servers, in order: the DHCP siaddr, then the ones in
+# &ztp_candidates=host[:port],... in onie_exec_url, then the lines of
+# candidates_path. With more than one the plugins race them, see
+# BudgetedConnection.race(), and keep the winner for the whole install:
+# preinstall records it in the device identity, and postinstall starts its
+# race with it.
+candidates_path = '/etc/ztp_candidates'
+
+def ztp_candidates(siaddr, parsed, port, path=candidates_path):
+  values = [siaddr] if siaddr else []
+  for value in parsed.get('ztp_candidates', []):
+    values += value.split(',')
+  try:
+    with open(path) as f:
+      values += [line.split('#', 1)[0] for line in f]
+  except IOError:
+    pass
+  candidates = []
+  for value in values:
+    value = value.strip()
+    if value and ':' not in value:
+      value = '{}:{}'.format(value, port)
+    if value and value not in candidates:
+      candidates.append(value)
+  return candidates
+
+def shard_servers(parsed, port):
+  """The ztp_servers of onie_exec_url's parsed query, with port added where missing"""
+  servers = []
+  for value in parsed.get('ztp_servers', []):
+    servers += [server if ':' in server else '{}:{}'.format(server, port) for server in value.split(',') if server]
+  return servers
+
+# Events that could not be delivered are journaled in ztp_spool.py's format.
+# The installer ramdisk is gone after the reboot, so the postinstall plugin
+# moves the journal into the installed image (ONL-DATA, /mnt/onl/data at
+# runtime) for ztp_replay_spool_httplib.py to drain.
+spool_path       = '/tmp/ztp_journal.jsonl'
+image_spool_path = 'ztp/journal.jsonl'
+# Same for the per-request timings (connect, write, ttfb, read, decode)
+metrics_path       = '/tmp/ztp_metrics.jsonl'
+image_metrics_path = 'ztp/metrics.jsonl'
+metrics_phases     = ['connect', 'write', 'ttfb', 'read', 'decode']
+# And, with &ztp_trace=1 in onie_exec_url, the requests themselves for
+# ztp_replay_trace.py
+trace_path       = '/tmp/ztp_trace.jsonl'
+image_trace_path = 'ztp/trace.jsonl'
+# And the flight recorder dumps
+flight_path       = '/tmp/ztp_flight.log'
+image_flight_path = 'ztp/flight.log'
+# And the status transitions this switch went through, in ztp_transitions.py's
+# format, for ztp_phase_report.py
+transitions_path       = '/tmp/ztp_transitions.jsonl'
+image_transitions_path = 'ztp/transitions.jsonl'
+# The device identity preinstall collected and registered, and the key the ZTP
+# server knows the device by. postinstall and the status scripts on the
+# installed switch (/mnt/onl/data/ztp/identity.json) report against it
+# instead of working it out again.
+identity_path       = '/tmp/ztp_identity.json'
+image_identity_path = 'ztp/identity.json'
+
+def spool_event(path, kind, device_data):
+  line = json.dumps(dict(kind=kind, ts=time.time(), device=device_data), sort_keys=True)
+  with open(path, 'a') as f:
+    f.write(line + '\n')
+    f.flush()
+    os.fsync(f.fileno())
+
+def record_transition(path, device_data, source):
+  line = json.dumps(dict(ts=time.time(), ip_addr=device_data['ip_addr'], os_name=device_data['os_name'],
+                         state=device_data['state'], source=source), sort_keys=True, separators=(',', ':'))
+  with open(path, 'a') as f:
+    f.write(line + '\n')
+# END shared plugin code
+
+def save_identity(path, identity):
+  tmp = '{}.tmp'.format(path)
+  with open(tmp, 'w') as f:
+    json.dump(identity, f, sort_keys=True, indent=2)
+    f.flush()
+    os.fsync(f.fileno())
+  os.rename(tmp, path)
+
 
 class Plugin(onl.install.Plugin.Plugin):
+  def start_worker(self, name, target):
+    """Runs the ZTP exchange in the background so the install can go on while
+    it waits for the network. shutdown() collects it"""
+    def guarded():
+      try:
+        target()
+      except Exception as e:
+        self.log.error("ZTP report failed: {}".format(e))
+        self.flight.dump('error', flight_path)
+    self.worker = threading.Thread(target=guarded, name=name)
+    self.worker.daemon = True
+    self.worker.start()
+
+  def shutdown(self):
+    worker = getattr(self, 'worker', None)
+    if worker is not None:
+      worker.join(start_spread + budget + shutdown_grace)
+      if worker.is_alive():
+        self.log.warn("ZTP report still running after the {}s budget; not waiting for it".format(budget))
+        self.flight.dump('timeout', flight_path)
+    return onl.install.Plugin.Plugin.shutdown(self)
+
   def run(self, mode):
     if mode == self.PLUGIN_PREINSTALL:
       self.log.info("hello from preinstall plugin")
+      parsed = {}
       if os.environ["onie_exec_url"]:
         parsed = urlparse.parse_qs(urlparse.urlparse(os.environ["onie_exec_url"]).query)
         if "ztp" not in parsed.keys():
           self.log.info("ztp variable not set in the onie_exec_url environment variable. ZTP not called for")
           return 0
       # Parsing out the environment variables
+      port = '8080'
       if "onie_disco_siaddr" in os.environ:
         hostname = os.environ["onie_disco_siaddr"]
+      elif "ztp_servers" in parsed or ztp_candidates(None, parsed, port):
+        hostname = None
       else:
         self.log.warn("WARN: onie_disco_siaddr not set. ZTP not performed")
         return 0
@@ -74,6 +475,8 @@ class Plugin(onl.install.Plugin.Plugin):
       else:
         self.log.warn("WARN: onie_disco_ip not set. ZTP not performed")
         return 0
+      # Probes the platform when imported; only pay for that when ZTP is wanted
+      from onl.platform.current import OnlPlatform
       if OnlPlatform.PLATFORM:
         device_hw = OnlPlatform.PLATFORM
       else:
@@ -99,69 +502,111 @@ class Plugin(onl.install.Plugin.Plugin):
       # Need to convert the dict to a json object for the httplib connection later
       json_string = json.dumps(device_data)
 
-      port             = '8080'
       protocol         = 'http'
       method           = 'POST'
       httpSuccessCodes = [200, 201, 202, 204]
-      verbose          = True
       statuses         = [
         'START', 'DONE', 'CONFIG', 'AWAIT-ONLINE', 'AWAIT-SYSTEM-READY', 
         'OS-INSTALL', 'OS-REBOOTING', 'FAILED'
       ]
-      URL_BASE = '{}:{}'.format(hostname, port)
+      servers = ztp_candidates(hostname, parsed, port)
+      if "ztp_servers" in parsed:
+        shard_key = device_sn if parsed.get("ztp_shard_key") == ["serial"] else device_ip
+        servers = ring_nodes(shard_servers(parsed, port), shard_key)
+      URL_BASE = servers[0]
       URL = '/api/devices'
       url_headers = {'Content-Type': 'application/json', 'Accept': 'application/json' }
       request_url="{}://{}{}".format(protocol, URL_BASE, URL)
-      if verbose: self.log.info("Request_url: \"{}\"".format(request_url))
-      if verbose:
-        self.log.info("****** Verbose mode ****")
-        self.log.info("DeviceData:".format(json.dumps(device_data)))
+      self.flight = FlightRecorder(self.log)
+      self.flight.debug("Request_url: \"{}\"", request_url)
+
+      identity = dict(
+        ip_addr       = device_ip,
+        os_name       = device_os,
+        serial_number = device_sn,
+        hw_model      = device_hw,
+        os_version    = device_data['os_version'],
+        uname         = list(os.uname()),
+        ztp_server    = URL_BASE,
+        # The server has no record id of its own; it finds devices by this
+        key           = dict(ip_addr=device_ip, os_name=device_os),
+        registered    = None
+      )
+      def registered(server):
+        # Where the device is registered, which is not its shard after a failover
+        identity['ztp_server'] = server
+        identity['registered'] = time.time()
+        try:
+          save_identity(identity_path, identity)
+          # Only a status the server took is one the device has reached
+          record_transition(transitions_path, device_data, 'preinstall')
+        except (IOError, OSError) as e:
+          self.log.warn("Could not record the device identity or ZTP status transition: {}".format(e))
+
+      self.flight.debug("DeviceData: {}", json_string)
       
-      def delete_device():
-        conn.request('DELETE', '/api/devices?ip_addr={}'.format(device_ip))
-        r1 = conn.getresponse()
-        data = r1.read()
-        self.log.info(json.dumps(json.loads(data), sort_keys=True, indent=4))
+      def exchange():
+        def delete_device():
+          r_status, reason, data = conn.request('DELETE', '/api/devices?ip_addr={}'.format(device_ip))
+          self.flight.debug("DELETE answer: {}", data)
 
-      try:
-        conn = httplib.HTTPConnection(URL_BASE)
-        if verbose: 
-          logging.basicConfig(level=logging.DEBUG)
-          conn.set_debuglevel(11)
-          HTTPConnection.debuglevel = 1
-        conn.request(method, URL, json_string, url_headers)
-        r1 = conn.getresponse()
-        if verbose:
-          self.log.info("Response: {}, reason: {}".format(r1.status, r1.reason))
-        if r1.status in httpSuccessCodes:
-          data = r1.read()
-          ztp_message = json.loads(data)['message']
-          if ztp_message == "device already exists":
-            self.log.info("ZTP already had this device in its inventory. Deleting.")
-            delete_device()
-            self.log.info("Now, lets re-try the add:")
-            device_data['message'] = "ONL preinstall.py WARN: Device was alredy in ZTP DB. Deleted and re-added. ({}|{}|{}).".format(device_ip, device_os, device_sn)
-            json_string = json.dumps(device_data)
-            self.log.info(json_string)
-            conn.request(method, URL, json_string, url_headers)
-            r1 = conn.getresponse()
-            data = r1.read()
-          if not ztp_message == "device added":
-            self.log.warn("Adding device to ZTP didn't succeed:")
-            self.log.warn(json.dumps(json.loads(data), sort_keys=True, indent=4))
-        else:
-          self.log.warn("Response: {}, reason: {}".format(r1.status, r1.reason))
-          self.log.warn("Non-200 HTTP response seen. Something went awry.")
-          data = r1.read()
-          self.log.info(json.dumps(json.loads(data), sort_keys=True, indent=4))
-      except ValueError as e:
-        self.log.err("Got the following data back: {}".format(data))
-        self.log.err("JSON parse error: {}".format(e))
-        return 0
-      except socket.error as e:
-        self.log.err("ERROR: Socket Error")
-        self.log.err("Tried to access 'http://{}'".format(URL_BASE))
-        self.log.err("ERROR: {}".format(e))
+        delay = start_delay(device_sn)
+        self.flight.debug("Waiting {:.2f}s before contacting ZTP (start spread)", delay)
+        time.sleep(delay)
+        data = None
+        failure = None
+        conn = BudgetedConnection(servers, self.log, self.flight, trace="ztp_trace" in parsed)
+        try:
+          if len(servers) > 1 and "ztp_servers" not in parsed:
+            # Candidates, not shards: any of them will do, so take the quickest
+            conn.race()
+          r_status, reason, data = conn.request(method, URL, json_string, url_headers)
+          if r_status in httpSuccessCodes:
+            ztp_message = conn.decode(data)['message']
+            if ztp_message == "device already exists":
+              self.log.info("ZTP already had this device in its inventory. Deleting.")
+              delete_device()
+              device_data['message'] = "ONL preinstall.py WARN: Device was alredy in ZTP DB. Deleted and re-added. ({}|{}|{}).".format(device_ip, device_os, device_sn)
+              readd_json = json.dumps(device_data)
+              self.flight.debug("Now, lets re-try the add: {}", readd_json)
+              r_status, reason, data = conn.request(method, URL, readd_json, url_headers)
+              if r_status in httpSuccessCodes:
+                ztp_message = conn.decode(data)['message']
+            if ztp_message == "device added":
+              registered(conn.url_base)
+            else:
+              failure = 'not added'
+              self.log.warn("Adding device to ZTP didn't succeed:")
+              self.log.warn(json.dumps(json.loads(data), sort_keys=True, indent=4))
+          else:
+            failure = 'HTTP {}'.format(r_status)
+            self.log.warn("Response: {}, reason: {}".format(r_status, reason))
+            self.log.warn("Non-200 HTTP response seen. Something went awry.")
+            self.log.info(json.dumps(json.loads(data), sort_keys=True, indent=4))
+        except ValueError as e:
+          failure = 'bad response'
+          self.log.error("Got the following data back: {}".format(data))
+          self.log.error("JSON parse error: {}".format(e))
+          return 0
+        except (socket.error, httplib.HTTPException) as e:
+          failure = 'gave up'
+          self.log.error("ERROR: Socket Error")
+          self.log.error("Tried to access 'http://{}'".format(', '.join(servers)))
+          self.log.error("ERROR: {}".format(e))
+          self.log.error("Gave up on ZTP after {:.1f}s. Continuing the install without it.".format(budget - conn.remaining()))
+          spool_event(spool_path, 'add', device_data)
+          self.log.info("Spooled the add to {}; the postinstall plugin keeps it in the installed image".format(spool_path))
+          return 0
+        finally:
+          conn.close()
+          conn.save_metrics(metrics_path)
+          conn.save_trace(trace_path)
+          if failure or "ztp_debug" in parsed:
+            self.flight.dump(failure or 'requested', flight_path)
         return 0
-      return 0
+      try:
+        save_identity(identity_path, identity)
+      except (IOError, OSError) as e:
+        self.log.warn("Could not write the device identity to {}: {}".format(identity_path, e))
+      self.start_worker('ztp-preinstall', exchange)
     return 0
\ No newline at end of file
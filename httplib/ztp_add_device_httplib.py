@@ -1,139 +1,319 @@
 #!/usr/bin/python
 
 # HTTPLib is not as awesome as Requests. But, in the ONL installer environment,
-# at least by default, the Requests module is not present. 
+# at least by default, the Requests module is not present.
 # So.... HTTPLib it is. At least for this stage.
-# This does mean that there's no support for niceties like SSL, or basic HTTP auth
+# This does mean that there's no support for niceties like basic HTTP auth
 import sys
-import os
 import json
 import argparse
-import subprocess
-import logging
+import threading
+import Queue
 import time
 import httplib
 import socket
 from httplib import HTTPConnection
 
+import ztp_client
+import ztp_codec
+import ztp_inventory
+import ztp_metrics
+import ztp_regcache
+import ztp_spool
+from ztp_client import statuses
+
 # Defaults
-hostname         = 'localhost'
-port             = '8080'
+hostname         = ztp_client.hostname
+port             = ztp_client.port
 method           = 'POST'
-httpSuccessCodes = [200, 201, 202, 204]
-statuses         = [
-  'START', 'DONE', 'CONFIG', 'AWAIT-ONLINE', 'AWAIT-SYSTEM-READY', 'OS-INSTALL', 'OS-REBOOTING', 'FAILED'
-]
-
-parser = argparse.ArgumentParser()
-parser.add_argument('--dry-run', help="Does input validation, prints what would be done, but doesn't actually do anything.", action='store_true')
-parser.add_argument('--ztp_host', help='Remote host against which to run. Default: {}'.format(hostname))
-parser.add_argument('--ztp_port', help='Remote host port against which to run. Default: {}'.format(port))
-# parser.add_argument('--ssl', help='Should the connection be treated as an SSL/TLS protected connection', action='store_true')
-parser.add_argument('--device_ip', help='The device IP for which to set the status', required=True)
-parser.add_argument('--device_os', help='The device OS', required=True)
-parser.add_argument('--device_sn', help='The device SN')
-parser.add_argument('--device_hw', help='The device hardware')
-parser.add_argument('--device_message', help='Optional message to be included')
-parser.add_argument('--device_status', help='Device state/status. Valid states/statuses are: {}'.format(statuses), required=True)
-parser.add_argument('--verbose', help='Make things chatty. Note: May display sensitive data like password', action='store_true')
-
-args = parser.parse_args()
-if args.verbose:
-  print "****** Verbose mode ****"
-  for arg in vars(args):
-     print "Argument: {}".format(arg)
-     print "|-> Value: {}".format(getattr(args, arg))
-
-status = args.device_status
-if status.upper() not in statuses:
-  print "ERROR: {} is not a valid ZTP status.".format(status)
-  print "Valid statuses are: {}".format(statuses)
-  exit(1)
-
-if args.ztp_host:
-  hostname = '{}'.format(args.ztp_host)
-if args.ztp_port:
-  port = '{}'.format(args.ztp_port)
-
-protocol="http"
-
-URL_BASE = '{}:{}'.format(hostname, port)
-URL = '/api/devices'
-url_headers = {'Content-Type': 'application/json', 'Accept': 'application/json' }
-request_url="{}://{}{}".format(protocol, URL_BASE, URL)
-if args.verbose: print "Request_url: \"{}\"".format(request_url)
-
-if args.device_message:
-  device_message     = args.device_message
-else:
-  device_message     = "Intial device add",
-
-if args.device_hw:
-  device_hardware    = args.device_hw
-else:
-  device_hardware    = "N/A"
-
-device_data = dict(
-  ip_addr       = args.device_ip,
-  os_name       = args.device_os,
-  serial_number = args.device_sn,
-  hw_model      = device_hardware,
-  os_version    = "2.0.0-2017-07-19.1529-40fc82b_armel",
-  message       = device_message,
-  state         = args.device_status
-)
-json_string = json.dumps(device_data)
-
-if args.dry_run:
-  print "DRY-RUN: {} {} JSON:'{}'".format(request_url, method, json_string)
-  exit(0)
-
-def delete_device():
-  conn.request('DELETE', '/api/devices?ip_addr={}'.format(args.device_ip))
-  r1 = conn.getresponse()
-  data = r1.read()
-  print json.dumps(json.loads(data), sort_keys=True, indent=4)
-
-try:
-  conn = httplib.HTTPConnection(URL_BASE)
-  if args.verbose: 
-    logging.basicConfig(level=logging.DEBUG)
-    conn.set_debuglevel(11)
-    HTTPConnection.debuglevel = 1
-  conn.request(method, URL, json_string, url_headers)
-  r1 = conn.getresponse()
-  if args.verbose:
-    print "Response: {}, reason: {}".format(r1.status, r1.reason)
-  if r1.status in httpSuccessCodes:
-    data = r1.read()
-    ztp_message = json.loads(data)['message']
-    if ztp_message == "device already exists":
-      print "Device with our IP and OS version already exists in the ZTP database."
-      print "Spooling a DELETE"
-      conn.request('DELETE', '/api/devices?ip_addr={}'.format(args.device_ip))
-      r1 = conn.getresponse()
-      data = r1.read()
-      print "Now, lets re-try the add:"
-      device_data['message'] = "WARN: Device was alredy in ZTP DB. Deleted and re-added. ({}|{}|{}|{})".format(args.device_ip, args.device_os, args.device_sn, time.time())
-      json_string = json.dumps(device_data)
-      print json_string
-      conn.request(method, URL, json_string, url_headers)
-      r1 = conn.getresponse()
-      data = r1.read()
-    if not ztp_message == "device added":
+concurrency      = 4
+outputs          = ['text', 'jsonl']
+shard_keys       = ['ip', 'serial']
+
+def parse_args(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--dry-run', help="Does input validation, prints what would be done, but doesn't actually do anything.", action='store_true')
+  parser.add_argument('--ztp_host', help='Remote host against which to run. Default: {}'.format(hostname))
+  parser.add_argument('--ztp_port', help='Remote host port against which to run. Default: {}'.format(port))
+  parser.add_argument('--ztp_servers', help='Comma separated host[:port] list of ZTP servers to shard devices over (consistent hashing, failing over to the next server). Replaces --ztp_host')
+  parser.add_argument('--shard_key', help='What devices are sharded on with --ztp_servers. Default: ip', choices=shard_keys, default='ip')
+  parser.add_argument('--ssl', help='Should the connection be treated as an SSL/TLS protected connection', action='store_true')
+  parser.add_argument('--verify', help='With --ssl: check the server certificate against the system CAs', action='store_true')
+  parser.add_argument('--ca_file', help='With --ssl: check the server certificate against the CAs in this PEM file')
+  parser.add_argument('--wire', help='Body format to negotiate with the ZTP server: msgpack or cbor if their library is installed and the server answers in it, JSON otherwise. Default: json', choices=ztp_codec.names, default='json')
+  parser.add_argument('--device_ip', help='The device IP for which to set the status')
+  parser.add_argument('--device_os', help='The device OS')
+  parser.add_argument('--device_sn', help='The device SN')
+  parser.add_argument('--device_hw', help='The device hardware')
+  parser.add_argument('--device_message', help='Optional message to be included')
+  parser.add_argument('--device_status', help='Device state/status. Valid states/statuses are: {}'.format(statuses))
+  parser.add_argument('--inventory', help='Bulk mode: CSV or JSONL file with one device per row (columns: ip, os, sn, hw, message, state). Replaces the --device_* arguments')
+  parser.add_argument('--concurrency', help='Bulk mode: number of keep-alive connections/in-flight requests. Default: {}'.format(concurrency), type=int)
+  parser.add_argument('--cache', help='Registration cache file. Devices registered unchanged within --cache_ttl are skipped, changed ones are replaced without probing first')
+  parser.add_argument('--cache_ttl', help='Seconds a cached registration is trusted. Default: {}'.format(ztp_regcache.ttl), type=int, default=ztp_regcache.ttl)
+  parser.add_argument('--cache_size', help='Maximum number of cached registrations. Default: {}'.format(ztp_regcache.size), type=int, default=ztp_regcache.size)
+  parser.add_argument('--spool', help='Journal adds that could not be delivered to this file for ztp_replay_spool_httplib.py. Default file: {}'.format(ztp_spool.path), nargs='?', const=ztp_spool.path)
+  parser.add_argument('--output', help='text: human readable, server responses pretty printed. jsonl: one compact JSON line per device (status code, timing, server message) for pipelines. Default: text', choices=outputs, default='text')
+  parser.add_argument('--metrics', help='Record the connect/write/ttfb/read/decode timings of every request to this file: a Prometheus textfile-collector file if it ends in .prom, JSONL events otherwise')
+  parser.add_argument('--trace', help='Append every request (method, URL, body, status, time) to this file for ztp_replay_trace.py')
+  parser.add_argument('--verbose', help='Make things chatty. Note: May display sensitive data like password', action='store_true')
+
+  args = parser.parse_args(argv)
+  if not args.inventory:
+    for required in ['device_ip', 'device_os', 'device_status']:
+      if not getattr(args, required):
+        parser.error('--{} is required unless --inventory is given'.format(required))
+  return args
+
+def bulk_add(args, transport, request_url, cache=None, spool=None):
+  """Bulk mode. The inventory is streamed twice: once to validate every row
+  before anything goes out on the wire, once to feed the workers. Neither pass
+  holds more than a handful of rows in memory (validation keeps the device
+  keys to catch duplicates), so a 100k row inventory is fine"""
+  path = args.inventory
+  workers = max(1, args.concurrency or concurrency)
+
+  def report(lineno, error):
+    print "ERROR: {} line {}: {}".format(path, lineno, error)
+  rows, errors = ztp_inventory.validate_inventory(path, report)
+  if errors:
+    print "{} of {} inventory rows are invalid. Nothing was sent.".format(errors, rows + errors)
+    return 1
+  if args.dry_run:
+    for lineno, device in ztp_inventory.devices(path):
+      if args.output == 'jsonl':
+        print ztp_client.result_line('add', device, 'dry-run', line=lineno)
+      else:
+        print "DRY-RUN: {} {} JSON:'{}'".format(request_url, method, json.dumps(device))
+    return 0
+
+  # Sharded: each server gets its own queue and workers, so a slow or failing
+  # shard doesn't hold up the others
+  shard_for = getattr(transport, 'shard_for', None)
+  shards = transport.ring.servers if shard_for else [None]
+  spool_lock = threading.Lock()
+  pending = dict((shard, Queue.Queue(workers * 2)) for shard in shards)
+  results = Queue.Queue(workers * 2 * len(shards))
+
+  def feeder():
+    for item in ztp_inventory.devices(path):
+      pending[shard_for(item[1]) if shard_for else None].put(item)
+    for shard in shards:
+      for _ in range(workers):
+        pending[shard].put(None)
+
+  def add_row(lineno, device):
+    """Adds one inventory device. Returns (outcome, output line)"""
+    started = time.time()
+    r1 = error = None
+    try:
+      outcome, r1 = ztp_client.add_device(transport, device, cache=cache)
+      if r1 is None:
+        detail = 'unchanged since last registration'
+      elif r1.ok:
+        detail = r1.message
+      else:
+        detail = 'HTTP {} {}'.format(r1.status, r1.reason)
+    except ValueError as e:
+      outcome, detail = 'failed', 'JSON parse error: {}'.format(e)
+      error = detail
+    except (socket.error, httplib.HTTPException) as e:
+      outcome, detail = 'failed', 'Socket error: {}'.format(e)
+      error = detail
+      if spool:
+        outcome = 'spooled'
+        with spool_lock:
+          spool.append('add', device)
+    except Exception as e:
+      outcome, detail = 'failed', '{}: {}'.format(type(e).__name__, e)
+      error = detail
+    elapsed = time.time() - started
+    # Formatted here so the workers share the serialization work
+    if args.output == 'jsonl':
+      line = ztp_client.result_line('add', device, outcome, r1, elapsed, error, line=lineno)
+    else:
+      line = "line {}: {} {} {} ({:.3f}s) {}".format(lineno, device['ip_addr'], device['os_name'], outcome, elapsed, detail)
+    return outcome, line
+
+  def worker(queue):
+    # Every row reports an outcome and every worker its end, whatever goes
+    # wrong; otherwise the loop below waits for them forever
+    try:
+      while True:
+        item = queue.get()
+        if item is None:
+          return
+        lineno, device = item
+        try:
+          results.put(add_row(lineno, device))
+        except Exception as e:
+          error = '{}: {}'.format(type(e).__name__, e)
+          if args.output == 'jsonl':
+            line = ztp_client.result_line('add', {}, 'failed', error=error, line=lineno)
+          else:
+            line = "line {}: failed {}".format(lineno, error)
+          results.put(('failed', line))
+    finally:
+      results.put(None)
+
+  start = time.time()
+  threads = [threading.Thread(target=feeder)]
+  for shard in shards:
+    threads += [threading.Thread(target=worker, args=(pending[shard],)) for _ in range(workers)]
+  for t in threads:
+    t.daemon = True
+    t.start()
+
+  outcomes = {}
+  running = workers * len(shards)
+  while running:
+    result = results.get()
+    if result is None:
+      running -= 1
+      continue
+    outcome, line = result
+    outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    print line
+  elapsed = time.time() - start
+
+  # With --output jsonl, stdout carries only the per-device lines
+  out = sys.stderr if args.output == 'jsonl' else sys.stdout
+  print >>out, "Summary: {} devices in {:.2f}s ({:.1f} devices/s) over {} connection(s)".format(rows, elapsed, rows / elapsed if elapsed else 0, transport.opened)
+  for outcome in sorted(outcomes):
+    print >>out, "|-> {}: {}".format(outcome, outcomes[outcome])
+  return 1 if outcomes.get('failed') or outcomes.get('spooled') else 0
+
+def add_one(args, transport, request_url, cache=None, spool=None):
+  status = args.device_status
+  if not ztp_client.valid_status(status):
+    print "ERROR: {} is not a valid ZTP status.".format(status)
+    print "Valid statuses are: {}".format(statuses)
+    return 1
+
+  device_data = dict(
+    ip_addr       = args.device_ip,
+    os_name       = args.device_os,
+    serial_number = args.device_sn,
+    hw_model      = args.device_hw or "N/A",
+    os_version    = ztp_client.os_version,
+    message       = args.device_message or "Intial device add",
+    state         = args.device_status
+  )
+
+  if args.dry_run:
+    if args.output == 'jsonl':
+      print ztp_client.result_line('add', device_data, 'dry-run')
+    else:
+      print "DRY-RUN: {} {} JSON:'{}'".format(request_url, method, json.dumps(device_data))
+    return 0
+
+  data = None
+  started = time.time()
+  try:
+    outcome, r1 = ztp_client.add_device(transport, device_data, cache=cache)
+    if args.output == 'jsonl':
+      print ztp_client.result_line('add', device_data, outcome, r1, time.time() - started)
+      return 1 if outcome == 'failed' else 0
+    if outcome == 'cached':
+      if args.verbose:
+        print "Device registered unchanged within the last {}s according to {}. Nothing sent.".format(args.cache_ttl, args.cache)
+      return 0
+    data = r1.body
+    if args.verbose:
+      print "Response: {}, reason: {}".format(r1.status, r1.reason)
+    if not r1.ok:
+      print "Response: {}, reason: {}".format(r1.status, r1.reason)
+      print "Non-200 HTTP response seen. Something went awry."
+      print json.dumps(r1.data, sort_keys=True, indent=4)
+    elif outcome == 'replaced':
+      print "Device with our IP and OS version already existed in the ZTP database. Deleted and re-added."
+    elif outcome == 'failed':
       print "Adding device to ZTP didn't succeed:"
-      print json.dumps(json.loads(data), sort_keys=True, indent=4)
+      print json.dumps(r1.data, sort_keys=True, indent=4)
+  except ValueError as e:
+    if args.output == 'jsonl':
+      print ztp_client.result_line('add', device_data, 'failed', elapsed=time.time() - started, error='JSON parse error: {}'.format(e))
+      return 1
+    print "Got the following data back: {}".format(data)
+    print "JSON parse error: {}".format(e)
+    return 1
+  except (socket.error, httplib.HTTPException) as e:
+    if spool:
+      spool.append('add', device_data)
+    if args.output == 'jsonl':
+      print ztp_client.result_line('add', device_data, 'spooled' if spool else 'failed', elapsed=time.time() - started, error='Socket error: {}'.format(e))
+      return 1
+    print "ERROR: Socket Error"
+    print "Tried to access '{}'".format(request_url)
+    print "ERROR: {}".format(e)
+    if spool:
+      print "Spooled to {} for a later ztp_replay_spool_httplib.py".format(spool.path)
+    return 1
+  return 0
+
+def main(argv=None):
+  args = parse_args(argv)
+  if args.verbose:
+    print "****** Verbose mode ****"
+    for arg in vars(args):
+       print "Argument: {}".format(arg)
+       print "|-> Value: {}".format(getattr(args, arg))
+
+  ztp_host = args.ztp_host or hostname
+  ztp_port = args.ztp_port or port
+  if args.ssl:
+    protocol = "https"
+  else:
+    protocol = "http"
+
+  size = max(1, args.concurrency or concurrency)
+  tls = dict(ssl=args.ssl, verify=args.verify, ca_file=args.ca_file)
+  if args.ztp_servers:
+    import ztp_shards
+    transport = ztp_shards.ShardedTransport(ztp_shards.parse_servers(args.ztp_servers, ztp_port), args.shard_key, size=size, **tls)
   else:
-    print "Response: {}, reason: {}".format(r1.status, r1.reason)
-    print "Non-200 HTTP response seen. Something went awry."
-    data = r1.read()
-    print json.dumps(json.loads(data), sort_keys=True, indent=4)
-except ValueError as e:
-  print "Got the following data back: {}".format(data)
-  print "JSON parse error: {}".format(e)
-  exit(1)
-except socket.error as e:
-  print "ERROR: Socket Error"
-  print "Tried to access 'http://{}'".format(URL_BASE)
-  print "ERROR: {}".format(e)
-  exit(1)
\ No newline at end of file
+    transport = ztp_client.get_transport(ztp_host, ztp_port, size=size, **tls)
+  if args.wire != 'json':
+    try:
+      transport.wire = ztp_codec.get(args.wire)
+    except ImportError as e:
+      print >>sys.stderr, "WARN: Can't use {}, talking JSON: {}".format(args.wire, e)
+
+  request_url = "{}://{}{}".format(protocol, transport.url_base, ztp_client.DEVICES_URL)
+  if args.verbose: print "Request_url: \"{}\"".format(request_url)
+
+  if args.verbose:
+    import logging
+    logging.basicConfig(level=logging.DEBUG)
+    transport.debuglevel = 11
+    HTTPConnection.debuglevel = 1
+
+  cache = None
+  if args.cache:
+    cache = ztp_regcache.RegistrationCache(args.cache, args.cache_ttl, args.cache_size)
+  spool = None
+  if args.spool:
+    spool = ztp_spool.Spool(args.spool)
+  if args.metrics:
+    transport.recorder = ztp_metrics.Recorder(args.metrics)
+  if args.trace:
+    import ztp_trace
+    transport.tracer = ztp_trace.Tracer(args.trace)
+  try:
+    if args.inventory:
+      return bulk_add(args, transport, request_url, cache, spool)
+    return add_one(args, transport, request_url, cache, spool)
+  finally:
+    if cache and not args.dry_run:
+      cache.save()
+    if spool:
+      spool.close()
+    if transport.recorder:
+      transport.recorder.close()
+    if transport.tracer:
+      transport.tracer.close()
+    if args.ssl and not args.dry_run:
+      print >>(sys.stderr if args.output == 'jsonl' else sys.stdout), ztp_client.tls_summary(transport)
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,275 @@
+#!/usr/bin/python
+
+# Resident ZTP status agent for the switch. Post-boot hooks hand their status
+# and message events to it over a local Unix socket with ztp_agent_client.py
+# instead of starting ztp_set_device_status_httplib.py for every report:
+#
+#   ztp_agent.py --identity &
+#   ztp_agent_client.py AWAIT-SYSTEM-READY "interfaces up"
+#   ztp_agent_client.py - "pulling config"      (message only, state unchanged)
+#
+# Events are acknowledged as soon as they are queued; the agent sends them in
+# the background over one kept-alive connection to the ZTP server, retrying
+# until the server is back. Like ztp_set_device_status_httplib.py --daemon it
+# only sends the latest state per device, and it drops an event that repeats
+# the state (and message) the device has pending or last had accepted.
+#
+# The socket protocol is one JSON object per line each way:
+#   -> {"state": "CONFIG", "message": "..."}    ip_addr/os_name default to the agent's
+#   <- {"ok": true, "queued": true} | {"ok": true, "duplicate": true} | {"ok": false, "error": "..."}
+#   -> {"op": "stats"}
+#   <- {"ok": true, "received": ..., "duplicates": ..., "sent": ..., "pending": ...}
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import httplib
+import argparse
+import threading
+import SocketServer
+
+import ztp_client
+import ztp_spool
+import ztp_transitions
+from ztp_set_device_status_httplib import StatusCoalescer, parse_event
+
+# Defaults
+socket_path    = '/var/run/ztp_agent.sock'
+flush_interval = 0.2
+retry_interval = 5.0
+max_retry      = 60.0
+timeout        = 10.0
+
+class Agent(object):
+  def __init__(self, transport, defaults=None, transitions=None, collapse_history=False, verbose=False):
+    self.transport = transport
+    self.defaults = defaults or {}
+    self.transitions = transitions
+    self.verbose = verbose
+    self.coalescer = StatusCoalescer(collapse_history)
+    self.lock = threading.Lock()
+    self.wakeup = threading.Event()
+    # (ip_addr, os_name) -> (state, message) the ZTP server last accepted
+    self.last = {}
+    self.duplicates = 0
+    self.sent = 0
+
+  @property
+  def received(self):
+    return self.coalescer.received + self.duplicates
+
+  def latest(self, key):
+    """(state, message) of the device's pending event, else the one last
+    delivered; None if there is neither"""
+    with self.coalescer.lock:
+      pending = self.coalescer.pending.get(key)
+    if pending:
+      return (pending['state'], pending['message'])
+    with self.lock:
+      return self.last.get(key)
+
+  def last_state(self, ip_addr, os_name):
+    last = self.latest((ip_addr, os_name))
+    if last:
+      return last[0]
+    if self.transitions:
+      return self.transitions.last(ip_addr, os_name)
+    return None
+
+  def submit(self, event):
+    """Queues one event from a client. Returns the reply for it"""
+    if not isinstance(event, dict):
+      return dict(ok=False, error='event is not a JSON object')
+    if event.get('op') == 'stats':
+      with self.coalescer.lock:
+        pending = len(self.coalescer.pending)
+      return dict(ok=True, received=self.received, duplicates=self.duplicates, sent=self.sent, pending=pending)
+    event = dict(self.defaults, **event)
+    if not event.get('state') and event.get('ip_addr') and event.get('os_name'):
+      # A message event: report it against the device's current state
+      event['state'] = self.last_state(event['ip_addr'], event['os_name'])
+    try:
+      device_data = parse_event(json.dumps(event))
+    except ValueError as e:
+      return dict(ok=False, error='{}'.format(e))
+    device_data['state'] = device_data['state'].upper()
+    key = (device_data['ip_addr'], device_data['os_name'])
+    if self.latest(key) == (device_data['state'], device_data['message']):
+      with self.lock:
+        self.duplicates += 1
+      return dict(ok=True, duplicate=True)
+    self.coalescer.add(device_data)
+    self.wakeup.set()
+    return dict(ok=True, queued=True)
+
+  def deliver(self):
+    """Sends everything pending. Returns False if the ZTP server could not be
+    reached; what wasn't sent is kept for the next attempt"""
+    reachable = True
+    for device_data in self.coalescer.drain():
+      if not reachable:
+        self.coalescer.requeue(device_data)
+        continue
+      key = (device_data['ip_addr'], device_data['os_name'])
+      try:
+        r1 = ztp_client.set_status(self.transport, transitions=self.transitions, **device_data)
+        self.sent += 1
+        outcome = ztp_client.status_outcome(r1)
+        # Only what the server took suppresses a repeat; after a refusal the
+        # device may send the same state again
+        with self.lock:
+          if outcome == 'updated':
+            self.last[key] = (device_data['state'], device_data['message'])
+          else:
+            self.last.pop(key, None)
+        if outcome != 'updated' or self.verbose:
+          print "{} {} {}: {} {}".format(device_data['ip_addr'], device_data['os_name'], device_data['state'], outcome, r1.message or r1.reason)
+      except ztp_client.InvalidTransition as e:
+        with self.lock:
+          self.last.pop(key, None)
+        print "ERROR: not sent: {}".format(e)
+      except ValueError as e:
+        with self.lock:
+          self.last.pop(key, None)
+        print "JSON parse error for {}: {}".format(device_data, e)
+      except (socket.error, httplib.HTTPException) as e:
+        print "ERROR: Socket Error sending {} to 'http://{}': {}".format(device_data, self.transport.url_base, e)
+        self.coalescer.requeue(device_data)
+        reachable = False
+    sys.stdout.flush()
+    return reachable
+
+  def run(self, interval=flush_interval):
+    """Delivers events as they come in, backing off while the ZTP server is unreachable"""
+    backoff = 0
+    while True:
+      self.wakeup.wait(backoff or 1.0)
+      if backoff:
+        backoff = min(max_retry, backoff * 2)
+      elif not self.wakeup.is_set():
+        continue
+      # Give a burst of events a moment to coalesce
+      time.sleep(interval)
+      self.wakeup.clear()
+      if self.deliver():
+        backoff = 0
+      elif not backoff:
+        backoff = retry_interval
+
+class AgentServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  daemon_threads = True
+
+class ClientHandler(SocketServer.StreamRequestHandler):
+  def handle(self):
+    for line in iter(self.rfile.readline, ''):
+      line = line.strip()
+      if not line:
+        continue
+      try:
+        reply = self.server.agent.submit(json.loads(line))
+      except ValueError as e:
+        reply = dict(ok=False, error='JSON parse error: {}'.format(e))
+      self.wfile.write(json.dumps(reply) + '\n')
+      self.wfile.flush()
+
+def listen(path, agent):
+  if os.path.exists(path):
+    # A running agent answers; a stale socket from an earlier one is replaced
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      probe.connect(path)
+    except socket.error:
+      os.unlink(path)
+    else:
+      raise socket.error('another agent is listening on {}'.format(path))
+    finally:
+      probe.close()
+  server = AgentServer(path, ClientHandler)
+  server.agent = agent
+  os.chmod(path, 0o660)
+  return server
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--socket', help='Unix socket to accept events on. Default: {}'.format(socket_path), default=socket_path)
+  parser.add_argument('--ztp_host', help='Remote host against which to run. Default: the identity\'s ZTP server, else {}'.format(ztp_client.hostname))
+  parser.add_argument('--ztp_port', help='Remote host port against which to run. Default: the identity\'s ZTP server, else {}'.format(ztp_client.port))
+  parser.add_argument('--device_ip', help='The device IP for events that carry none')
+  parser.add_argument('--device_os', help='The device OS for events that carry none')
+  parser.add_argument('--identity', help='Take the device IP, OS and ZTP server from the identity file the ONL preinstall plugin registered. Default file: {}'.format(ztp_client.identity_path), nargs='?', const=ztp_client.identity_path)
+  parser.add_argument('--transitions', help='Transition log: refuse statuses the device can not reach from the last one recorded for it, and record the ones the server accepts. Default file: {}'.format(ztp_transitions.path), nargs='?', const=ztp_transitions.path)
+  parser.add_argument('--timeout', help='Seconds to wait for the ZTP server to accept the connection or answer a request. Default: {}'.format(timeout), type=float, default=timeout)
+  parser.add_argument('--flush_interval', help='Seconds to let a burst of events coalesce before sending. Default: {}'.format(flush_interval), type=float, default=flush_interval)
+  parser.add_argument('--collapse_history', help='Fold superseded states into the message of the state that is sent instead of dropping them', action='store_true')
+  parser.add_argument('--spool', help='On exit, journal what could not be delivered to this file for ztp_replay_spool_httplib.py. Default file: {}'.format(ztp_spool.path), nargs='?', const=ztp_spool.path)
+  parser.add_argument('--verbose', help='Print every status sent, not only the ones that failed', action='store_true')
+  args = parser.parse_args(argv)
+
+  defaults = {}
+  ztp_server = None
+  if args.identity:
+    try:
+      identity = ztp_client.read_identity(args.identity)
+    except (IOError, ValueError) as e:
+      print "ERROR: Can't use the device identity {}: {}".format(args.identity, e)
+      return 1
+    defaults = dict(identity['key'])
+    ztp_server = identity.get('ztp_server')
+  if args.device_ip:
+    defaults['ip_addr'] = args.device_ip
+  if args.device_os:
+    defaults['os_name'] = args.device_os
+
+  ztp_host, ztp_port = ztp_client.hostname, ztp_client.port
+  if ztp_server:
+    ztp_host, _, ztp_port = ztp_server.rpartition(':')
+  ztp_host = args.ztp_host or ztp_host
+  ztp_port = args.ztp_port or ztp_port
+  transport = ztp_client.get_transport(ztp_host, ztp_port, size=1, timeout=args.timeout)
+
+  transitions = None
+  if args.transitions:
+    transitions = ztp_transitions.TransitionLog(args.transitions, source='ztp_agent.py')
+  agent = Agent(transport, defaults, transitions, args.collapse_history, args.verbose)
+  try:
+    server = listen(args.socket, agent)
+  except socket.error as e:
+    print "ERROR: Can't listen on {}: {}".format(args.socket, e)
+    return 1
+  reader = threading.Thread(target=server.serve_forever)
+  reader.daemon = True
+  reader.start()
+  print "Listening on {}, reporting to 'http://{}'".format(args.socket, transport.url_base)
+  sys.stdout.flush()
+
+  def terminate(signum, frame):
+    raise KeyboardInterrupt()
+  signal.signal(signal.SIGTERM, terminate)
+  try:
+    agent.run(args.flush_interval)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    os.unlink(args.socket)
+    # One last try for whatever is still pending
+    agent.deliver()
+    left = agent.coalescer.drain()
+    if left and args.spool:
+      spool = ztp_spool.Spool(args.spool)
+      for device_data in left:
+        spool.append('status', device_data)
+      spool.close()
+      print "Spooled {} undelivered status(es) to {}".format(len(left), args.spool)
+    elif left:
+      print "ERROR: {} status(es) could not be delivered".format(len(left))
+    transport.close()
+    if transitions:
+      transitions.close()
+  print "Events received: {}, duplicates dropped: {}, PUTs sent: {}".format(agent.received, agent.duplicates, agent.sent)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
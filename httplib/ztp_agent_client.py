@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+# Hands one status or message event to a running ztp_agent.py and exits as
+# soon as the agent has queued it:
+#
+#   ztp_agent_client.py CONFIG "applying startup config"
+#   ztp_agent_client.py - "still applying"      (message only, state unchanged)
+#   ztp_agent_client.py --stats
+#
+# It is started from boot hooks on slow switch CPUs, so it imports nothing
+# beyond sys, os, json and socket and parses its few arguments by hand. The
+# agent's socket is taken from $ZTP_AGENT_SOCKET if set.
+#
+# Exit status: 0 queued (or dropped as a duplicate), 1 refused by the agent,
+# 2 usage error, 3 no agent listening. On 3 the caller can fall back to
+# ztp_set_device_status_httplib.py.
+import os
+import sys
+import json
+import socket
+
+# Defaults
+socket_path = '/var/run/ztp_agent.sock'
+timeout     = 2.0
+
+usage = '''usage: ztp_agent_client.py STATE|- [MESSAGE] [--device_ip IP] [--device_os OS] [--socket PATH]
+       ztp_agent_client.py --stats [--socket PATH]
+'''
+
+def parse_args(argv):
+  """Returns (event, socket path), or None for a usage error"""
+  event = {}
+  path = os.environ.get('ZTP_AGENT_SOCKET') or socket_path
+  options = {'--device_ip': 'ip_addr', '--device_os': 'os_name', '--socket': None}
+  positional = []
+  argv = list(argv)
+  while argv:
+    arg = argv.pop(0)
+    if arg == '--stats':
+      event['op'] = 'stats'
+    elif arg in options:
+      if not argv:
+        return None
+      value = argv.pop(0)
+      if options[arg]:
+        event[options[arg]] = value
+      else:
+        path = value
+    elif arg.startswith('--') and len(arg) > 2:
+      return None
+    else:
+      positional.append(arg)
+  if event.get('op'):
+    return (event, path) if not positional else None
+  if not 1 <= len(positional) <= 2:
+    return None
+  if positional[0] != '-':
+    event['state'] = positional[0]
+  if len(positional) > 1:
+    event['message'] = positional[1]
+  if 'state' not in event and 'message' not in event:
+    return None
+  return event, path
+
+def send(event, path=socket_path, timeout=timeout):
+  """Returns the agent's reply. Raises socket.error if no agent is listening"""
+  s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  s.settimeout(timeout)
+  try:
+    s.connect(path)
+    s.sendall((json.dumps(event) + '\n').encode('utf-8'))
+    reply = b''
+    while not reply.endswith(b'\n'):
+      chunk = s.recv(4096)
+      if not chunk:
+        break
+      reply += chunk
+  finally:
+    s.close()
+  return json.loads(reply.decode('utf-8'))
+
+def main(argv=None):
+  if argv is None:
+    argv = sys.argv[1:]
+  if '-h' in argv or '--help' in argv:
+    sys.stdout.write(usage)
+    return 0
+  parsed = parse_args(argv)
+  if parsed is None:
+    sys.stderr.write(usage)
+    return 2
+  event, path = parsed
+  try:
+    reply = send(event, path)
+  except (socket.error, ValueError) as e:
+    sys.stderr.write("ERROR: No ZTP agent answering on {}: {}\n".format(path, e))
+    return 3
+  if event.get('op') == 'stats':
+    sys.stdout.write(json.dumps(reply, sort_keys=True) + '\n')
+    return 0
+  if not reply.get('ok'):
+    sys.stderr.write("ERROR: The ZTP agent refused {}: {}\n".format(json.dumps(event), reply.get('error')))
+    return 1
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,256 @@
+#!/usr/bin/python
+
+# Benchmark harness for the ZTP clients. Starts the stand-in ZTP server
+# (ztp_standin_server.py) in-process and drives each client path against it
+# at a configurable concurrency:
+#
+#   add-*     POST of a device the server doesn't know (1 round trip)
+#   re-add-*  POST of a known device: "device already exists", DELETE, POST
+#             (3 round trips, the onl_preinstall.py/ztp_add_device_httplib.py path)
+#   status-*  PUT to /api/devices/status
+#
+# '*-pooled' shares one keep-alive ztp_client transport between all workers,
+# '*-oneshot' opens a new connection per operation the way one script
+# invocation per device does, '*-requests' uses the requests backend (when
+# installed) and 'add-async' the asyncio driver (Python 3 only).
+#
+# For every scenario it reports throughput, p50/p95/p99 latency, and the HTTP
+# requests and TCP connections the server saw per operation. --output writes
+# the results as JSON, --compare checks them against an earlier run.
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import threading
+try:
+  import httplib
+except ImportError:
+  import http.client as httplib
+
+import ztp_client
+from ztp_standin_server import StandinServer
+
+# Defaults
+operations  = 500
+concurrency = 8
+tolerance   = 0.10
+
+def bench_device(i):
+  return dict(
+    ip_addr       = '10.{}.{}.{}'.format((i >> 16) & 255, (i >> 8) & 255, i & 255),
+    os_name       = 'ONL',
+    serial_number = 'BENCH{:07d}'.format(i),
+    hw_model      = 'accton_as4610_54',
+    os_version    = ztp_client.os_version,
+    message       = 'ztp_bench.py',
+    state         = 'OS-INSTALL'
+  )
+
+def oneshot(operation):
+  """Runs operation on a transport of its own, like a fresh script invocation"""
+  def run(shared, device):
+    transport = ztp_client.HttplibTransport(*shared.url_base.rsplit(':', 1), size=1)
+    try:
+      return operation(transport, device)
+    finally:
+      transport.close()
+  return run
+
+def add(transport, device):
+  outcome, r1 = ztp_client.add_device(transport, device)
+  return outcome in ('added', 'replaced')
+
+def set_status(transport, device):
+  r1 = ztp_client.set_status(transport, device['ip_addr'], device['os_name'], 'CONFIG', 'ztp_bench.py')
+  return r1.ok and r1.data['ok']
+
+# name: (operation, preload the devices into the server, backend)
+scenarios = [
+  ('add-pooled',       add,                 False, 'httplib'),
+  ('add-oneshot',      oneshot(add),        False, 'httplib'),
+  ('re-add-pooled',    add,                 True,  'httplib'),
+  ('re-add-oneshot',   oneshot(add),        True,  'httplib'),
+  ('status-pooled',    set_status,          True,  'httplib'),
+  ('status-oneshot',   oneshot(set_status), True,  'httplib'),
+  ('add-requests',     add,                 False, 'requests'),
+  ('status-requests',  set_status,          True,  'requests'),
+  ('add-async',        None,                False, 'async'),
+]
+
+def percentile(ordered, p):
+  if not ordered:
+    return 0.0
+  return ordered[int(round(p / 100.0 * (len(ordered) - 1)))]
+
+def run_threads(server, operation, backend, ops, workers):
+  """Runs ops operations from a pool of worker threads. Returns (latencies, errors)"""
+  transport = ztp_client.backends[backend]('127.0.0.1', server.port, size=workers)
+  latencies = []
+  errors = [0]
+  lock = threading.Lock()
+  counter = iter(range(ops))
+
+  def worker():
+    while True:
+      with lock:
+        i = next(counter, None)
+      if i is None:
+        return
+      started = time.time()
+      try:
+        ok = operation(transport, bench_device(i))
+      except (ValueError, socket.error, httplib.HTTPException, IOError):
+        ok = False
+      elapsed = time.time() - started
+      with lock:
+        latencies.append(elapsed)
+        if not ok:
+          errors[0] += 1
+
+  threads = [threading.Thread(target=worker) for _ in range(workers)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  transport.close()
+  return latencies, errors[0]
+
+def run_async(server, ops, workers):
+  import asyncio
+  import ztp_fleet_async
+  loop = asyncio.new_event_loop()
+  asyncio.set_event_loop(loop)
+  transport = ztp_fleet_async.AsyncTransport('127.0.0.1', server.port, 30.0)
+  driver = ztp_fleet_async.FleetDriver(transport, workers)
+  driver.op_latencies = []
+  devices = ((i, bench_device(i)) for i in range(ops))
+  try:
+    loop.run_until_complete(driver.run(driver.add, devices))
+  finally:
+    transport.close()
+    loop.close()
+  return driver.op_latencies, driver.outcomes.get('failed', 0) + driver.outcomes.get('timeout', 0)
+
+def available(backend):
+  if backend == 'async':
+    return sys.version_info >= (3, 5)
+  if backend == 'requests':
+    try:
+      import requests
+    except ImportError:
+      return False
+  return True
+
+def run_scenario(server, name, operation, preload, backend, ops, workers):
+  with server.lock:
+    server.devices = {}
+    if preload:
+      for i in range(ops):
+        device = bench_device(i)
+        server.devices[(device['ip_addr'], device['os_name'])] = device
+  server.reset_stats()
+
+  started = time.time()
+  if backend == 'async':
+    latencies, errors = run_async(server, ops, workers)
+  else:
+    latencies, errors = run_threads(server, operation, backend, ops, workers)
+  elapsed = time.time() - started
+  stats = server.reset_stats()
+
+  latencies.sort()
+  return dict(
+    scenario           = name,
+    operations         = ops,
+    concurrency        = workers,
+    errors             = errors,
+    seconds            = round(elapsed, 4),
+    ops_per_sec        = round(ops / elapsed, 1) if elapsed else 0,
+    latency_ms         = dict(
+      mean = round(1000.0 * sum(latencies) / len(latencies), 3) if latencies else 0,
+      p50  = round(1000.0 * percentile(latencies, 50), 3),
+      p95  = round(1000.0 * percentile(latencies, 95), 3),
+      p99  = round(1000.0 * percentile(latencies, 99), 3),
+      max  = round(1000.0 * (latencies[-1] if latencies else 0), 3),
+    ),
+    requests_per_op    = round(float(stats.get('requests', 0)) / ops, 3),
+    connections_per_op = round(float(stats.get('connections', 0)) / ops, 3),
+    injected_errors    = stats.get('injected_errors', 0),
+  )
+
+def compare(results, baseline_path, tolerance):
+  """Returns a description of every scenario that got slower than in the baseline run"""
+  with open(baseline_path) as f:
+    baseline = dict((r['scenario'], r) for r in json.load(f)['results'])
+  regressions = []
+  for result in results:
+    old = baseline.get(result['scenario'])
+    if not old:
+      continue
+    if result['ops_per_sec'] < old['ops_per_sec'] * (1 - tolerance):
+      regressions.append('{}: throughput {} -> {} ops/s'.format(result['scenario'], old['ops_per_sec'], result['ops_per_sec']))
+    if result['latency_ms']['p95'] > old['latency_ms']['p95'] * (1 + tolerance):
+      regressions.append('{}: p95 {} -> {} ms'.format(result['scenario'], old['latency_ms']['p95'], result['latency_ms']['p95']))
+    if result['connections_per_op'] > old['connections_per_op'] * (1 + tolerance):
+      regressions.append('{}: connections/op {} -> {}'.format(result['scenario'], old['connections_per_op'], result['connections_per_op']))
+  return regressions
+
+def main(argv=None):
+  names = [s[0] for s in scenarios]
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--scenarios', help='Comma separated scenarios to run. Default: all available. Choices: {}'.format(', '.join(names)))
+  parser.add_argument('--operations', help='Operations per scenario. Default: {}'.format(operations), type=int, default=operations)
+  parser.add_argument('--concurrency', help='Concurrent workers per scenario. Default: {}'.format(concurrency), type=int, default=concurrency)
+  parser.add_argument('--latency', help='Server-side latency to inject per request, in seconds', type=float, default=0.0)
+  parser.add_argument('--jitter', help='Randomize the injected latency by +/- this fraction', type=float, default=0.0)
+  parser.add_argument('--error_rate', help='Fraction of requests the server fails', type=float, default=0.0)
+  parser.add_argument('--error_code', help='HTTP status of injected failures. Default: 500', type=int, default=500)
+  parser.add_argument('--output', help='Write the results to this JSON file')
+  parser.add_argument('--compare', help='JSON file of an earlier run; exit non-zero if a scenario regressed')
+  parser.add_argument('--tolerance', help='Allowed regression against --compare, as a fraction. Default: {}'.format(tolerance), type=float, default=tolerance)
+  args = parser.parse_args(argv)
+
+  wanted = args.scenarios.split(',') if args.scenarios else names
+  for name in wanted:
+    if name not in names:
+      parser.error('unknown scenario {}'.format(name))
+
+  server = StandinServer('127.0.0.1', 0, args.latency, args.jitter, args.error_rate, args.error_code).start()
+  results = []
+  try:
+    for name, operation, preload, backend in scenarios:
+      if name not in wanted:
+        continue
+      if not available(backend):
+        print("{:<16} skipped ({} backend not available)".format(name, backend))
+        continue
+      result = run_scenario(server, name, operation, preload, backend, args.operations, max(1, args.concurrency))
+      results.append(result)
+      print("{scenario:<16} {ops_per_sec:>9.1f} ops/s  p50 {p50:>8.2f}ms  p95 {p95:>8.2f}ms  p99 {p99:>8.2f}ms  "
+            "{requests_per_op:.2f} req/op  {connections_per_op:.3f} conn/op  {errors} errors".format(**dict(result, **result['latency_ms'])))
+  finally:
+    server.stop()
+
+  if args.output:
+    report = dict(
+      timestamp = time.time(),
+      python    = platform.python_version(),
+      platform  = platform.platform(),
+      settings  = dict((k, getattr(args, k)) for k in ['operations', 'concurrency', 'latency', 'jitter', 'error_rate', 'error_code']),
+      results   = results,
+    )
+    with open(args.output, 'w') as f:
+      json.dump(report, f, sort_keys=True, indent=2)
+
+  if args.compare:
+    regressions = compare(results, args.compare, args.tolerance)
+    for regression in regressions:
+      print("REGRESSION: {}".format(regression))
+    if regressions:
+      return 1
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,537 @@
+"""
+Client for the AEON ZTP server API shared by the ztp_* scripts.
+
+Importing this module has no side effects, so it can be used from other
+Python tooling as well as from the command line entry points:
+
+  import ztp_client
+  transport = ztp_client.get_transport('ztp.example.net', '8080')
+  outcome, r1 = ztp_client.add_device(transport, device_data)
+  ztp_client.set_status(transport, '172.31.0.50', 'ONL', 'DONE')
+
+Two transports are available. 'httplib' only needs the standard library and
+is what the ONL installer environment can run. 'requests' uses a
+requests.Session and is meant for ops hosts. Both keep a small pool of
+keep-alive connections per ZTP server, and get_transport() hands out the
+same transport for the same server, so callers making thousands of calls
+reuse a handful of sockets.
+
+With ssl=True both speak HTTPS. The httplib transport only checks the
+certificate with verify=True (system CAs) or ca_file, since the ZTP servers
+mostly run with self-signed ones. The requests transport checks it by
+default, as requests itself does; verify=False turns that off. The httplib
+transport shares one
+SSLContext across its connections and, on Python 3.6+, offers the last TLS
+session when it opens a new one, so reconnects are abbreviated handshakes.
+Both count their handshakes in .handshakes (and .resumed) for the scripts
+to report.
+
+With a ztp_codec.Codec as .wire, a transport negotiates MessagePack or CBOR
+with the server and falls back to JSON, see ztp_codec. Callers keep building
+JSON bodies; the conversion happens in the transport.
+
+The ONL installer plugins (onl_preinstall.py, onl_postinstall.py) are
+extracted on their own by the installer and cannot import this module.
+"""
+import json
+import socket
+import threading
+import time
+try:
+  import httplib
+  import Queue as queue
+except ImportError:
+  import http.client as httplib
+  import queue
+
+import ztp_codec
+import ztp_metrics
+
+# Defaults
+hostname         = 'localhost'
+port             = '8080'
+pool_size        = 4
+os_version       = '2.0.0-2017-07-19.1529-40fc82b_armel'
+httpSuccessCodes = [200, 201, 202, 204]
+statuses         = [
+  'START', 'DONE', 'CONFIG', 'AWAIT-ONLINE', 'AWAIT-SYSTEM-READY', 'OS-INSTALL', 'OS-REBOOTING', 'FAILED'
+]
+
+# Written by onl_preinstall.py, saved to ONL-DATA by onl_postinstall.py
+identity_path = '/mnt/onl/data/ztp/identity.json'
+
+# Candidate ZTP servers for race(), one host[:port] per line, as read by the
+# ONL plugins
+candidates_path = '/etc/ztp_candidates'
+race_stagger    = 0.25
+race_timeout    = 2.0
+
+DEVICES_URL = '/api/devices'
+STATUS_URL  = '/api/devices/status'
+url_headers = {'Content-Type': 'application/json', 'Accept': 'application/json' }
+
+# The order a device goes through the statuses in. A device may skip ahead
+# (the ONL plugins go from OS-INSTALL straight to AWAIT-ONLINE) but never
+# back, except to start over: a new provisioning run begins with START, or
+# with OS-INSTALL when the installer is rerun. FAILED can be reported from
+# anywhere, and a failed device can be retried from any status.
+lifecycle = ['START', 'OS-INSTALL', 'OS-REBOOTING', 'AWAIT-ONLINE', 'AWAIT-SYSTEM-READY', 'CONFIG', 'DONE']
+restarts  = ['START', 'OS-INSTALL']
+transitions = dict((state, set(lifecycle[i:] + restarts + ['FAILED'])) for i, state in enumerate(lifecycle))
+transitions['FAILED'] = set(statuses)
+
+class InvalidTransition(ValueError):
+  pass
+
+def read_identity(path=identity_path):
+  """The device identity the ONL preinstall plugin registered. Its 'key'
+  holds the ip_addr and os_name the ZTP server knows the device by. Raises
+  IOError or ValueError"""
+  with open(path) as f:
+    identity = json.load(f)
+  if not isinstance(identity, dict) or not isinstance(identity.get('key'), dict):
+    raise ValueError('{} has no device key'.format(path))
+  return identity
+
+def read_candidates(value, port=port):
+  """'ztp1,ztp2:8081' or '@FILE' (one per line, # comments) -> ['ztp1:<port>', 'ztp2:8081']"""
+  if value.startswith('@'):
+    with open(value[1:]) as f:
+      values = [line.split('#', 1)[0] for line in f]
+  else:
+    values = value.split(',')
+  candidates = []
+  for value in values:
+    value = value.strip()
+    if value and ':' not in value:
+      value = '{}:{}'.format(value, port)
+    if value and value not in candidates:
+      candidates.append(value)
+  return candidates
+
+def race(candidates, stagger=race_stagger, timeout=race_timeout):
+  """Happy eyeballs across ZTP servers: opens TCP connections to the
+  candidates in order, starting the next one stagger seconds later or as soon
+  as the previous one failed. Returns the host:port of the first that
+  connects; the connections themselves are closed. Raises socket.error if
+  none does within timeout"""
+  results = queue.Queue()
+  def attempt(server):
+    host, _, server_port = server.rpartition(':')
+    try:
+      socket.create_connection((host, int(server_port)), timeout).close()
+    except socket.error as e:
+      results.put((server, e))
+    else:
+      results.put((server, None))
+  deadline = time.time() + timeout
+  waiting = list(candidates)
+  running = 0
+  errors = []
+  while waiting or running:
+    if waiting:
+      worker = threading.Thread(target=attempt, args=(waiting.pop(0),))
+      worker.daemon = True
+      worker.start()
+      running += 1
+    try:
+      server, error = results.get(timeout=stagger if waiting else max(0.01, deadline - time.time()))
+    except queue.Empty:
+      if waiting:
+        continue
+      break
+    running -= 1
+    if error is None:
+      return server
+    errors.append('{}: {}'.format(server, error))
+  raise socket.error('no ZTP server answered ({})'.format('; '.join(errors) or 'timed out'))
+
+def valid_status(state):
+  return state.upper() in statuses
+
+def valid_transition(previous, state):
+  """True if a device last known to be in previous (None: unknown) may report state"""
+  if previous is None:
+    return True
+  return state.upper() in transitions.get(previous.upper(), ())
+
+class Response(object):
+  """A ZTP server response. The body is parsed at most once, on first use of
+  .data, as JSON or whatever format its content_type says. The names in
+  .headers are lower case"""
+  def __init__(self, status, reason, body, timing=None, content_type=None, headers=None):
+    self.status = status
+    self.reason = reason
+    self.body = body
+    self.timing = timing
+    self.content_type = content_type
+    self.headers = headers or {}
+
+  @property
+  def ok(self):
+    return self.status in httpSuccessCodes
+
+  @property
+  def data(self):
+    if not hasattr(self, '_data'):
+      started = time.time()
+      self._data = ztp_codec.loads(self.body, self.content_type)
+      if self.timing is not None:
+        self.timing.add('decode', time.time() - started)
+    return self._data
+
+  @property
+  def message(self):
+    data = self.data
+    return data.get('message') if isinstance(data, dict) else None
+
+def wire_request(transport, body, headers):
+  """The body and headers to send with the transport's .wire format: always
+  asked for in Accept, used for the body once the server has answered in it"""
+  wire = transport.wire
+  headers = dict(headers, Accept=wire.accept)
+  if transport.wire_spoken and body is not None and headers.get('Content-Type') == 'application/json':
+    if isinstance(body, bytes) and not isinstance(body, str):
+      body = body.decode('utf-8')
+    body = wire.dumps(json.loads(body))
+    headers['Content-Type'] = wire.content_type
+  return body, headers
+
+def wire_response(transport, response, headers):
+  """Notes whether the server speaks the transport's .wire format. Returns
+  True if the request has to be sent again in JSON"""
+  if response.status == 415 and headers.get('Content-Type') == transport.wire.content_type:
+    transport.wire = None
+    transport.wire_spoken = False
+    return True
+  if not transport.wire_spoken and ztp_codec.media_type(response.content_type) in transport.wire.content_types:
+    transport.wire_spoken = True
+  return False
+
+def tls_context(verify=False, ca_file=None):
+  """The SSLContext for a transport's HTTPS connections"""
+  import ssl
+  if verify or ca_file:
+    return ssl.create_default_context(cafile=ca_file)
+  # The ZTP servers mostly run with self-signed certificates; checking them
+  # has to be asked for
+  return ssl._create_unverified_context()
+
+class ResumingHTTPSConnection(httplib.HTTPSConnection):
+  """An HTTPSConnection that offers the transport's last TLS session in its
+  handshake. SSLContext.wrap_socket() only takes a session on Python 3.6+;
+  older versions always do a full handshake"""
+  transport = None
+
+  def connect(self):
+    httplib.HTTPConnection.connect(self)
+    options = dict(server_hostname=self.host)
+    session = self.transport.tls_session if self.transport else None
+    if session is not None:
+      options['session'] = session
+    self.sock = self._context.wrap_socket(self.sock, **options)
+
+class HttplibTransport(object):
+  """A fixed number of keep-alive HTTPConnections to one ZTP server, opened on demand.
+  With a ztp_metrics.Recorder as .recorder, the phases of every request are
+  recorded; with a ztp_trace.Tracer as .tracer, the requests themselves"""
+  def __init__(self, hostname=hostname, port=port, size=pool_size, timeout=None, ssl=False, verify=False, ca_file=None):
+    self.url_base = '{}:{}'.format(hostname, port)
+    self.timeout = timeout
+    self.opened = 0
+    self.debuglevel = 0
+    self.recorder = None
+    self.tracer = None
+    self.wire = None
+    self.wire_spoken = False
+    self.context = tls_context(verify, ca_file) if ssl else None
+    self.tls_session = None
+    self.handshakes = 0
+    self.resumed = 0
+    self.lock = threading.Lock()
+    self.idle = queue.Queue()
+    for _ in range(size):
+      self.idle.put(None)
+
+  def connect(self):
+    if self.context:
+      conn = ResumingHTTPSConnection(self.url_base, timeout=self.timeout, context=self.context)
+      conn.transport = self
+    else:
+      conn = httplib.HTTPConnection(self.url_base, timeout=self.timeout)
+    conn.set_debuglevel(self.debuglevel)
+    with self.lock:
+      self.opened += 1
+    return conn
+
+  def connected(self, conn):
+    """Counts the TLS handshake conn just did"""
+    with self.lock:
+      self.handshakes += 1
+      if getattr(conn.sock, 'session_reused', False):
+        self.resumed += 1
+
+  def request(self, method, url, body=None, headers={}):
+    """Sends one request on a pooled connection. A kept-alive connection the
+    server has already dropped is reopened once"""
+    sent, sent_headers = body, headers
+    if self.wire is not None:
+      sent, sent_headers = wire_request(self, body, headers)
+    if sent is not None and not isinstance(sent, bytes):
+      sent = sent.encode('utf-8')
+    timing = ztp_metrics.Timing(method, url)
+    conn = self.idle.get() or self.connect()
+    try:
+      for attempt in [0, 1]:
+        timing.retries = attempt
+        try:
+          if conn.sock is None:
+            started = time.time()
+            conn.connect()
+            timing.add('connect', time.time() - started)
+            if self.context:
+              self.connected(conn)
+          started = time.time()
+          conn.request(method, url, sent, sent_headers)
+          wrote = time.time()
+          timing.add('write', wrote - started)
+          r1 = conn.getresponse()
+          started = time.time()
+          timing.add('ttfb', started - wrote)
+          response = Response(r1.status, r1.reason, r1.read(), timing, r1.getheader('Content-Type'),
+                              dict((name.lower(), value) for name, value in r1.getheaders()))
+          timing.add('read', time.time() - started)
+          if self.context and self.tls_session is None:
+            # TLS 1.3 sends the session ticket after the handshake, so it is
+            # only there once a response has been read
+            self.tls_session = getattr(conn.sock, 'session', None)
+          break
+        except (socket.error, httplib.HTTPException) as e:
+          conn.close()
+          if attempt:
+            conn = None
+            timing.done(error='{}: {}'.format(type(e).__name__, e))
+            self.finished(timing, url, body)
+            raise
+          conn = self.connect()
+    finally:
+      self.idle.put(conn)
+    timing.done(response.status)
+    self.finished(timing, url, body)
+    if self.wire is not None and wire_response(self, response, sent_headers):
+      return self.request(method, url, body, headers)
+    return response
+
+  def finished(self, timing, url, body):
+    if self.recorder:
+      self.recorder.record(timing)
+    if self.tracer:
+      self.tracer.record(timing, url, body)
+
+  def close(self):
+    while True:
+      try:
+        conn = self.idle.get_nowait()
+      except queue.Empty:
+        return
+      if conn:
+        conn.close()
+
+class RequestsTransport(object):
+  """A requests.Session with a keep-alive pool to one ZTP server. urllib3
+  does not resume TLS sessions, so every new connection is a full handshake"""
+  def __init__(self, hostname=hostname, port=port, size=pool_size, timeout=None, ssl=False, verify=True, ca_file=None):
+    import requests
+    self.requests = requests
+    self.ssl = ssl
+    self.url_base = '{}:{}'.format(hostname, port)
+    self.base_url = '{}://{}:{}'.format('https' if ssl else 'http', hostname, port)
+    self.timeout = timeout
+    self.recorder = None
+    self.tracer = None
+    self.wire = None
+    self.wire_spoken = False
+    self.resumed = 0
+    self.session = requests.Session()
+    self.session.verify = ca_file or verify
+    self.adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=size)
+    self.session.mount(self.base_url, self.adapter)
+
+  @property
+  def opened(self):
+    pools = self.adapter.poolmanager.pools
+    return sum(pools[key].num_connections for key in pools.keys())
+
+  @property
+  def handshakes(self):
+    return self.opened if self.ssl else 0
+
+  def request(self, method, url, body=None, headers={}):
+    """requests doesn't expose connect and write separately; both are part of ttfb here"""
+    sent, sent_headers = body, headers
+    if self.wire is not None:
+      sent, sent_headers = wire_request(self, body, headers)
+    timing = ztp_metrics.Timing(method, url)
+    try:
+      r1 = self.session.request(method, self.base_url + url, data=sent, headers=sent_headers, timeout=self.timeout, stream=True)
+      started = time.time()
+      timing.ttfb = started - timing.started
+      response = Response(r1.status_code, r1.reason, r1.content, timing, r1.headers.get('Content-Type'),
+                          dict((name.lower(), value) for name, value in r1.headers.items()))
+      timing.read = time.time() - started
+    except self.requests.exceptions.RequestException as e:
+      timing.done(error='{}: {}'.format(type(e).__name__, e))
+      self.finished(timing, url, body)
+      raise
+    timing.done(response.status)
+    self.finished(timing, url, body)
+    if self.wire is not None and wire_response(self, response, sent_headers):
+      return self.request(method, url, body, headers)
+    return response
+
+  def finished(self, timing, url, body):
+    if self.recorder:
+      self.recorder.record(timing)
+    if self.tracer:
+      self.tracer.record(timing, url, body)
+
+  def close(self):
+    self.session.close()
+
+backends = {
+  'httplib': HttplibTransport,
+  'requests': RequestsTransport,
+}
+transports = {}
+transports_lock = threading.Lock()
+
+def tls_summary(transport):
+  """One line on the TLS handshakes a transport did, for the scripts to print with --ssl"""
+  return "TLS handshakes: {}, resumed: {}".format(transport.handshakes, transport.resumed)
+
+def get_transport(hostname=hostname, port=port, backend='httplib', **options):
+  """Returns the shared transport for one ZTP server, creating it on first use"""
+  key = (backend, '{}'.format(hostname), '{}'.format(port), tuple(sorted(options.items())))
+  with transports_lock:
+    if key not in transports:
+      transports[key] = backends[backend](hostname, port, **options)
+    return transports[key]
+
+def add_device(transport, device_data, replace=True, cache=None):
+  """POSTs a device. If the ZTP server already has it and replace is set, the
+  old record is deleted and the device re-added. Returns (outcome, response)
+  where outcome is one of 'added', 'replaced', 'cached' or 'failed'.
+
+  With a ztp_regcache.RegistrationCache, a record registered unchanged within
+  the cache TTL is not sent at all ('cached', response None), and a changed
+  one is replaced without first POSTing it"""
+  known = cache.lookup(device_data) if cache else None
+  if known == 'fresh':
+    return 'cached', None
+  if known == 'changed' and replace:
+    outcome, r1 = replace_device(transport, device_data)
+  else:
+    r1 = transport.request('POST', DEVICES_URL, json.dumps(device_data), url_headers)
+    if not r1.ok:
+      outcome = 'failed'
+    elif r1.message == "device already exists" and replace:
+      outcome, r1 = replace_device(transport, device_data)
+    elif r1.message == "device added":
+      outcome = 'added'
+    else:
+      outcome = 'failed'
+  if cache:
+    if outcome == 'failed':
+      cache.forget(device_data)
+    else:
+      cache.remember(device_data)
+  return outcome, r1
+
+def replace_device(transport, device_data):
+  """DELETEs the device and POSTs it again. Returns ('replaced' or 'failed', response)"""
+  delete_device(transport, ip_addr=device_data['ip_addr'])
+  device_data = dict(device_data, message="WARN: Device was alredy in ZTP DB. Deleted and re-added. ({}|{}|{}|{})".format(
+    device_data['ip_addr'], device_data['os_name'], device_data.get('serial_number'), time.time()))
+  r1 = transport.request('POST', DEVICES_URL, json.dumps(device_data), url_headers)
+  if r1.ok and r1.message == "device added":
+    return 'replaced', r1
+  return 'failed', r1
+
+def set_status(transport, ip_addr, os_name, state, message="", transitions=None):
+  """PUTs a new state for the device. The ZTP server finds the device by the
+  (ip_addr, os_name) tuple, so an update after the OS string changed fails.
+
+  With a ztp_transitions.TransitionLog, a state the device can't reach from
+  the one last recorded for it raises InvalidTransition before anything is
+  sent, and an accepted one is recorded"""
+  if not valid_status(state):
+    raise ValueError('{} is not a valid ZTP status'.format(state))
+  if transitions is not None:
+    previous = transitions.last(ip_addr, os_name)
+    if not valid_transition(previous, state):
+      raise InvalidTransition('{} {} can not go from {} to {}'.format(ip_addr, os_name, previous, state))
+  device_data = dict(
+    ip_addr = ip_addr,
+    os_name = os_name,
+    state   = state,
+    message = message
+  )
+  r1 = transport.request('PUT', STATUS_URL, json.dumps(device_data), url_headers)
+  if transitions is not None and status_outcome(r1) == 'updated':
+    transitions.record(ip_addr, os_name, state)
+  return r1
+
+def result_line(op, device_data, outcome, response=None, elapsed=None, error=None, **extra):
+  """Describes one operation as a compact JSON line, for --output jsonl.
+  The response body is parsed at most once (Response.data is cached) and
+  only its message is kept"""
+  record = dict(
+    op      = op,
+    ip_addr = device_data.get('ip_addr'),
+    os_name = device_data.get('os_name'),
+    outcome = outcome,
+    status  = None,
+    message = None,
+    ms      = None if elapsed is None else round(1000.0 * elapsed, 3)
+  )
+  if response is not None:
+    record['status'] = response.status
+    try:
+      record['message'] = response.message
+    except ValueError:
+      error = error or 'unparseable response body'
+  if error:
+    record['error'] = '{}'.format(error)
+  record.update(extra)
+  return json.dumps(record, sort_keys=True, separators=(',', ':'))
+
+def status_outcome(response):
+  """'updated' if the ZTP server took a set_status() PUT, 'rejected' if it
+  answered with ok false, 'failed' on an HTTP error"""
+  if not response.ok:
+    return 'failed'
+  if not response.data.get('ok'):
+    return 'rejected'
+  return 'updated'
+
+def query_string(filters):
+  # urllib is only needed for filtered calls; keep it off the startup path
+  try:
+    from urllib import urlencode
+  except ImportError:
+    from urllib.parse import urlencode
+  return urlencode(sorted(filters.items()))
+
+def delete_device(transport, **filters):
+  """DELETEs the devices matching filters, e.g. ip_addr='172.31.0.50'"""
+  return transport.request('DELETE', '{}?{}'.format(DEVICES_URL, query_string(filters)))
+
+def list_devices(transport, **filters):
+  """GETs the devices matching filters (all of them by default). Returns the list of device dicts"""
+  url = DEVICES_URL
+  if filters:
+    url = '{}?{}'.format(url, query_string(filters))
+  r1 = transport.request('GET', url, headers={'Accept': 'application/json'})
+  if not r1.ok:
+    raise httplib.HTTPException('GET {}: {} {}'.format(url, r1.status, r1.reason))
+  return r1.data.get('items', [])
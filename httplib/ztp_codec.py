@@ -0,0 +1,116 @@
+"""
+Wire formats for the ZTP API: JSON, and MessagePack or CBOR where installed.
+
+The AEON ZTP server speaks JSON. A transport with a binary format as .wire
+asks for it in every request's Accept header:
+
+  Accept: application/msgpack, application/json;q=0.5
+
+and keeps sending JSON bodies until a response comes back in that format.
+From then on it converts its request bodies as well (Content-Type), and it
+goes back to JSON for good if the server answers one with 415. A server that
+doesn't know the format simply keeps answering JSON, so nothing changes
+against it. Callers don't see any of this: they build JSON bodies and use
+Response.data as before.
+
+msgpack and cbor2 are optional and only imported when a format is asked for:
+
+  transport.wire = ztp_codec.get('msgpack')    # ImportError if not installed
+
+ztp_standin_server.py answers in any installed format a client asks for,
+and ztp_codec_bench.py compares the formats with the JSON path.
+"""
+import json
+
+# Defaults
+names = ['json', 'msgpack', 'cbor']
+
+# Content types of the binary formats, known without importing their libraries
+known_types = {
+  'msgpack': ['application/msgpack', 'application/x-msgpack'],
+  'cbor':    ['application/cbor'],
+}
+
+class Codec(object):
+  def __init__(self, name, content_type, dumps, loads, aliases=()):
+    self.name = name
+    self.content_type = content_type
+    self.content_types = [content_type] + list(aliases)
+    self.dumps = dumps
+    self.loads = loads
+
+  @property
+  def accept(self):
+    """An Accept header preferring this format, with JSON as the fallback"""
+    if self.name == 'json':
+      return 'application/json'
+    return '{}, application/json;q=0.5'.format(self.content_type)
+
+def json_loads(body):
+  if isinstance(body, bytes) and not isinstance(body, str):
+    body = body.decode('utf-8')
+  return json.loads(body)
+
+JSON = Codec('json', 'application/json', json.dumps, json_loads)
+loaded = {'json': JSON}
+
+def get(name):
+  """The Codec for name. Raises ImportError if its library isn't installed,
+  ValueError for an unknown name"""
+  if name not in loaded:
+    if name == 'msgpack':
+      import msgpack
+      loaded[name] = Codec(name, known_types[name][0],
+                           lambda data: msgpack.packb(data, use_bin_type=True),
+                           lambda body: msgpack.unpackb(body, raw=False),
+                           aliases=known_types[name][1:])
+    elif name == 'cbor':
+      import cbor2
+      loaded[name] = Codec(name, known_types[name][0], cbor2.dumps, cbor2.loads)
+    else:
+      raise ValueError('unknown wire format {} (known: {})'.format(name, ', '.join(names)))
+  return loaded[name]
+
+def media_type(header):
+  """'application/msgpack; charset=x' -> 'application/msgpack'"""
+  return (header or '').split(';', 1)[0].strip().lower()
+
+def for_content_type(header):
+  """The Codec for a Content-Type header; JSON for none or an unknown one.
+  Raises ImportError for a known format whose library isn't installed"""
+  content_type = media_type(header)
+  for name, types in known_types.items():
+    if content_type in types:
+      return get(name)
+  return JSON
+
+def loads(body, content_type=None):
+  return for_content_type(content_type).loads(body)
+
+def preferred(accept):
+  """The installed Codec an Accept header ranks highest, JSON if none. For
+  the server side"""
+  ranked = []
+  for i, part in enumerate((accept or '').split(',')):
+    fields = part.split(';')
+    q = 1.0
+    for field in fields[1:]:
+      key, _, value = field.strip().partition('=')
+      if key == 'q':
+        try:
+          q = float(value)
+        except ValueError:
+          q = 0.0
+    ranked.append((-q, i, media_type(fields[0])))
+  for q, i, content_type in sorted(ranked):
+    if q == 0:
+      break
+    if content_type in ['application/json', '*/*', 'application/*']:
+      return JSON
+    for name, types in known_types.items():
+      if content_type in types:
+        try:
+          return get(name)
+        except ImportError:
+          break
+  return JSON
@@ -0,0 +1,167 @@
+#!/usr/bin/python
+
+# Compares the wire formats of ztp_codec.py with the JSON path the clients
+# use today. Two parts:
+#
+#   encode/decode  one device body (what POST /api/devices and PUT status
+#                  send) and a GET /api/devices response of --devices devices,
+#                  encoded and decoded --rounds times in-process
+#   round trip     GET /api/devices against the stand-in ZTP server
+#                  (ztp_standin_server.py, in-process), through a ztp_client
+#                  transport with the format as .wire
+#
+# For every format it reports the encoded size and the time per encode/decode,
+# and how both compare with JSON. msgpack and cbor2 are optional; a format
+# whose library isn't installed is reported and skipped. --output writes the
+# results as JSON.
+import sys
+import json
+import time
+import argparse
+import platform
+
+import ztp_client
+import ztp_codec
+from ztp_bench import bench_device
+from ztp_standin_server import StandinServer
+
+# Defaults
+devices  = 1000
+rounds   = 200
+requests = 20
+
+def timed(rounds, function, *args):
+  """Microseconds per call of function(*args), the best of three batches"""
+  best = None
+  for _ in range(3):
+    started = time.time()
+    for _ in range(rounds):
+      function(*args)
+    elapsed = (time.time() - started) / rounds
+    best = elapsed if best is None else min(best, elapsed)
+  return 1000000.0 * best
+
+def encode_decode(codec, payload, rounds):
+  body = codec.dumps(payload)
+  if codec.name == 'json':
+    # What the clients do: json.dumps() to text, sent as UTF-8
+    encode = lambda data: codec.dumps(data).encode('utf-8')
+    body = body.encode('utf-8')
+  else:
+    encode = codec.dumps
+  if codec.loads(body) != payload:
+    raise ValueError('{} does not round-trip the payload'.format(codec.name))
+  return dict(
+    bytes     = len(body),
+    encode_us = round(timed(rounds, encode, payload), 2),
+    decode_us = round(timed(rounds, codec.loads, body), 2),
+  )
+
+def round_trip(server, codec, requests):
+  """GET /api/devices requests times over one keep-alive connection"""
+  transport = ztp_client.HttplibTransport('127.0.0.1', server.port, size=1)
+  if codec.name != 'json':
+    transport.wire = codec
+  latencies = []
+  decode = 0.0
+  size = 0
+  try:
+    for i in range(requests + 1):
+      started = time.time()
+      r1 = transport.request('GET', ztp_client.DEVICES_URL, headers={'Accept': 'application/json'})
+      r1.data
+      elapsed = time.time() - started
+      if not r1.ok:
+        raise ValueError('GET {}: {} {}'.format(ztp_client.DEVICES_URL, r1.status, r1.reason))
+      if ztp_codec.media_type(r1.content_type) not in codec.content_types:
+        raise ValueError('the server answered {} instead of {}'.format(r1.content_type, codec.content_type))
+      if i:
+        # The first request only opens the connection
+        latencies.append(elapsed)
+        decode += r1.timing.decode or 0.0
+      size = len(r1.body)
+  finally:
+    transport.close()
+  latencies.sort()
+  return dict(
+    bytes     = size,
+    p50_ms    = round(1000.0 * latencies[len(latencies) // 2], 3),
+    mean_ms   = round(1000.0 * sum(latencies) / len(latencies), 3),
+    decode_ms = round(1000.0 * decode / len(latencies), 3),
+  )
+
+def relative(value, baseline):
+  return '{:.2f}x'.format(float(value) / baseline) if baseline else '-'
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--formats', help='Comma separated formats to compare with JSON. Default: all known. Choices: {}'.format(', '.join(ztp_codec.names[1:])))
+  parser.add_argument('--devices', help='Devices in the GET /api/devices response. Default: {}'.format(devices), type=int, default=devices)
+  parser.add_argument('--rounds', help='Encodes/decodes per measurement. Default: {}'.format(rounds), type=int, default=rounds)
+  parser.add_argument('--requests', help='GET /api/devices requests per format, 0 to skip the round trips. Default: {}'.format(requests), type=int, default=requests)
+  parser.add_argument('--output', help='Write the results to this JSON file')
+  args = parser.parse_args(argv)
+
+  wanted = ['json'] + (args.formats.split(',') if args.formats else ztp_codec.names[1:])
+  for name in wanted:
+    if name not in ztp_codec.names:
+      parser.error('unknown format {}'.format(name))
+  codecs = []
+  for name in wanted:
+    try:
+      codec = ztp_codec.get(name)
+    except ImportError as e:
+      print("{:<8} not installed ({})".format(name, e))
+      continue
+    if codec not in codecs:
+      codecs.append(codec)
+
+  payloads = [
+    ('device', bench_device(0), args.rounds * 10),
+    ('list', dict(ok=True, count=args.devices, items=[bench_device(i) for i in range(args.devices)]), args.rounds),
+  ]
+  results = []
+  for payload, data, n in payloads:
+    print("encode/decode {} ({} rounds)".format('one device' if payload == 'device' else 'a list of {} devices'.format(args.devices), n))
+    baseline = None
+    for codec in codecs:
+      result = dict(encode_decode(codec, data, n), format=codec.name, payload=payload)
+      baseline = baseline or result
+      results.append(result)
+      print("  {format:<8} {bytes:>9} bytes ({size})  encode {encode_us:>10.1f}us ({encode})  decode {decode_us:>10.1f}us ({decode})".format(
+        size=relative(result['bytes'], baseline['bytes']), encode=relative(result['encode_us'], baseline['encode_us']),
+        decode=relative(result['decode_us'], baseline['decode_us']), **result))
+
+  if args.requests > 0:
+    server = StandinServer('127.0.0.1', 0).start()
+    with server.lock:
+      for i in range(args.devices):
+        device = bench_device(i)
+        server.devices[(device['ip_addr'], device['os_name'])] = device
+    print("round trip GET {} of {} devices ({} requests)".format(ztp_client.DEVICES_URL, args.devices, args.requests))
+    baseline = None
+    try:
+      for codec in codecs:
+        result = dict(round_trip(server, codec, args.requests), format=codec.name, payload='get-devices')
+        baseline = baseline or result
+        results.append(result)
+        print("  {format:<8} {bytes:>9} bytes ({size})  p50 {p50_ms:>8.2f}ms  mean {mean_ms:>8.2f}ms ({mean})  decode {decode_ms:>8.2f}ms ({decode})".format(
+          size=relative(result['bytes'], baseline['bytes']), mean=relative(result['mean_ms'], baseline['mean_ms']),
+          decode=relative(result['decode_ms'], baseline['decode_ms']), **result))
+    finally:
+      server.stop()
+
+  if args.output:
+    report = dict(
+      timestamp = time.time(),
+      python    = platform.python_version(),
+      platform  = platform.platform(),
+      settings  = dict((k, getattr(args, k)) for k in ['devices', 'rounds', 'requests']),
+      results   = results,
+    )
+    with open(args.output, 'w') as f:
+      json.dump(report, f, sort_keys=True, indent=2)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,210 @@
+"""
+Local copy of the ZTP server's device list, indexed for queries.
+
+GET /api/devices returns every device the server knows, so each look at the
+fleet costs a full inventory transfer. A DeviceCache keeps the last list in a
+JSON file together with the ETag and Last-Modified the server sent with it:
+
+- within ttl seconds of the last check the cached list is used as is, with no
+  request at all;
+- after that it is revalidated with a conditional GET (If-None-Match,
+  If-Modified-Since). An unchanged list costs a 304 without a body; only a
+  changed one is transferred again.
+
+A server that sends neither validator gets a plain GET whenever the TTL has
+run out. Last-Modified has a resolution of one second: a list fetched in the
+same second as its Last-Modified may miss a change made later in that second,
+which If-Modified-Since would then never see. Such a Last-Modified is not
+kept (RFC 7232 calls it weak), so the next revalidation is a plain GET; the
+list it gets is from a later second and can be revalidated again.
+
+With path=None nothing is written and the cache only saves transfers within
+the process, which is how ztp_watch_devices.py polls.
+
+DeviceIndex answers filters on ip_addr, serial_number, hw_model and state
+from dicts built once per list instead of scanning every device:
+
+  cache = ztp_devcache.DeviceCache('/tmp/ztp_devices.json')
+  index = cache.fetch(transport)
+  index.select(state='AWAIT-SYSTEM-READY', hw_model='as4610')
+
+ztp_query_devices_httplib.py is the command line front end.
+"""
+import os
+import json
+import time
+from email.utils import parsedate_tz, mktime_tz
+try:
+  import httplib
+except ImportError:
+  import http.client as httplib
+
+import ztp_client
+
+# Defaults
+ttl  = 60
+path = '/tmp/ztp_devices_{server}.json'
+
+# The fields DeviceIndex can select on
+indexed = ['ip_addr', 'serial_number', 'hw_model', 'state']
+
+def index_key(field, value):
+  """States are compared case-insensitively like the server does, models
+  in lower case so a part of one can be looked for"""
+  value = '{}'.format(value)
+  if field == 'state':
+    return value.upper()
+  if field == 'hw_model':
+    return value.lower()
+  return value
+
+def state_order(state):
+  """Sort key putting states in lifecycle order, unknown ones last"""
+  order = ztp_client.lifecycle + ['FAILED']
+  return (order.index(state) if state in order else len(order), state)
+
+def strong_last_modified(headers):
+  """The response's Last-Modified if the list can't have changed again within
+  its second, i.e. it is at least a second older than the response's Date;
+  None otherwise"""
+  modified = parsedate_tz(headers.get('last-modified') or '')
+  date = parsedate_tz(headers.get('date') or '')
+  if modified is None or date is None or mktime_tz(modified) >= mktime_tz(date):
+    return None
+  return headers['last-modified']
+
+class DeviceIndex(object):
+  """The positions of the devices in items by the value of each indexed field"""
+  def __init__(self, items):
+    self.items = items
+    self.by = dict((field, {}) for field in indexed)
+    for position, item in enumerate(items):
+      for field in indexed:
+        if item.get(field) is not None:
+          self.by[field].setdefault(index_key(field, item[field]), []).append(position)
+
+  def matching(self, field, values):
+    """Positions of the devices whose field has one of values. A hw_model
+    value with no exact match finds the models it is part of: 'as4610' finds
+    accton_as4610_54 and accton_as4610_30"""
+    index = self.by[field]
+    found = set()
+    for value in values:
+      value = index_key(field, value)
+      if value in index:
+        found.update(index[value])
+      elif field == 'hw_model':
+        for model, positions in index.items():
+          if value in model:
+            found.update(positions)
+    return found
+
+  def select(self, **filters):
+    """The devices matching every filter, in the server's order. A filter
+    is a value or a list of alternatives, e.g. state=['OS-INSTALL', 'CONFIG']"""
+    for field in filters:
+      if field not in indexed:
+        raise ValueError('{} is not indexed (indexed: {})'.format(field, ', '.join(indexed)))
+    candidates = []
+    for field, values in filters.items():
+      if values is None:
+        continue
+      if not isinstance(values, (list, tuple, set)):
+        values = [values]
+      candidates.append(self.matching(field, values))
+    if not candidates:
+      return list(self.items)
+    candidates.sort(key=len)
+    found = candidates[0]
+    for other in candidates[1:]:
+      if not found:
+        break
+      found = found & other
+    return [self.items[position] for position in sorted(found)]
+
+  def counts(self, field='state'):
+    """{value: number of devices} for an indexed field"""
+    return dict((value, len(positions)) for value, positions in self.by[field].items())
+
+  def __len__(self):
+    return len(self.items)
+
+class DeviceCache(object):
+  """The device list of one ZTP server. .outcome says how the last fetch()
+  got it: 'cached', 'not-modified' or 'fetched'"""
+  def __init__(self, path, ttl=ttl):
+    self.path = path
+    self.ttl = ttl
+    self.entry = None
+    self.index = None
+    self.outcome = None
+    if path is None:
+      return
+    try:
+      with open(path) as f:
+        self.entry = json.load(f)
+    except IOError:
+      pass
+    except ValueError:
+      # A damaged cache only costs one full transfer
+      pass
+
+  @property
+  def age(self):
+    """Seconds since the cached list was last checked with the server"""
+    if self.entry is None:
+      return None
+    return max(0.0, time.time() - self.entry['checked'])
+
+  def cached(self, url_base=None):
+    """The cached list as a DeviceIndex without asking the server, None if
+    there is none (for url_base)"""
+    if self.entry is None or (url_base and self.entry.get('server') != url_base):
+      return None
+    if self.index is None:
+      self.index = DeviceIndex(self.entry['items'])
+    return self.index
+
+  def fetch(self, transport, refresh=False):
+    """The server's devices as a DeviceIndex: the cached list if it was
+    checked within ttl seconds (unless refresh), revalidated with a
+    conditional GET otherwise"""
+    index = self.cached(transport.url_base)
+    if index is not None and not refresh and self.age < self.ttl:
+      self.outcome = 'cached'
+      return index
+    headers = {'Accept': 'application/json'}
+    if index is not None:
+      if self.entry.get('etag'):
+        headers['If-None-Match'] = self.entry['etag']
+      if self.entry.get('last_modified'):
+        headers['If-Modified-Since'] = self.entry['last_modified']
+    r1 = transport.request('GET', ztp_client.DEVICES_URL, headers=headers)
+    if r1.status == 304 and index is not None:
+      self.entry['checked'] = time.time()
+      self.outcome = 'not-modified'
+    elif r1.ok:
+      self.entry = dict(
+        server        = transport.url_base,
+        checked       = time.time(),
+        etag          = r1.headers.get('etag'),
+        last_modified = strong_last_modified(r1.headers),
+        items         = r1.data.get('items', []),
+      )
+      self.index = None
+      self.outcome = 'fetched'
+    else:
+      raise httplib.HTTPException('GET {}: {} {}'.format(ztp_client.DEVICES_URL, r1.status, r1.reason))
+    self.save()
+    return self.cached()
+
+  def save(self):
+    """Writes the cache back atomically"""
+    if self.path is None or self.entry is None:
+      return
+    import tempfile
+    directory = os.path.dirname(os.path.abspath(self.path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.ztp_devcache')
+    with os.fdopen(fd, 'w') as f:
+      json.dump(self.entry, f, separators=(',', ':'))
+    os.rename(tmp, self.path)
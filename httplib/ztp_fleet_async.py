@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+# asyncio fleet driver: pushes adds, status updates or deletes for a whole
+# inventory through a single event loop, so thousands of requests can be in
+# flight on one core. Unlike the other scripts this one needs Python 3
+# (asyncio), but it still only uses the standard library. It speaks just
+# enough HTTP/1.1 for the ZTP API and keeps the connections alive.
+import sys
+import json
+import time
+import argparse
+import asyncio
+from urllib.parse import urlencode
+
+import ztp_client
+import ztp_inventory
+
+# Defaults
+hostname    = ztp_client.hostname
+port        = ztp_client.port
+concurrency = 256
+timeout     = 10.0
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+buckets = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, float('inf')]
+
+class Histogram(object):
+  """Fixed-bucket latency histogram; percentiles are bucket upper bounds"""
+  def __init__(self):
+    self.counts = [0] * len(buckets)
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+
+  def add(self, seconds):
+    ms = seconds * 1000.0
+    for i, bound in enumerate(buckets):
+      if ms <= bound:
+        self.counts[i] += 1
+        break
+    self.count += 1
+    self.total += ms
+    self.max = max(self.max, ms)
+
+  def percentile(self, p):
+    wanted = self.count * p / 100.0
+    seen = 0
+    for bound, n in zip(buckets, self.counts):
+      seen += n
+      if n and seen >= wanted:
+        return min(bound, self.max)
+    return self.max
+
+  def render(self, name):
+    lines = ["{}: {} requests, mean {:.1f}ms, p50 <={:.0f}ms, p95 <={:.0f}ms, p99 <={:.0f}ms, max {:.1f}ms".format(
+      name, self.count, self.total / self.count if self.count else 0,
+      self.percentile(50), self.percentile(95), self.percentile(99), self.max)]
+    widest = max(self.counts) or 1
+    for bound, n in zip(buckets, self.counts):
+      if n:
+        lines.append("  <= {:>7} ms | {:<40} {}".format(bound, '#' * max(1, 40 * n // widest), n))
+    return '\n'.join(lines)
+
+class AsyncTransport(object):
+  """Keep-alive HTTP/1.1 connections to one ZTP server, shared by all tasks"""
+  def __init__(self, hostname, port, timeout):
+    self.hostname = hostname
+    self.port = int(port)
+    self.timeout = timeout
+    self.idle = []
+    self.opened = 0
+
+  async def connection(self):
+    while self.idle:
+      reader, writer = self.idle.pop()
+      if not reader.at_eof():
+        return reader, writer
+      writer.close()
+    self.opened += 1
+    return await asyncio.open_connection(self.hostname, self.port)
+
+  async def exchange(self, reader, writer, method, url, body):
+    head = "{} {} HTTP/1.1\r\nHost: {}:{}\r\nAccept: application/json\r\n".format(method, url, self.hostname, self.port)
+    if body is not None:
+      head += "Content-Type: application/json\r\nContent-Length: {}\r\n".format(len(body))
+    writer.write(head.encode('latin-1') + b"\r\n" + (body or b""))
+    status_line = await reader.readline()
+    if not status_line:
+      raise ConnectionError('connection closed by server')
+    version, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+    headers = {}
+    while True:
+      line = (await reader.readline()).decode('latin-1').rstrip('\r\n')
+      if not line:
+        break
+      name, _, value = line.partition(':')
+      headers[name.strip().lower()] = value.strip()
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+      data = b''
+      while True:
+        size = int((await reader.readline()).split(b';')[0], 16)
+        chunk = await reader.readexactly(size + 2)
+        if not size:
+          break
+        data += chunk[:-2]
+    elif 'content-length' in headers:
+      data = await reader.readexactly(int(headers['content-length']))
+    else:
+      data = await reader.read()
+    reusable = (headers.get('connection', '').lower() != 'close' and version != 'HTTP/1.0'
+                and ('content-length' in headers or 'transfer-encoding' in headers))
+    return ztp_client.Response(int(status), reason, data), reusable
+
+  async def request(self, method, url, body=None):
+    if body is not None:
+      body = body.encode('utf-8')
+    for attempt in [0, 1]:
+      reader, writer = await asyncio.wait_for(self.connection(), self.timeout)
+      try:
+        response, reusable = await asyncio.wait_for(self.exchange(reader, writer, method, url, body), self.timeout)
+      except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        # A kept-alive connection the server already dropped is retried once
+        writer.close()
+        if attempt:
+          raise
+        continue
+      except BaseException:
+        writer.close()
+        raise
+      if reusable:
+        self.idle.append((reader, writer))
+      else:
+        writer.close()
+      return response
+
+  def close(self):
+    for reader, writer in self.idle:
+      writer.close()
+    self.idle = []
+
+class FleetDriver(object):
+  def __init__(self, transport, concurrency):
+    self.transport = transport
+    self.slots = asyncio.Semaphore(concurrency)
+    self.histograms = {}
+    self.outcomes = {}
+    # Set to a list to collect the latency of every whole operation
+    self.op_latencies = None
+
+  async def timed(self, method, url, device_data=None):
+    started = time.time()
+    body = json.dumps(device_data) if device_data is not None else None
+    try:
+      return await self.transport.request(method, url, body)
+    finally:
+      self.histograms.setdefault(method, Histogram()).add(time.time() - started)
+
+  async def add(self, device):
+    r1 = await self.timed('POST', ztp_client.DEVICES_URL, device)
+    if not r1.ok:
+      return 'failed', 'HTTP {} {}'.format(r1.status, r1.reason)
+    if r1.message == "device already exists":
+      await self.delete(device)
+      device = dict(device, message="WARN: Device was alredy in ZTP DB. Deleted and re-added. ({}|{}|{}|{})".format(
+        device['ip_addr'], device['os_name'], device.get('serial_number'), time.time()))
+      r1 = await self.timed('POST', ztp_client.DEVICES_URL, device)
+      if r1.ok and r1.message == "device added":
+        return 'replaced', r1.message
+      return 'failed', r1.body
+    if r1.message == "device added":
+      return 'added', r1.message
+    return 'failed', r1.message
+
+  async def status(self, device):
+    device_data = dict((key, device.get(key, "")) for key in ['ip_addr', 'os_name', 'state', 'message'])
+    r1 = await self.timed('PUT', ztp_client.STATUS_URL, device_data)
+    if r1.ok and r1.data['ok']:
+      return 'updated', r1.message
+    return 'failed', 'HTTP {} {}: {}'.format(r1.status, r1.reason, r1.body)
+
+  async def delete(self, device):
+    r1 = await self.timed('DELETE', '{}?{}'.format(ztp_client.DEVICES_URL, urlencode({'ip_addr': device['ip_addr']})))
+    if r1.ok:
+      return 'deleted', r1.message
+    return 'failed', 'HTTP {} {}'.format(r1.status, r1.reason)
+
+  async def one(self, operation, lineno, device, verbose):
+    started = time.time()
+    try:
+      outcome, detail = await operation(device)
+    except asyncio.TimeoutError:
+      outcome, detail = 'timeout', 'no answer within {}s'.format(self.transport.timeout)
+    except Exception as e:
+      # Connection errors, bad JSON and anything else (a KeyError from an odd
+      # answer, say) fail this row, not the whole run
+      outcome, detail = 'failed', '{}: {}'.format(type(e).__name__, e)
+    finally:
+      self.slots.release()
+      if self.op_latencies is not None:
+        self.op_latencies.append(time.time() - started)
+    self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+    if verbose or outcome in ('failed', 'timeout'):
+      print("line {}: {} {} {} {}".format(lineno, device['ip_addr'], device['os_name'], outcome, detail))
+
+  async def run(self, operation, devices, verbose=False):
+    tasks = set()
+    for lineno, device in devices:
+      # Waiting for a slot before creating the task keeps the number of
+      # pending tasks, and so memory, bounded by the concurrency cap
+      await self.slots.acquire()
+      task = asyncio.ensure_future(self.one(operation, lineno, device, verbose))
+      tasks.add(task)
+      task.add_done_callback(tasks.discard)
+    if tasks:
+      await asyncio.wait(tasks)
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('operation', help='What to do for every inventory row', choices=['add', 'status', 'delete'])
+  parser.add_argument('inventory', help='CSV or JSONL file with one device per row (columns: ip, os, sn, hw, message, state)')
+  parser.add_argument('--ztp_host', help='Remote host against which to run. Default: {}'.format(hostname))
+  parser.add_argument('--ztp_port', help='Remote host port against which to run. Default: {}'.format(port))
+  parser.add_argument('--concurrency', help='Maximum number of requests in flight. Default: {}'.format(concurrency), type=int, default=concurrency)
+  parser.add_argument('--timeout', help='Per-request timeout in seconds. Default: {}'.format(timeout), type=float, default=timeout)
+  parser.add_argument('--verbose', help='Print every result, not just the failures', action='store_true')
+  args = parser.parse_args(argv)
+
+  def report(lineno, error):
+    print("ERROR: {} line {}: {}".format(args.inventory, lineno, error))
+  rows, errors = ztp_inventory.validate_inventory(args.inventory, report)
+  if errors:
+    print("{} of {} inventory rows are invalid. Nothing was sent.".format(errors, rows + errors))
+    return 1
+
+  loop = asyncio.new_event_loop()
+  asyncio.set_event_loop(loop)
+  transport = AsyncTransport(args.ztp_host or hostname, args.ztp_port or port, args.timeout)
+  driver = FleetDriver(transport, max(1, args.concurrency))
+  operation = getattr(driver, args.operation)
+
+  start = time.time()
+  try:
+    loop.run_until_complete(driver.run(operation, ztp_inventory.devices(args.inventory), args.verbose))
+  finally:
+    transport.close()
+    loop.close()
+  elapsed = time.time() - start
+
+  print("Summary: {} {} operations in {:.2f}s ({:.1f} devices/s) over {} connection(s)".format(
+    rows, args.operation, elapsed, rows / elapsed if elapsed else 0, transport.opened))
+  for outcome in sorted(driver.outcomes):
+    print("|-> {}: {}".format(outcome, driver.outcomes[outcome]))
+  for method in sorted(driver.histograms):
+    print(driver.histograms[method].render(method))
+  return 1 if driver.outcomes.get('failed') or driver.outcomes.get('timeout') else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
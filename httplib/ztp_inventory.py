@@ -0,0 +1,97 @@
+"""
+Streaming reader for device inventory files.
+
+An inventory is either a CSV file with a header row or a JSONL file with
+one JSON object per line. Columns may use the short names (ip, os, sn, hw,
+message, state) or the ZTP API field names (ip_addr, os_name,
+serial_number, hw_model, os_version, message, state). Rows are yielded one
+at a time, so the size of the file does not matter.
+"""
+import csv
+import json
+import sys
+
+import ztp_client
+
+columns = {
+  'ip': 'ip_addr', 'ip_addr': 'ip_addr',
+  'os': 'os_name', 'os_name': 'os_name',
+  'sn': 'serial_number', 'serial_number': 'serial_number',
+  'hw': 'hw_model', 'hw_model': 'hw_model',
+  'os_version': 'os_version',
+  'message': 'message',
+  'state': 'state', 'status': 'state',
+}
+
+def read_inventory(path):
+  """Yields (line number, raw row dict) for every device in a CSV or JSONL inventory"""
+  mode = 'rb' if sys.version_info[0] == 2 else 'r'
+  with open(path, mode) as f:
+    first = f.readline()
+    f.seek(0)
+    if first.lstrip().startswith('{'):
+      for lineno, line in enumerate(f, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+          continue
+        yield lineno, json.loads(line)
+    else:
+      reader = csv.DictReader(f)
+      for row in reader:
+        yield reader.line_num, row
+
+def inventory_device(row):
+  """Maps an inventory row onto a device_data dict. Raises ValueError if the row is unusable"""
+  device = {}
+  for column, value in row.items():
+    if column is None:
+      raise ValueError('too many fields')
+    key = columns.get(column.strip().lower())
+    if key and value not in (None, ''):
+      device[key] = value.strip() if hasattr(value, 'strip') else value
+  for key in ['ip_addr', 'os_name', 'state']:
+    if key not in device:
+      raise ValueError('missing {}'.format(key))
+  if not ztp_client.valid_status(device['state']):
+    raise ValueError('{} is not a valid ZTP status'.format(device['state']))
+  device.setdefault('hw_model', 'N/A')
+  device.setdefault('os_version', ztp_client.os_version)
+  device.setdefault('message', 'Intial device add')
+  return device
+
+def validate_inventory(path, report):
+  """Checks every inventory row without sending anything. Each bad row is
+  passed to report(lineno, error). A device the ZTP server knows by the same
+  (ip_addr, os_name) as an earlier row is bad too: both would be sent at once
+  and race each other. Returns (good rows, bad rows)"""
+  rows = 0
+  errors = 0
+  # (ip_addr, os_name) -> line number of its first row
+  seen = {}
+  rowsource = read_inventory(path)
+  while True:
+    try:
+      lineno, row = next(rowsource)
+    except StopIteration:
+      break
+    except ValueError as e:
+      # A JSONL line that doesn't parse; the generator can't resume after it
+      report(rows + errors + 1, e)
+      errors += 1
+      break
+    try:
+      device = inventory_device(row)
+      key = (device['ip_addr'], device['os_name'])
+      if key in seen:
+        raise ValueError('{} {} is in the inventory more than once, first on line {}'.format(key[0], key[1], seen[key]))
+      seen[key] = lineno
+      rows += 1
+    except ValueError as e:
+      report(lineno, e)
+      errors += 1
+  return rows, errors
+
+def devices(path):
+  """Yields (line number, device_data) for an inventory that already passed validate_inventory"""
+  for lineno, row in read_inventory(path):
+    yield lineno, inventory_device(row)
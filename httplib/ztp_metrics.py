@@ -0,0 +1,187 @@
+"""
+Per-request timings of the ZTP API calls, and where to put them.
+
+The transports in ztp_client fill in one Timing per request:
+
+  connect  TCP connect, when the request needed a new connection
+  write    sending the request line, headers and body
+  ttfb     waiting for the status line and headers (time to first byte)
+  read     reading the body
+  decode   parsing the JSON body (filled in when Response.data is first used)
+  total    all of the above, retries included
+  retries  how many times the request was re-sent on a fresh connection
+
+A Recorder collects them and writes them out either as JSONL, one event per
+request:
+
+  {"event": "ztp_request", "method": "POST", "path": "/api/devices",
+   "status": 201, "connect": 0.0004, "write": 0.0001, ..., "retries": 0}
+
+or, for a path ending in .prom, as a Prometheus textfile-collector file with
+per-phase sums and counts and a histogram of the total. The textfile is
+rewritten atomically on close(); give each script its own file.
+
+Events are formatted when they are written, not when they are recorded, so
+recording costs next to nothing on the request path. Times are in seconds.
+"""
+import os
+import json
+import time
+import threading
+
+# Defaults
+flush_every = 1000
+buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+phases = ['connect', 'write', 'ttfb', 'read', 'decode']
+
+class Timing(object):
+  """The phases of one request. Unmeasured phases stay None"""
+  def __init__(self, method, url):
+    self.method = method
+    self.path = url.split('?', 1)[0]
+    self.started = time.time()
+    self.connect = None
+    self.write = None
+    self.ttfb = None
+    self.read = None
+    self.decode = None
+    self.elapsed = None
+    self.retries = 0
+    self.status = None
+    self.error = None
+
+  def add(self, phase, seconds):
+    setattr(self, phase, (getattr(self, phase) or 0) + seconds)
+
+  def done(self, status=None, error=None):
+    self.elapsed = time.time() - self.started
+    self.status = status
+    self.error = error
+
+  @property
+  def total(self):
+    """Wall clock time of the request plus the JSON decode, if it happened"""
+    return (self.elapsed or 0) + (self.decode or 0)
+
+  def event(self):
+    event = dict(
+      event   = 'ztp_request',
+      ts      = round(self.started, 6),
+      method  = self.method,
+      path    = self.path,
+      status  = self.status,
+      total   = round(self.total, 6),
+      retries = self.retries,
+    )
+    for phase in phases:
+      value = getattr(self, phase)
+      event[phase] = None if value is None else round(value, 6)
+    if self.error:
+      event['error'] = self.error
+    return event
+
+class Recorder(object):
+  """Collects Timings from any number of threads. path ending in .prom
+  selects the Prometheus textfile format, anything else JSONL"""
+  def __init__(self, path, flush_every=flush_every):
+    self.path = path
+    self.prometheus = path.endswith('.prom')
+    self.flush_every = flush_every
+    self.lock = threading.Lock()
+    self.pending = []
+    # Prometheus: (method, path) -> aggregated counters
+    self.series = {}
+
+  def record(self, timing):
+    with self.lock:
+      self.pending.append(timing)
+      full = len(self.pending) >= self.flush_every
+    if full:
+      self.flush()
+
+  def flush(self):
+    with self.lock:
+      pending, self.pending = self.pending, []
+      if self.prometheus:
+        for timing in pending:
+          self.aggregate(timing)
+      elif pending:
+        with open(self.path, 'a') as f:
+          for timing in pending:
+            f.write(json.dumps(timing.event(), sort_keys=True, separators=(',', ':')) + '\n')
+
+  def aggregate(self, timing):
+    series = self.series.setdefault((timing.method, timing.path), dict(
+      requests = {},
+      retries  = 0,
+      phases   = dict((phase, [0.0, 0]) for phase in phases),
+      buckets  = [0] * len(buckets),
+      total    = [0.0, 0],
+    ))
+    status = '{}'.format(timing.status) if timing.status else 'error'
+    series['requests'][status] = series['requests'].get(status, 0) + 1
+    series['retries'] += timing.retries
+    for phase in phases:
+      value = getattr(timing, phase)
+      if value is not None:
+        series['phases'][phase][0] += value
+        series['phases'][phase][1] += 1
+    total = timing.total
+    series['total'][0] += total
+    series['total'][1] += 1
+    for i, bound in enumerate(buckets):
+      if total <= bound:
+        series['buckets'][i] += 1
+
+  def prometheus_text(self):
+    lines = [
+      '# HELP ztp_client_requests_total ZTP API requests by response status',
+      '# TYPE ztp_client_requests_total counter',
+    ]
+    ordered = sorted(self.series.items())
+    for (method, path), series in ordered:
+      for status, count in sorted(series['requests'].items()):
+        lines.append('ztp_client_requests_total{{method="{}",path="{}",status="{}"}} {}'.format(method, path, status, count))
+    lines += [
+      '# HELP ztp_client_request_retries_total ZTP API requests re-sent on a fresh connection',
+      '# TYPE ztp_client_request_retries_total counter',
+    ]
+    for (method, path), series in ordered:
+      lines.append('ztp_client_request_retries_total{{method="{}",path="{}"}} {}'.format(method, path, series['retries']))
+    lines += [
+      '# HELP ztp_client_request_phase_seconds Time spent in each phase of ZTP API requests',
+      '# TYPE ztp_client_request_phase_seconds summary',
+    ]
+    for (method, path), series in ordered:
+      for phase in phases:
+        total, count = series['phases'][phase]
+        labels = 'method="{}",path="{}",phase="{}"'.format(method, path, phase)
+        lines.append('ztp_client_request_phase_seconds_sum{{{}}} {:.6f}'.format(labels, total))
+        lines.append('ztp_client_request_phase_seconds_count{{{}}} {}'.format(labels, count))
+    lines += [
+      '# HELP ztp_client_request_duration_seconds Total time of ZTP API requests, retries and JSON decode included',
+      '# TYPE ztp_client_request_duration_seconds histogram',
+    ]
+    for (method, path), series in ordered:
+      labels = 'method="{}",path="{}"'.format(method, path)
+      for bound, count in zip(buckets, series['buckets']):
+        lines.append('ztp_client_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(labels, bound, count))
+      lines.append('ztp_client_request_duration_seconds_bucket{{{},le="+Inf"}} {}'.format(labels, series['total'][1]))
+      lines.append('ztp_client_request_duration_seconds_sum{{{}}} {:.6f}'.format(labels, series['total'][0]))
+      lines.append('ztp_client_request_duration_seconds_count{{{}}} {}'.format(labels, series['total'][1]))
+    lines += [
+      '# HELP ztp_client_last_run_timestamp_seconds When these metrics were written',
+      '# TYPE ztp_client_last_run_timestamp_seconds gauge',
+      'ztp_client_last_run_timestamp_seconds {:.3f}'.format(time.time()),
+    ]
+    return '\n'.join(lines) + '\n'
+
+  def close(self):
+    self.flush()
+    if self.prometheus:
+      # The collector may read the file at any time; never let it see half of it
+      tmp = '{}.tmp'.format(self.path)
+      with open(tmp, 'w') as f:
+        f.write(self.prometheus_text())
+      os.rename(tmp, self.path)
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+# Where does provisioning time go? Reads ztp_transitions logs (from the
+# switches' /mnt/onl/data/ztp/transitions.jsonl and/or an ops host's
+# ztp_set_device_status_httplib.py --transitions file), splits them into
+# provisioning runs per device and reports, per status, how long devices
+# stayed in it: p50/p95/p99/max across the fleet and its share of the total
+# time-to-DONE. The stays furthest beyond their phase's p95 are listed as
+# outliers.
+import sys
+import json
+import glob
+import argparse
+
+import ztp_client
+import ztp_transitions
+
+# Defaults
+outliers = 10
+
+def percentile(ordered, p):
+  if not ordered:
+    return 0.0
+  return ordered[int(round(p / 100.0 * (len(ordered) - 1)))]
+
+def human(seconds):
+  if seconds < 60:
+    return '{:.1f}s'.format(seconds)
+  if seconds < 3600:
+    return '{}m{:02d}s'.format(int(seconds // 60), int(seconds % 60))
+  return '{}h{:02d}m'.format(int(seconds // 3600), int(seconds % 3600 // 60))
+
+def summary(samples):
+  ordered = sorted(seconds for seconds, device in samples)
+  return dict(
+    count = len(ordered),
+    p50   = percentile(ordered, 50),
+    p95   = percentile(ordered, 95),
+    p99   = percentile(ordered, 99),
+    max   = ordered[-1] if ordered else 0.0,
+  )
+
+def report(events, top=outliers):
+  runs = ztp_transitions.runs(events)
+  phases, to_done, done_share = ztp_transitions.phase_durations(runs)
+  total_to_done = sum(seconds for seconds, device in to_done)
+  order = dict((state, i) for i, state in enumerate(ztp_client.lifecycle + ['FAILED']))
+  result = dict(
+    devices      = len(set(device for device, run in runs)),
+    runs         = len(runs),
+    done         = len(to_done),
+    phases       = [],
+    outliers     = [],
+    time_to_done = summary(to_done),
+  )
+  slow = []
+  for state in sorted(phases, key=lambda state: order.get(state, len(order))):
+    phase = dict(summary(phases[state]), state=state)
+    phase['share_of_time_to_done'] = done_share.get(state, 0) / total_to_done if total_to_done else 0.0
+    result['phases'].append(phase)
+    for seconds, device in phases[state]:
+      if seconds > phase['p95']:
+        slow.append((seconds / phase['p95'] if phase['p95'] else seconds, seconds, state, device, phase['p95']))
+  # Ranked by how far beyond its own phase's p95 a stay is, so a stuck CONFIG
+  # isn't hidden behind ordinary long OS-INSTALLs
+  slow.sort(reverse=True)
+  for ratio, seconds, state, device, p95 in slow[:top]:
+    result['outliers'].append(dict(state=state, ip_addr=device[0], os_name=device[1], seconds=seconds, p95=p95))
+  return result
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('logs', help='ztp_transitions JSONL files (shell patterns are expanded)', nargs='+')
+  parser.add_argument('--outliers', help='How many of the stays furthest beyond their phase p95 to list. Default: {}'.format(outliers), type=int, default=outliers)
+  parser.add_argument('--output', help='Write the report to this JSON file')
+  args = parser.parse_args(argv)
+
+  events = []
+  for pattern in args.logs:
+    for path in sorted(glob.glob(pattern)) or [pattern]:
+      try:
+        with open(path) as f:
+          events += ztp_transitions.read_events(f)
+      except IOError as e:
+        print "ERROR: Can't read {}: {}".format(path, e)
+        return 1
+
+  result = report(events, args.outliers)
+  print "Devices: {devices}, provisioning runs: {runs}, reached DONE: {done}".format(**result)
+  print "{:<20} {:>6} {:>9} {:>9} {:>9} {:>9} {:>14}".format('status', 'count', 'p50', 'p95', 'p99', 'max', 'time-to-DONE')
+  for phase in result['phases']:
+    print "{:<20} {:>6} {:>9} {:>9} {:>9} {:>9} {:>13.1f}%".format(phase['state'], phase['count'],
+      human(phase['p50']), human(phase['p95']), human(phase['p99']), human(phase['max']), 100 * phase['share_of_time_to_done'])
+  t = result['time_to_done']
+  print "{:<20} {:>6} {:>9} {:>9} {:>9} {:>9}".format('time-to-DONE', t['count'], human(t['p50']), human(t['p95']), human(t['p99']), human(t['max']))
+  if result['outliers']:
+    print "Furthest beyond their phase p95:"
+    for outlier in result['outliers']:
+      print "|-> {ip_addr} {os_name}: {state} took {}, p95 {}".format(human(outlier['seconds']), human(outlier['p95']), **outlier)
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(result, f, sort_keys=True, indent=2)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
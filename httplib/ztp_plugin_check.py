@@ -0,0 +1,70 @@
+#!/usr/bin/python
+
+# The ONL installer loads each plugin as a single file, so the code both
+# plugins need (BudgetedConnection, FlightRecorder, ring_nodes(), the ZTP
+# candidates and Retry-After parsing, start_delay(), record_transition(), the
+# ramdisk and ONL-DATA paths) is in onl_preinstall.py and onl_postinstall.py
+# alike, between their "# BEGIN shared plugin code" and "# END shared plugin
+# code" lines. This keeps the two copies from drifting apart:
+#
+#   ztp_plugin_check.py            exit 1 with a diff if the blocks differ
+#   ztp_plugin_check.py --write    copy the block of onl_preinstall.py over
+#                                  the one of onl_postinstall.py
+#
+# Edit the shared code in onl_preinstall.py, then run --write. Run the plain
+# check before packaging the plugins.
+import os
+import sys
+import difflib
+import argparse
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# Defaults
+source = os.path.join(here, 'onl_preinstall.py')
+copies = [os.path.join(here, 'onl_postinstall.py')]
+
+begin = '# BEGIN shared plugin code'
+end = '# END shared plugin code'
+
+def split(path):
+  """(lines before the shared block, the block from its BEGIN line to its END
+  line, lines after it). Raises ValueError without exactly one block"""
+  with open(path) as f:
+    lines = f.readlines()
+  starts = [i for i, line in enumerate(lines) if line.startswith(begin)]
+  ends = [i for i, line in enumerate(lines) if line.startswith(end)]
+  if len(starts) != 1 or len(ends) != 1 or ends[0] < starts[0]:
+    raise ValueError('{} needs one "{}" line followed by one "{}" line'.format(path, begin, end))
+  return lines[:starts[0]], lines[starts[0]:ends[0] + 1], lines[ends[0] + 1:]
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--write', help='Copy the shared block of {} into the other plugins instead of checking them'.format(os.path.basename(source)), action='store_true')
+  args = parser.parse_args(argv)
+
+  try:
+    _, shared, _ = split(source)
+    drifted = 0
+    for path in copies:
+      before, block, after = split(path)
+      if block == shared:
+        continue
+      if args.write:
+        with open(path, 'w') as f:
+          f.writelines(before + shared + after)
+        print "Updated the shared block of {}".format(path)
+        continue
+      drifted += 1
+      sys.stdout.writelines(difflib.unified_diff(shared, block, source, path))
+  except (IOError, ValueError) as e:
+    print "ERROR: {}".format(e)
+    return 1
+  if drifted:
+    print "ERROR: the shared plugin code differs in {} file(s). Edit it in {} and run {} --write".format(
+      drifted, os.path.basename(source), os.path.basename(sys.argv[0]))
+    return 1
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
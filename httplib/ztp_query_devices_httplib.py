@@ -0,0 +1,100 @@
+#!/usr/bin/python
+
+# Answers questions about the devices the ZTP server knows from a local copy
+# of its device list (see ztp_devcache.py) instead of every tool pulling the
+# whole list itself:
+#
+#   ztp_query_devices_httplib.py --device_status AWAIT-SYSTEM-READY --device_hw as4610
+#   ztp_query_devices_httplib.py --count
+#
+# The list is kept in --cache. Within --cache_ttl seconds of the last check it
+# is used without asking the server; after that it is revalidated with a
+# conditional GET, which costs a 304 while nothing has changed. Filters select
+# on indexes by IP, serial, hardware model (or a part of it) and state; each
+# takes a comma separated list of alternatives. If the server can't be reached
+# the cached list is used, with a warning saying how old it is.
+import sys
+import json
+import socket
+import httplib
+import argparse
+
+import ztp_client
+import ztp_codec
+import ztp_devcache
+
+# Defaults
+hostname = ztp_client.hostname
+port = ztp_client.port
+outputs = ['text', 'jsonl']
+
+def split(value):
+  return [part.strip() for part in value.split(',') if part.strip()] if value else None
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--ztp_host', help='Remote host against which to run. Default: {}'.format(hostname))
+  parser.add_argument('--ztp_port', help='Remote host port against which to run. Default: {}'.format(port))
+  parser.add_argument('--ssl', help='Should the connection be treated as an SSL/TLS protected connection', action='store_true')
+  parser.add_argument('--verify', help='With --ssl: check the server certificate against the system CAs', action='store_true')
+  parser.add_argument('--ca_file', help='With --ssl: check the server certificate against the CAs in this PEM file')
+  parser.add_argument('--wire', help='Body format to negotiate with the ZTP server: msgpack or cbor if their library is installed and the server answers in it, JSON otherwise. Default: json', choices=ztp_codec.names, default='json')
+  parser.add_argument('--device_ip', help='Comma separated device IPs to select')
+  parser.add_argument('--device_sn', help='Comma separated device serial numbers to select')
+  parser.add_argument('--device_hw', help='Comma separated hardware models to select; a part of a model name selects every model it is in')
+  parser.add_argument('--device_status', help='Comma separated states to select. Valid states/statuses are: {}'.format(ztp_client.statuses))
+  parser.add_argument('--count', help='Print the number of selected devices per state instead of the devices', action='store_true')
+  parser.add_argument('--cache', help='Device list cache file. Default: {}'.format(ztp_devcache.path.format(server='<host>_<port>')))
+  parser.add_argument('--cache_ttl', help='Seconds the cached list is used without revalidating it with the server. Default: {}'.format(ztp_devcache.ttl), type=int, default=ztp_devcache.ttl)
+  parser.add_argument('--refresh', help='Revalidate the cached list now, whatever its age', action='store_true')
+  parser.add_argument('--output', help='text: a table. jsonl: one compact JSON line per device (or state with --count) for pipelines. Default: text', choices=outputs, default='text')
+  args = parser.parse_args(argv)
+
+  ztp_host = args.ztp_host or hostname
+  ztp_port = args.ztp_port or port
+  transport = ztp_client.get_transport(ztp_host, ztp_port, ssl=args.ssl, verify=args.verify, ca_file=args.ca_file)
+  if args.wire != 'json':
+    try:
+      transport.wire = ztp_codec.get(args.wire)
+    except ImportError as e:
+      print >>sys.stderr, "WARN: Can't use {}, talking JSON: {}".format(args.wire, e)
+
+  out = sys.stderr if args.output == 'jsonl' else sys.stdout
+  cache = ztp_devcache.DeviceCache(args.cache or ztp_devcache.path.format(server=transport.url_base.replace(':', '_')), args.cache_ttl)
+  try:
+    index = cache.fetch(transport, args.refresh)
+  except ValueError as e:
+    print "ERROR: Can't parse the device list from '{}': {}".format(transport.url_base, e)
+    return 1
+  except (socket.error, httplib.HTTPException) as e:
+    index = cache.cached(transport.url_base)
+    if index is None:
+      print "ERROR: Can't get the device list from '{}': {}".format(transport.url_base, e)
+      return 1
+    print >>out, "WARN: Can't get the device list from '{}', using the one cached {:.0f}s ago: {}".format(transport.url_base, cache.age, e)
+  except (IOError, OSError) as e:
+    # The list itself was fetched
+    index = cache.cached()
+    print >>out, "WARN: Can't write the device list cache: {}".format(e)
+
+  selected = index.select(ip_addr=split(args.device_ip), serial_number=split(args.device_sn),
+                          hw_model=split(args.device_hw), state=split(args.device_status))
+  if args.count:
+    counts = ztp_devcache.DeviceIndex(selected).counts('state')
+    for state in sorted(counts, key=ztp_devcache.state_order):
+      if args.output == 'jsonl':
+        print json.dumps(dict(state=state, count=counts[state]), sort_keys=True, separators=(',', ':'))
+      else:
+        print "{:<20} {:>7}".format(state, counts[state])
+  elif args.output == 'jsonl':
+    for device in selected:
+      print json.dumps(device, sort_keys=True, separators=(',', ':'))
+  else:
+    print "{:<16} {:<6} {:<16} {:<24} {:<20} {}".format('IP', 'OS', 'SERIAL', 'HW MODEL', 'STATE', 'MESSAGE')
+    for device in selected:
+      print "{:<16} {:<6} {:<16} {:<24} {:<20} {}".format(*[device.get(field) or '' for field in ['ip_addr', 'os_name', 'serial_number', 'hw_model', 'state', 'message']])
+  print >>out, "{} of {} devices. List: {} ({}).".format(len(selected), len(index), cache.outcome or 'stale', transport.url_base)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,90 @@
+"""
+On-disk cache of the device registrations this host has made successfully.
+
+The ZTP server identifies a device by (ip_addr, os_name). For each of those
+the cache remembers the serial_number, hw_model, os_version and state that
+were last registered, and when. ztp_client.add_device() uses it to
+
+- skip the network entirely when the same record was registered within the
+  TTL, and
+- go straight to DELETE + POST when the record changed, instead of POSTing
+  first only to be told "device already exists".
+
+Entries expire after ttl seconds; beyond size entries the least recently
+registered ones are dropped. The file is JSON and is rewritten atomically by
+save(). If the ZTP server loses its database, expire the cache (or delete
+the file), otherwise unchanged devices are not re-registered until the TTL
+runs out.
+"""
+import os
+import json
+import time
+import threading
+
+# Defaults
+ttl  = 24 * 3600
+size = 100000
+
+fields = ['serial_number', 'hw_model', 'os_version', 'state']
+
+class RegistrationCache(object):
+  def __init__(self, path, ttl=ttl, size=size):
+    self.path = path
+    self.ttl = ttl
+    self.size = size
+    self.lock = threading.Lock()
+    self.dirty = False
+    self.entries = {}
+    try:
+      with open(path) as f:
+        self.entries = json.load(f)
+    except IOError:
+      pass
+    except ValueError:
+      # A damaged cache only costs us some round trips; start over
+      self.dirty = True
+
+  @staticmethod
+  def key(device_data):
+    return '{}|{}'.format(device_data['ip_addr'], device_data['os_name'])
+
+  def lookup(self, device_data):
+    """Returns 'fresh' if this exact record is registered and unexpired,
+    'changed' if a different record is registered under the same
+    (ip_addr, os_name), and None if nothing usable is known"""
+    with self.lock:
+      entry = self.entries.get(self.key(device_data))
+    if entry is None or entry['registered'] + self.ttl < time.time():
+      return None
+    if all(entry.get(field) == device_data.get(field) for field in fields):
+      return 'fresh'
+    return 'changed'
+
+  def remember(self, device_data):
+    entry = dict((field, device_data.get(field)) for field in fields)
+    entry['registered'] = time.time()
+    with self.lock:
+      self.entries[self.key(device_data)] = entry
+      self.dirty = True
+
+  def forget(self, device_data):
+    with self.lock:
+      if self.entries.pop(self.key(device_data), None) is not None:
+        self.dirty = True
+
+  def save(self):
+    """Drops expired and excess entries and writes the cache back if it changed"""
+    with self.lock:
+      if not self.dirty:
+        return
+      cutoff = time.time() - self.ttl
+      live = [(entry['registered'], key) for key, entry in self.entries.items() if entry['registered'] >= cutoff]
+      live.sort(reverse=True)
+      self.entries = dict((key, self.entries[key]) for registered, key in live[:self.size])
+      import tempfile
+      directory = os.path.dirname(os.path.abspath(self.path))
+      fd, tmp = tempfile.mkstemp(dir=directory, prefix='.ztp_regcache')
+      with os.fdopen(fd, 'w') as f:
+        json.dump(self.entries, f, separators=(',', ':'))
+      os.rename(tmp, self.path)
+      self.dirty = False
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+
+# Drains a ztp_spool journal: the adds and statuses the other scripts and the
+# ONL plugins could not deliver while the ZTP server was unreachable. The
+# journal is compacted to the latest state per device first and then replayed
+# in order over one keep-alive connection (one per server with --ztp_servers).
+# Whatever still can't be delivered stays in the journal for the next run.
+#
+# On an installed ONL switch the postinstall plugin's journal lives at
+# /mnt/onl/data/ztp/journal.jsonl.
+import sys
+import argparse
+import httplib
+import socket
+from httplib import HTTPConnection
+
+import ztp_client
+import ztp_metrics
+import ztp_spool
+
+# Defaults
+hostname = ztp_client.hostname
+port = ztp_client.port
+shard_keys = ['ip', 'serial']
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--dry-run', help="Compacts the journal and prints what would be sent, but doesn't send anything.", action='store_true')
+  parser.add_argument('--ztp_host', help='Remote host against which to run. Default: {}'.format(hostname))
+  parser.add_argument('--ztp_port', help='Remote host port against which to run. Default: {}'.format(port))
+  parser.add_argument('--ssl', help='Should the connection be treated as an SSL/TLS protected connection', action='store_true')
+  parser.add_argument('--verify', help='With --ssl: check the server certificate against the system CAs', action='store_true')
+  parser.add_argument('--ca_file', help='With --ssl: check the server certificate against the CAs in this PEM file')
+  parser.add_argument('--ztp_servers', help='Comma separated host[:port] list of ZTP servers devices are sharded over (consistent hashing, failing over to the next server). Replaces --ztp_host')
+  parser.add_argument('--shard_key', help='What devices are sharded on with --ztp_servers. Default: ip', choices=shard_keys, default='ip')
+  parser.add_argument('--spool', help='Journal to replay. Default: {}'.format(ztp_spool.path), default=ztp_spool.path)
+  parser.add_argument('--metrics', help='Record the connect/write/ttfb/read/decode timings of every request to this file: a Prometheus textfile-collector file if it ends in .prom, JSONL events otherwise')
+  parser.add_argument('--trace', help='Append every request (method, URL, body, status, time) to this file for ztp_replay_trace.py')
+  parser.add_argument('--verbose', help='Make things chatty. Note: May display sensitive data like password', action='store_true')
+  args = parser.parse_args(argv)
+
+  ztp_host = args.ztp_host or hostname
+  ztp_port = args.ztp_port or port
+
+  try:
+    before, after = ztp_spool.compact(args.spool)
+  except IOError as e:
+    print "ERROR: Can't open journal {}: {}".format(args.spool, e)
+    return 1
+  print "Journal {}: {} event(s), {} after compaction".format(args.spool, before, after)
+
+  if args.dry_run:
+    with open(args.spool) as f:
+      for event in ztp_spool.read_events(f):
+        print "DRY-RUN: {} {}".format(event['kind'], event['device'])
+    return 0
+
+  tls = dict(ssl=args.ssl, verify=args.verify, ca_file=args.ca_file)
+  if args.ztp_servers:
+    import ztp_shards
+    transport = ztp_shards.ShardedTransport(ztp_shards.parse_servers(args.ztp_servers, ztp_port), args.shard_key, size=1, **tls)
+  else:
+    transport = ztp_client.get_transport(ztp_host, ztp_port, size=1, **tls)
+  if args.verbose:
+    import logging
+    logging.basicConfig(level=logging.DEBUG)
+    transport.debuglevel = 11
+    HTTPConnection.debuglevel = 1
+
+  def report(event, ok):
+    if args.verbose or not ok:
+      print "{} {} {} {}".format('sent' if ok else 'REJECTED', event['kind'], event['device']['ip_addr'], event['device']['os_name'])
+
+  if args.metrics:
+    transport.recorder = ztp_metrics.Recorder(args.metrics)
+  if args.trace:
+    import ztp_trace
+    transport.tracer = ztp_trace.Tracer(args.trace)
+  delivered, rejected, remaining = ztp_spool.replay(transport, args.spool, report)
+  transport.close()
+  if transport.recorder:
+    transport.recorder.close()
+  if transport.tracer:
+    transport.tracer.close()
+  if args.ssl:
+    print ztp_client.tls_summary(transport)
+  print "Delivered: {}, rejected by the server: {}, still spooled: {}".format(delivered, rejected, remaining)
+  if remaining:
+    print "ERROR: Could not reach '{}://{}'. Run again once it is back.".format('https' if args.ssl else 'http', transport.url_base)
+    return 1
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,197 @@
+#!/usr/bin/python
+
+# Re-issues the requests captured with --trace (see ztp_trace.py) against any
+# ZTP server, to reproduce the load of a real provisioning day:
+#
+#   ztp_replay_trace.py --speed 10 --ztp_host ztp-staging day1-*.jsonl
+#
+# Several traces (one per script run or switch) are merged by time. --speed 1
+# keeps the recorded gaps between requests, N plays them N times faster and 0
+# sends them as fast as --concurrency connections allow. The requests of one
+# device (by ip_addr) always go out one at a time and in the recorded order;
+# the others are spread over the connections.
+#
+# Afterwards the replay is compared with the recording per method and path:
+# requests, errors, and p50/p95/mean latency, each with its delta. How far
+# behind the schedule requests went out is reported too; a large lag means the
+# target (or --concurrency) could not keep up with the speed asked for.
+import sys
+import json
+import time
+import socket
+import httplib
+import argparse
+import threading
+import Queue
+
+import ztp_client
+import ztp_trace
+
+# Defaults
+hostname    = ztp_client.hostname
+port        = ztp_client.port
+speed       = 1.0
+concurrency = 16
+outputs     = ['text', 'jsonl']
+shard_keys  = ['ip', 'serial']
+
+def percentile(ordered, p):
+  if not ordered:
+    return 0.0
+  return ordered[int(round(p / 100.0 * (len(ordered) - 1)))]
+
+def failed(status, error=None):
+  return bool(error) or status is None or status >= 400
+
+def replay(transport, records, speed=speed, concurrency=concurrency):
+  """Sends records on schedule. Returns one (record, status, ms, error, lag)
+  per record, in the order they completed"""
+  lanes = [Queue.Queue() for _ in range(max(1, concurrency))]
+  results = []
+  lock = threading.Lock()
+
+  def worker(lane):
+    while True:
+      item = lane.get()
+      if item is None:
+        return
+      record, due = item
+      started = time.time()
+      status = error = None
+      headers = ztp_client.url_headers if record.get('body') is not None else {'Accept': 'application/json'}
+      try:
+        status = transport.request(record['method'], record['url'], record.get('body'), headers).status
+      except (socket.error, httplib.HTTPException) as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+      elapsed = 1000.0 * (time.time() - started)
+      with lock:
+        results.append((record, status, elapsed, error, max(0.0, started - due)))
+
+  threads = [threading.Thread(target=worker, args=(lane,)) for lane in lanes]
+  for t in threads:
+    t.daemon = True
+    t.start()
+  start = time.time()
+  first = records[0]['ts'] if records else 0
+  spare = 0
+  for record in records:
+    due = start + (record['ts'] - first) / speed if speed else time.time()
+    wait = due - time.time()
+    if wait > 0:
+      time.sleep(wait)
+    key = ztp_trace.device_key(record)
+    if key is None:
+      # Not about one device: any connection will do
+      spare += 1
+      lane = lanes[spare % len(lanes)]
+    else:
+      lane = lanes[hash(key) % len(lanes)]
+    lane.put((record, due))
+  for lane in lanes:
+    lane.put(None)
+  for t in threads:
+    t.join()
+  return results
+
+def compare(results):
+  """Per (method, path): the recorded and replayed counts, errors and latencies"""
+  groups = {}
+  for record, status, ms, error, lag in results:
+    key = (record['method'], record['url'].split('?', 1)[0])
+    group = groups.setdefault(key, dict(recorded=[], replayed=[], recorded_errors=0, replayed_errors=0, changed=0))
+    if record.get('ms') is not None:
+      group['recorded'].append(record['ms'])
+    group['replayed'].append(ms)
+    group['recorded_errors'] += failed(record.get('status'), record.get('error'))
+    group['replayed_errors'] += failed(status, error)
+    group['changed'] += status != record.get('status')
+  rows = []
+  for (method, path), group in sorted(groups.items()):
+    row = dict(method=method, path=path, requests=len(group['replayed']),
+               errors=group['recorded_errors'], replay_errors=group['replayed_errors'],
+               status_changed=group['changed'])
+    for name, samples in [('recorded', sorted(group['recorded'])), ('replayed', sorted(group['replayed']))]:
+      row[name] = dict(
+        p50  = round(percentile(samples, 50), 3),
+        p95  = round(percentile(samples, 95), 3),
+        mean = round(sum(samples) / len(samples), 3) if samples else 0.0,
+      )
+    rows.append(row)
+  return rows
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('trace', help='Trace file(s) written with --trace or by the ONL plugins', nargs='+')
+  parser.add_argument('--speed', help='1: the recorded pace, N: N times faster, 0: as fast as possible. Default: {}'.format(speed), type=float, default=speed)
+  parser.add_argument('--concurrency', help='Number of keep-alive connections/in-flight requests. Default: {}'.format(concurrency), type=int, default=concurrency)
+  parser.add_argument('--dry-run', help="Reads the traces and prints what would be replayed, but doesn't send anything.", action='store_true')
+  parser.add_argument('--ztp_host', help='Remote host against which to run. Default: {}'.format(hostname))
+  parser.add_argument('--ztp_port', help='Remote host port against which to run. Default: {}'.format(port))
+  parser.add_argument('--ztp_servers', help='Comma separated host[:port] list of ZTP servers devices are sharded over (consistent hashing, failing over to the next server). Replaces --ztp_host')
+  parser.add_argument('--shard_key', help='What devices are sharded on with --ztp_servers. Default: ip', choices=shard_keys, default='ip')
+  parser.add_argument('--ssl', help='Should the connection be treated as an SSL/TLS protected connection', action='store_true')
+  parser.add_argument('--verify', help='With --ssl: check the server certificate against the system CAs', action='store_true')
+  parser.add_argument('--ca_file', help='With --ssl: check the server certificate against the CAs in this PEM file')
+  parser.add_argument('--output', help='text: a comparison table. jsonl: one compact JSON line per method and path. Default: text', choices=outputs, default='text')
+  args = parser.parse_args(argv)
+
+  if args.speed < 0:
+    parser.error('--speed must not be negative')
+  try:
+    records = ztp_trace.read_trace(args.trace)
+  except IOError as e:
+    print "ERROR: Can't read trace: {}".format(e)
+    return 1
+  if not records:
+    print "ERROR: No requests in {}".format(', '.join(args.trace))
+    return 1
+  recorded = records[-1]['ts'] - records[0]['ts']
+  pace = '{:g}x'.format(args.speed) if args.speed else 'max'
+  out = sys.stderr if args.output == 'jsonl' else sys.stdout
+  print >>out, "Trace: {} request(s) over {:.1f}s from {} file(s), {} device(s). Speed: {}".format(
+    len(records), recorded, len(args.trace), len(set(ztp_trace.device_key(r) for r in records) - set([None])), pace)
+  if args.dry_run:
+    for record in records:
+      print "DRY-RUN: {:.3f} {} {}".format(record['ts'] - records[0]['ts'], record['method'], record['url'])
+    return 0
+
+  ztp_host = args.ztp_host or hostname
+  ztp_port = args.ztp_port or port
+  tls = dict(ssl=args.ssl, verify=args.verify, ca_file=args.ca_file)
+  size = max(1, args.concurrency)
+  if args.ztp_servers:
+    import ztp_shards
+    transport = ztp_shards.ShardedTransport(ztp_shards.parse_servers(args.ztp_servers, ztp_port), args.shard_key, size=size, **tls)
+  else:
+    transport = ztp_client.get_transport(ztp_host, ztp_port, size=size, **tls)
+
+  started = time.time()
+  results = replay(transport, records, args.speed, args.concurrency)
+  elapsed = time.time() - started
+  transport.close()
+  lags = sorted(1000.0 * lag for record, status, ms, error, lag in results)
+  rows = compare(results)
+
+  if args.output == 'jsonl':
+    for row in rows:
+      print json.dumps(row, sort_keys=True, separators=(',', ':'))
+  else:
+    print "{:<7} {:<20} {:>7} {:>15} {:>25} {:>25} {:>25}".format('METHOD', 'PATH', 'COUNT', 'ERRORS rec/rep', 'P50 ms rec/rep (delta)', 'P95 ms rec/rep (delta)', 'MEAN ms rec/rep (delta)')
+    for row in rows:
+      cells = []
+      for stat in ['p50', 'p95', 'mean']:
+        before, after = row['recorded'][stat], row['replayed'][stat]
+        cells.append('{:.1f}/{:.1f} ({:+.1f})'.format(before, after, after - before))
+      print "{:<7} {:<20} {:>7} {:>15} {:>25} {:>25} {:>25}".format(
+        row['method'], row['path'], row['requests'], '{}/{}'.format(row['errors'], row['replay_errors']), *cells)
+  print >>out, "Replayed {} request(s) in {:.2f}s over {} connection(s). Schedule lag: p50 {:.1f}ms, max {:.1f}ms".format(
+    len(results), elapsed, transport.opened, percentile(lags, 50), lags[-1] if lags else 0.0)
+  changed = sum(row['status_changed'] for row in rows)
+  if changed:
+    print >>out, "{} request(s) got a different status than recorded".format(changed)
+  if args.ssl:
+    print >>out, ztp_client.tls_summary(transport)
+  return 1 if sum(row['replay_errors'] for row in rows) > sum(row['errors'] for row in rows) else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
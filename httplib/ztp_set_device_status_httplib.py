@@ -1,125 +1,388 @@
 #!/usr/bin/python
 
 import sys
-import os
 import json
 import argparse
-import subprocess
-import logging
-import time
 import httplib
 import socket
+import threading
+import time
 from httplib import HTTPConnection
 
+import ztp_client
+import ztp_codec
+import ztp_metrics
+import ztp_spool
+import ztp_transitions
+from ztp_client import statuses
+
 # Defaults
-hostname = 'localhost'
-port = '8080'
+hostname = ztp_client.hostname
+port = ztp_client.port
 
-httpSuccessCodes = [200, 201, 202, 204]
 method = 'PUT'
-statuses = [
-	'START', 'DONE', 'CONFIG', 'AWAIT-ONLINE', 'AWAIT-SYSTEM-READY', 'OS-INSTALL', 'OS-REBOOTING', 'FAILED'
-]
-
-parser = argparse.ArgumentParser()
-parser.add_argument('status', help='AEON ZTP status. Valid options are: {}'.format(statuses))
-parser.add_argument('--dry-run', help="Does input validation, prints what would be done, but doesn't actually do anything.", action='store_true')
-parser.add_argument('--ztp_host', help='Remote host against which to run. Default: {}'.format(hostname))
-parser.add_argument('--ztp_port', help='Remote host port against which to run. Default: {}'.format(port))
-parser.add_argument('--ssl', help='Should the connection be treated as an SSL/TLS protected connection', action='store_true')
-parser.add_argument('--device_ip', help='The device IP for which to set the status', required=True)
-parser.add_argument('--device_os', help='The device OS', required=True)
-parser.add_argument('--device_message', help='Optional message to be included')
-parser.add_argument('--verbose', help='Make things chatty. Note: May display sensitive data like password', action='store_true')
-
-args = parser.parse_args()
-if args.verbose:
-  print "****** Verbose mode ****"
-  for arg in vars(args):
-     print "Argument: {}".format(arg)
-     print "|-> Value: {}".format(getattr(args, arg))
-
-status = args.status
-if status.upper() not in statuses:
-  print "ERROR: {} is not a valid ZTP status.".format(status)
-  print "Valid statuses are: {}".format(statuses)
-  exit(1)
-
-if args.ztp_host:
-  hostname = '{}'.format(args.ztp_host)
-if args.ztp_port:
-  port = '{}'.format(args.ztp_port)
-if args.ssl:
-  protocol="https"
-else:
-  protocol="http"
-
-URL_BASE = '{}:{}'.format(hostname, port)
-URL = '/api/devices/status'
-url_headers = {'Content-Type': 'application/json', 'Accept': 'application/json' }
-request_url="{}://{}{}".format(protocol, URL_BASE, URL)
-if args.verbose: print "Request_url: \"{}\"".format(request_url)
-
-# device_data = dict(
-#   ip_addr = args.device_ip,
-#   serial_number="EC1713003123",
-#   hw_model="accton_as4610_54",
-#   os_version="2.0.0-2017-07-19.1529-40fc82b_armel",
-#   os_name="ONL",
-#   state = args.status
-# )
-
-if args.device_message:
-  device_message     = args.device_message
-else:
-  device_message     = ""
-
-# The device is found via the IP and OS tupple.
-# An update of status if the OS string has changed will fail.
-device_data = dict(
-  ip_addr = args.device_ip,
-  os_name = args.device_os,
-  state   = args.status,
-  message = device_message
-)
-
-# print device_data
-json_string = json.dumps(device_data)
-# print json_string
-
-if args.dry_run:
-  print "DRY-RUN: {} {} JSON:'{}'".format(request_url, method, json_string)
-  exit(0)
-
-
-
-try:
-  conn = httplib.HTTPConnection(URL_BASE)
-  if args.verbose: 
-    logging.basicConfig(level=logging.DEBUG)
-    conn.set_debuglevel(11)
-    HTTPConnection.debuglevel = 1
-  conn.request(method, URL, json_string, url_headers)
-  r1 = conn.getresponse()
+flush_interval = 1.0
+outputs = ['text', 'jsonl']
+shard_keys = ['ip', 'serial']
+
+def parse_args(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('status', help='AEON ZTP status. Valid options are: {}'.format(statuses), nargs='?')
+  parser.add_argument('--dry-run', help="Does input validation, prints what would be done, but doesn't actually do anything.", action='store_true')
+  parser.add_argument('--ztp_host', help='Remote host against which to run. Default: {}'.format(hostname))
+  parser.add_argument('--ztp_port', help='Remote host port against which to run. Default: {}'.format(port))
+  parser.add_argument('--ztp_servers', help='Comma separated host[:port] list of ZTP servers devices are sharded over (consistent hashing, failing over to the next server). Replaces --ztp_host')
+  parser.add_argument('--shard_key', help='What devices are sharded on with --ztp_servers. Default: ip', choices=shard_keys, default='ip')
+  parser.add_argument('--ztp_candidates', help='Comma separated host[:port] list of ZTP servers, or @FILE with one per line (the ONL plugins read @{}). They are raced with a {}s stagger and the first to accept a connection is used. Replaces --ztp_host'.format(ztp_client.candidates_path, ztp_client.race_stagger))
+  parser.add_argument('--ssl', help='Should the connection be treated as an SSL/TLS protected connection', action='store_true')
+  parser.add_argument('--verify', help='With --ssl: check the server certificate against the system CAs', action='store_true')
+  parser.add_argument('--ca_file', help='With --ssl: check the server certificate against the CAs in this PEM file')
+  parser.add_argument('--wire', help='Body format to negotiate with the ZTP server: msgpack or cbor if their library is installed and the server answers in it, JSON otherwise. Default: json', choices=ztp_codec.names, default='json')
+  parser.add_argument('--device_ip', help='The device IP for which to set the status')
+  parser.add_argument('--device_os', help='The device OS')
+  parser.add_argument('--device_message', help='Optional message to be included')
+  parser.add_argument('--daemon', help='Long-running mode: read JSON status events ({"ip_addr", "os_name", "state", "message"}) one per line and send only the latest state per device every flush interval', action='store_true')
+  parser.add_argument('--listen', help='Daemon mode: read events from TCP connections on this local [host:]port instead of stdin')
+  parser.add_argument('--flush_interval', help='Daemon mode: seconds between flushes. Default: {}'.format(flush_interval), type=float)
+  parser.add_argument('--collapse_history', help='Daemon mode: fold superseded states into the message of the state that is sent instead of dropping them', action='store_true')
+  parser.add_argument('--spool', help='Journal statuses that could not be delivered to this file for ztp_replay_spool_httplib.py. Default file: {}'.format(ztp_spool.path), nargs='?', const=ztp_spool.path)
+  parser.add_argument('--output', help='text: human readable, server responses pretty printed. jsonl: one compact JSON line per PUT (status code, timing, server message) for pipelines. Default: text', choices=outputs, default='text')
+  parser.add_argument('--identity', help='Take --device_ip and --device_os (and, in daemon mode, missing event fields) from the identity file the ONL preinstall plugin registered. Default file: {}'.format(ztp_client.identity_path), nargs='?', const=ztp_client.identity_path)
+  parser.add_argument('--transitions', help='Transition log: refuse statuses the device can not reach from the last one recorded for it, and record the ones the server accepts, for ztp_phase_report.py. Default file: {}'.format(ztp_transitions.path), nargs='?', const=ztp_transitions.path)
+  parser.add_argument('--metrics', help='Record the connect/write/ttfb/read/decode timings of every request to this file: a Prometheus textfile-collector file if it ends in .prom, JSONL events otherwise')
+  parser.add_argument('--trace', help='Append every request (method, URL, body, status, time) to this file for ztp_replay_trace.py')
+  parser.add_argument('--verbose', help='Make things chatty. Note: May display sensitive data like password', action='store_true')
+
+  args = parser.parse_args(argv)
+  if not args.daemon:
+    if not args.status:
+      parser.error('status is required unless --daemon is given')
+    for required in ['device_ip', 'device_os']:
+      if not getattr(args, required) and not args.identity:
+        parser.error('--{} is required unless --daemon or --identity is given'.format(required))
+  args.candidates = None
+  if args.ztp_candidates and not args.ztp_servers:
+    try:
+      args.candidates = ztp_client.read_candidates(args.ztp_candidates, args.ztp_port or port)
+    except IOError as e:
+      parser.error("can't read the ZTP candidates: {}".format(e))
+    if not args.candidates:
+      parser.error('--ztp_candidates {} names no ZTP server'.format(args.ztp_candidates))
+  return args
+
+class StatusCoalescer(object):
+  """Keeps only the latest pending state per (ip_addr, os_name) between flushes"""
+  def __init__(self, collapse_history=False):
+    self.collapse_history = collapse_history
+    self.lock = threading.Lock()
+    self.pending = {}
+    self.received = 0
+    self.superseded = 0
+
+  def add(self, event):
+    key = (event['ip_addr'], event['os_name'])
+    with self.lock:
+      self.received += 1
+      previous = self.pending.get(key)
+      history = []
+      if previous:
+        self.superseded += 1
+        history = previous['history'] + [previous['state']]
+      self.pending[key] = dict(event, history=history)
+
+  def requeue(self, event):
+    """Puts back an event that could not be sent, unless a newer one for the
+    same device has come in since"""
+    key = (event['ip_addr'], event['os_name'])
+    with self.lock:
+      if key not in self.pending:
+        self.pending[key] = dict(event, history=[])
+
+  def drain(self):
+    """Returns the device_data for every pending device and starts a new batch"""
+    with self.lock:
+      pending, self.pending = self.pending, {}
+    batch = []
+    for event in pending.values():
+      history = event.pop('history')
+      if history and self.collapse_history:
+        event['message'] = '{} -> {}: {}'.format(' -> '.join(history), event['state'], event['message'])
+      batch.append(event)
+    return batch
+
+def parse_event(line, defaults=None):
+  """Turns one JSON event line into device_data, taking missing ip_addr and
+  os_name from defaults. Raises ValueError if it is unusable"""
+  event = json.loads(line)
+  if not isinstance(event, dict):
+    raise ValueError('event is not a JSON object')
+  if defaults:
+    event = dict(defaults, **event)
+  for key in ['ip_addr', 'os_name', 'state']:
+    if not event.get(key):
+      raise ValueError('missing {}'.format(key))
+  if not ztp_client.valid_status(event['state']):
+    raise ValueError('{} is not a valid ZTP status'.format(event['state']))
+  return dict(
+    ip_addr = event['ip_addr'],
+    os_name = event['os_name'],
+    state   = event['state'],
+    message = event.get('message') or ""
+  )
+
+def read_events(stream, coalescer, defaults=None):
+  for line in iter(stream.readline, ''):
+    line = line.strip()
+    if not line:
+      continue
+    try:
+      coalescer.add(parse_event(line, defaults))
+    except ValueError as e:
+      print >>sys.stderr, "ERROR: dropping event {}: {}".format(line, e)
+
+def flush(transport, coalescer, verbose=False, spool=None, output='text', transitions=None):
+  """Sends what the coalescer has pending. Returns (PUTs sent, statuses that
+  failed, were rejected or were not sent)"""
+  sent = 0
+  failed = 0
+  for device_data in coalescer.drain():
+    started = time.time()
+    try:
+      r1 = ztp_client.set_status(transport, transitions=transitions, **device_data)
+      sent += 1
+      outcome = ztp_client.status_outcome(r1)
+      if outcome != 'updated':
+        failed += 1
+      if output == 'jsonl':
+        print ztp_client.result_line('status', device_data, outcome, r1, time.time() - started, state=device_data['state'])
+      elif not r1.ok:
+        print "Response: {}, reason: {} for {}".format(r1.status, r1.reason, device_data)
+      elif not r1.data['ok']:
+        print "ZTP status returned an error for {}: {}".format(device_data, r1.body)
+      elif verbose:
+        print "{} {} -> {}".format(device_data['ip_addr'], device_data['os_name'], device_data['state'])
+    except ztp_client.InvalidTransition as e:
+      failed += 1
+      if output == 'jsonl':
+        print ztp_client.result_line('status', device_data, 'invalid-transition', error='{}'.format(e), state=device_data['state'])
+      else:
+        print "ERROR: not sent: {}".format(e)
+    except ValueError as e:
+      failed += 1
+      if output == 'jsonl':
+        print ztp_client.result_line('status', device_data, 'failed', elapsed=time.time() - started, error='JSON parse error: {}'.format(e), state=device_data['state'])
+      else:
+        print "JSON parse error for {}: {}".format(device_data, e)
+    except (socket.error, httplib.HTTPException) as e:
+      if spool:
+        spool.append('status', device_data)
+      if output == 'jsonl':
+        print ztp_client.result_line('status', device_data, 'spooled' if spool else 'failed', elapsed=time.time() - started, error='Socket error: {}'.format(e), state=device_data['state'])
+      else:
+        print >>sys.stderr, "ERROR: Socket Error sending {} to 'http://{}': {}".format(device_data, transport.url_base, e)
+      if not spool:
+        failed += 1
+        # Coalesced away from the sender already; this is the last trace of it
+        print >>sys.stderr, "ERROR: dropping status {} {} -> {}: not delivered and no --spool given".format(
+          device_data['ip_addr'], device_data['os_name'], device_data['state'])
+  return sent, failed
+
+def run_daemon(args, transport, transitions=None):
+  coalescer = StatusCoalescer(args.collapse_history)
+  defaults = dict((key, value) for key, value in [('ip_addr', args.device_ip), ('os_name', args.device_os)] if value)
+  interval = args.flush_interval or flush_interval
+  if args.listen:
+    import SocketServer
+    listen_host, _, listen_port = args.listen.rpartition(':')
+    class EventHandler(SocketServer.StreamRequestHandler):
+      def handle(self):
+        read_events(self.rfile, coalescer, defaults)
+    server = SocketServer.ThreadingTCPServer((listen_host or 'localhost', int(listen_port)), EventHandler)
+    server.daemon_threads = True
+    reader = threading.Thread(target=server.serve_forever)
+  else:
+    reader = threading.Thread(target=read_events, args=(sys.stdin, coalescer, defaults))
+  reader.daemon = True
+  reader.start()
+
+  spool = ztp_spool.Spool(args.spool) if args.spool else None
+  sent = 0
+  failed = 0
+  try:
+    while reader.is_alive():
+      reader.join(interval)
+      flushed = flush(transport, coalescer, args.verbose, spool, args.output, transitions)
+      sent, failed = sent + flushed[0], failed + flushed[1]
+  except KeyboardInterrupt:
+    flushed = flush(transport, coalescer, args.verbose, spool, args.output, transitions)
+    sent, failed = sent + flushed[0], failed + flushed[1]
+  transport.close()
+  if spool:
+    spool.close()
+  out = sys.stderr if args.output == 'jsonl' else sys.stdout
+  print >>out, "Events received: {}, superseded: {}, PUTs sent: {}, failed: {}".format(coalescer.received, coalescer.superseded, sent, failed)
+  # Pipelines read the outcome per line; the exit code says whether any failed
+  return 1 if failed and args.output == 'jsonl' else 0
+
+def main(argv=None):
+  args = parse_args(argv)
   if args.verbose:
-    print "Response: {}, reason: {}".format(r1.status, r1.reason)
-  if r1.status in httpSuccessCodes:
-    data = r1.read()
-    ztp_status = json.loads(data)['ok']
-    if not ztp_status:
-      print "ZTP status returned an error:"
-      print json.dumps(json.loads(data), sort_keys=True, indent=4)
+    print "****** Verbose mode ****"
+    for arg in vars(args):
+       print "Argument: {}".format(arg)
+       print "|-> Value: {}".format(getattr(args, arg))
+
+  status = args.status
+  if status and not ztp_client.valid_status(status):
+    print "ERROR: {} is not a valid ZTP status.".format(status)
+    print "Valid statuses are: {}".format(statuses)
+    return 1
+
+  if args.identity:
+    try:
+      identity = ztp_client.read_identity(args.identity)
+    except (IOError, ValueError) as e:
+      print "ERROR: Can't use the device identity {}: {}".format(args.identity, e)
+      return 1
+    # Report against the record preinstall registered; explicit arguments win
+    args.device_ip = args.device_ip or identity['key']['ip_addr']
+    args.device_os = args.device_os or identity['key']['os_name']
+
+  ztp_host = args.ztp_host or hostname
+  ztp_port = args.ztp_port or port
+  if args.candidates:
+    candidates = args.candidates
+    if args.identity and identity.get('ztp_server') in candidates:
+      # Where the plugins registered the device; give it the head start
+      candidates.remove(identity['ztp_server'])
+      candidates.insert(0, identity['ztp_server'])
+    try:
+      winner = ztp_client.race(candidates)
+    except socket.error as e:
+      # Go on with the first one; the request fails (and spools) as usual
+      print "WARN: {}".format(e)
+      winner = candidates[0]
+    ztp_host, _, ztp_port = winner.rpartition(':')
+    if args.verbose:
+      print "ZTP server: {} of {}".format(winner, ', '.join(candidates))
+  if args.ssl:
+    protocol="https"
   else:
-    print "Response: {}, reason: {}".format(r1.status, r1.reason)
-    print "Non-200 HTTP response seen. Something went awry."
-    data = r1.read()
-    print json.dumps(json.loads(data), sort_keys=True, indent=4)
-except ValueError as e:
-  print "Got the following data back: {}".format(data)
-  print "JSON parse error: {}".format(e)
-  exit(1)
-except socket.error as e:
-  print "ERROR: Socket Error"
-  print "Tried to access 'http://{}'".format(URL_BASE)
-  print "ERROR: {}".format(e)
-  exit(1)
\ No newline at end of file
+    protocol="http"
+
+  tls = dict(ssl=args.ssl, verify=args.verify, ca_file=args.ca_file)
+  if args.ztp_servers:
+    import ztp_shards
+    transport = ztp_shards.ShardedTransport(ztp_shards.parse_servers(args.ztp_servers, ztp_port), args.shard_key, **tls)
+  else:
+    transport = ztp_client.get_transport(ztp_host, ztp_port, **tls)
+  if args.wire != 'json':
+    try:
+      transport.wire = ztp_codec.get(args.wire)
+    except ImportError as e:
+      print >>sys.stderr, "WARN: Can't use {}, talking JSON: {}".format(args.wire, e)
+
+  request_url = "{}://{}{}".format(protocol, transport.url_base, ztp_client.STATUS_URL)
+  if args.verbose: print "Request_url: \"{}\"".format(request_url)
+  if args.verbose:
+    import logging
+    logging.basicConfig(level=logging.DEBUG)
+    transport.debuglevel = 11
+    HTTPConnection.debuglevel = 1
+
+  if args.metrics:
+    transport.recorder = ztp_metrics.Recorder(args.metrics)
+  if args.trace:
+    import ztp_trace
+    transport.tracer = ztp_trace.Tracer(args.trace)
+  transitions = None
+  if args.transitions:
+    transitions = ztp_transitions.TransitionLog(args.transitions, source='ztp_set_device_status_httplib.py')
+  try:
+    if args.daemon:
+      if args.dry_run:
+        print "DRY-RUN: {} {} for every coalesced event".format(request_url, method)
+        return 0
+      return run_daemon(args, transport, transitions)
+    return set_one(args, transport, request_url, transitions)
+  finally:
+    if transport.recorder:
+      transport.recorder.close()
+    if transport.tracer:
+      transport.tracer.close()
+    if transitions:
+      transitions.close()
+    if args.ssl and not args.dry_run:
+      print >>(sys.stderr if args.output == 'jsonl' else sys.stdout), ztp_client.tls_summary(transport)
+
+def set_one(args, transport, request_url, transitions=None):
+  # The device is found via the IP and OS tupple.
+  # An update of status if the OS string has changed will fail.
+  device_data = dict(
+    ip_addr = args.device_ip,
+    os_name = args.device_os,
+    state   = args.status,
+    message = args.device_message or ""
+  )
+
+  # Checked here as well as in set_status() so that --dry-run catches it too
+  previous = transitions.last(device_data['ip_addr'], device_data['os_name']) if transitions else None
+  if not ztp_client.valid_transition(previous, device_data['state']):
+    error = '{} {} can not go from {} to {}'.format(device_data['ip_addr'], device_data['os_name'], previous, device_data['state'])
+    if args.output == 'jsonl':
+      print ztp_client.result_line('status', device_data, 'invalid-transition', error=error, state=device_data['state'])
+    else:
+      print "ERROR: {} according to {}. Nothing sent.".format(error, transitions.path)
+    return 1
+
+  if args.dry_run:
+    if args.output == 'jsonl':
+      print ztp_client.result_line('status', device_data, 'dry-run', state=device_data['state'])
+    else:
+      print "DRY-RUN: {} {} JSON:'{}'".format(request_url, method, json.dumps(device_data))
+    return 0
+
+  data = None
+  started = time.time()
+  try:
+    r1 = ztp_client.set_status(transport, transitions=transitions, **device_data)
+    data = r1.body
+    if args.output == 'jsonl':
+      outcome = ztp_client.status_outcome(r1)
+      print ztp_client.result_line('status', device_data, outcome, r1, time.time() - started, state=device_data['state'])
+      return 0 if outcome == 'updated' else 1
+    if args.verbose:
+      print "Response: {}, reason: {}".format(r1.status, r1.reason)
+    if r1.ok:
+      if not r1.data['ok']:
+        print "ZTP status returned an error:"
+        print json.dumps(r1.data, sort_keys=True, indent=4)
+    else:
+      print "Response: {}, reason: {}".format(r1.status, r1.reason)
+      print "Non-200 HTTP response seen. Something went awry."
+      print json.dumps(r1.data, sort_keys=True, indent=4)
+  except ValueError as e:
+    if args.output == 'jsonl':
+      print ztp_client.result_line('status', device_data, 'failed', elapsed=time.time() - started, error='JSON parse error: {}'.format(e), state=device_data['state'])
+      return 1
+    print "Got the following data back: {}".format(data)
+    print "JSON parse error: {}".format(e)
+    return 1
+  except (socket.error, httplib.HTTPException) as e:
+    if args.spool:
+      spool = ztp_spool.Spool(args.spool)
+      spool.append('status', device_data)
+      spool.close()
+    if args.output == 'jsonl':
+      print ztp_client.result_line('status', device_data, 'spooled' if args.spool else 'failed', elapsed=time.time() - started, error='Socket error: {}'.format(e), state=device_data['state'])
+      return 1
+    print "ERROR: Socket Error"
+    print "Tried to access '{}'".format(request_url)
+    print "ERROR: {}".format(e)
+    if args.spool:
+      print "Spooled to {} for a later ztp_replay_spool_httplib.py".format(args.spool)
+    return 1
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,280 @@
+"""
+Spreads devices over several ZTP servers with consistent hashing.
+
+  transport = ztp_shards.ShardedTransport(['ztp1:8080', 'ztp2:8080', 'ztp3:8080'])
+  ztp_client.add_device(transport, device_data)
+
+ShardedTransport has the same request() as the ztp_client transports, so
+everything built on them works unchanged. It looks at the device in each
+request's JSON body and sends it to the
+device's shard: the first server clockwise from the hash of its ip_addr, or
+its serial_number with key='serial'. Adding or removing a server only moves
+the devices of the neighbouring arc.
+
+A server that fails a request (connection error, 502/503/504) is marked down
+for cooldown seconds and the request goes to the next server on the ring,
+so while a shard is down its devices are registered on its neighbour. A
+status update the device's shard doesn't know ("device not found") is
+therefore offered to the next servers on the ring as well. The same is done
+when sharding by serial and a status update's serial is unknown: the PUT
+body only carries ip_addr and os_name, so serials are learnt from the adds
+this transport routes.
+
+DELETEs go to every server, GETs are fanned out to all of them in parallel
+and merged.
+"""
+import json
+import time
+import bisect
+import socket
+import hashlib
+import threading
+try:
+  import httplib
+except ImportError:
+  import http.client as httplib
+
+import ztp_client
+import ztp_metrics
+
+# Defaults
+replicas       = 64
+cooldown       = 30.0
+failover_codes = [502, 503, 504]
+keys           = ['ip', 'serial']
+
+def parse_servers(servers, port=ztp_client.port):
+  """'ztp1:8080,ztp2' -> ['ztp1:8080', 'ztp2:<port>']"""
+  result = []
+  for server in servers.split(','):
+    server = server.strip()
+    if not server:
+      continue
+    if ':' not in server:
+      server = '{}:{}'.format(server, port)
+    result.append(server)
+  return result
+
+def hash_value(value):
+  return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+class Ring(object):
+  """A consistent hash ring with replicas virtual nodes per server"""
+  def __init__(self, servers, replicas=replicas):
+    self.servers = list(servers)
+    points = []
+    for server in self.servers:
+      for i in range(replicas):
+        points.append((hash_value('{}#{}'.format(server, i)), server))
+    points.sort()
+    self.hashes = [h for h, server in points]
+    self.owners = [server for h, server in points]
+
+  def nodes(self, key):
+    """Every server, in ring order starting at the one key belongs to"""
+    order = []
+    start = bisect.bisect(self.hashes, hash_value(key))
+    for i in range(len(self.owners)):
+      server = self.owners[(start + i) % len(self.owners)]
+      if server not in order:
+        order.append(server)
+        if len(order) == len(self.servers):
+          break
+    return order
+
+class ShardedTransport(object):
+  def __init__(self, servers, key='ip', size=ztp_client.pool_size, timeout=None, backend='httplib', cooldown=cooldown, **options):
+    if key not in keys:
+      raise ValueError('shard key must be one of {}'.format(keys))
+    self.key = key
+    self.ring = Ring(servers)
+    self.url_base = ','.join(self.ring.servers)
+    self.cooldown = cooldown
+    self.transports = {}
+    for server in self.ring.servers:
+      host, port = server.rsplit(':', 1)
+      self.transports[server] = ztp_client.get_transport(host, port, backend, size=size, timeout=timeout, **options)
+    self.lock = threading.Lock()
+    self.down_until = {}
+    self.serials = {}
+    # Traced here rather than per server: a trace holds the requests the
+    # caller made, not the fan-out, so it replays against any layout
+    self.tracer = None
+
+  # The attributes the scripts use on a single transport
+  @property
+  def opened(self):
+    return sum(getattr(transport, 'opened', 0) for transport in self.transports.values())
+
+  @property
+  def handshakes(self):
+    return sum(getattr(transport, 'handshakes', 0) for transport in self.transports.values())
+
+  @property
+  def resumed(self):
+    return sum(getattr(transport, 'resumed', 0) for transport in self.transports.values())
+
+  @property
+  def debuglevel(self):
+    return max(getattr(transport, 'debuglevel', 0) for transport in self.transports.values())
+
+  @debuglevel.setter
+  def debuglevel(self, level):
+    for transport in self.transports.values():
+      transport.debuglevel = level
+
+  @property
+  def recorder(self):
+    return next(iter(self.transports.values())).recorder
+
+  @recorder.setter
+  def recorder(self, recorder):
+    for transport in self.transports.values():
+      transport.recorder = recorder
+
+
+  @property
+  def wire(self):
+    return next(iter(self.transports.values())).wire
+
+  @wire.setter
+  def wire(self, wire):
+    # Negotiated with each server on its own
+    for transport in self.transports.values():
+      transport.wire = wire
+
+  def shard_for(self, device_data):
+    """The server device_data belongs to while every server is healthy"""
+    return self.ring.nodes(self.routing_key(device_data) or device_data.get('ip_addr') or '')[0]
+
+  def routing_key(self, device):
+    """The value device is hashed on, or None if it isn't known"""
+    if self.key == 'serial':
+      serial = device.get('serial_number')
+      if serial:
+        return serial
+      with self.lock:
+        return self.serials.get((device.get('ip_addr'), device.get('os_name')))
+    return device.get('ip_addr')
+
+  def healthy_first(self, servers):
+    now = time.time()
+    with self.lock:
+      up = [server for server in servers if self.down_until.get(server, 0) <= now]
+    return up + [server for server in servers if server not in up]
+
+  def mark_down(self, server):
+    with self.lock:
+      self.down_until[server] = time.time() + self.cooldown
+
+  def mark_up(self, server):
+    with self.lock:
+      self.down_until.pop(server, None)
+
+  def send(self, server, method, url, body, headers):
+    """Returns the response, or None if server failed and is now marked down"""
+    try:
+      response = self.transports[server].request(method, url, body, headers)
+    except (IOError, httplib.HTTPException):
+      # IOError covers socket.error and the requests backend's exceptions
+      self.mark_down(server)
+      return None
+    if response.status in failover_codes:
+      self.mark_down(server)
+      return None
+    self.mark_up(server)
+    return response
+
+  def request(self, method, url, body=None, headers={}):
+    if not self.tracer:
+      return self.route(method, url, body, headers)
+    timing = ztp_metrics.Timing(method, url)
+    try:
+      response = self.route(method, url, body, headers)
+    except (IOError, httplib.HTTPException) as e:
+      timing.done(error='{}: {}'.format(type(e).__name__, e))
+      self.tracer.record(timing, url, body)
+      raise
+    timing.done(response.status)
+    self.tracer.record(timing, url, body)
+    return response
+
+  def route(self, method, url, body, headers):
+    if method == 'GET':
+      return self.gather(url, headers)
+    if method == 'DELETE':
+      return self.broadcast(method, url, body, headers)
+
+    device = json.loads(body) if body else {}
+    key = self.routing_key(device)
+    servers = self.healthy_first(self.ring.nodes(key or device.get('ip_addr') or ''))
+    response = None
+    for server in servers:
+      answer = self.send(server, method, url, body, headers)
+      if answer is None:
+        continue
+      response = answer
+      if method == 'PUT' and not self.found(response):
+        # Registered on a neighbour while its shard was down, or routed
+        # without knowing its serial: look further along the ring
+        continue
+      if method == 'POST' and self.key == 'serial' and device.get('serial_number'):
+        with self.lock:
+          self.serials[(device.get('ip_addr'), device.get('os_name'))] = device['serial_number']
+      return response
+    if response is None:
+      raise socket.error('no ZTP server reachable of {}'.format(self.url_base))
+    return response
+
+  @staticmethod
+  def found(response):
+    try:
+      return not (response.ok and not response.data.get('ok') and response.message == 'device not found')
+    except ValueError:
+      return True
+
+  def fan_out(self, method, url, body, headers):
+    """Sends the request to every server in parallel. Returns {server: response or None}"""
+    answers = {}
+    def one(server):
+      answers[server] = self.send(server, method, url, body, headers)
+    threads = [threading.Thread(target=one, args=(server,)) for server in self.ring.servers]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    return answers
+
+  def broadcast(self, method, url, body, headers):
+    """A DELETE may match records on any shard. Returns the successful
+    response that deleted the most, with the counts of all of them added up"""
+    answers = [r for r in self.fan_out(method, url, body, headers).values() if r is not None]
+    if not answers:
+      raise socket.error('no ZTP server reachable of {}'.format(self.url_base))
+    ok = [r for r in answers if r.ok]
+    if not ok:
+      return answers[0]
+    try:
+      counts = [r.data.get('count', 0) for r in ok]
+    except ValueError:
+      return ok[0]
+    best = ok[counts.index(max(counts))]
+    return ztp_client.Response(best.status, best.reason, json.dumps(dict(best.data, count=sum(counts))))
+
+  def gather(self, url, headers):
+    """Fans a GET out to every server and merges the device lists. Fails if
+    any shard can't answer, since a partial list would be silently wrong"""
+    answers = self.fan_out('GET', url, None, headers)
+    items = []
+    for server in self.ring.servers:
+      r1 = answers[server]
+      if r1 is None:
+        raise socket.error('ZTP server {} did not answer GET {}'.format(server, url))
+      if not r1.ok:
+        return r1
+      items += r1.data.get('items', [])
+    return ztp_client.Response(200, 'OK', json.dumps(dict(ok=True, count=len(items), items=items)))
+
+  def close(self):
+    for transport in self.transports.values():
+      transport.close()
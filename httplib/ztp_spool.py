@@ -0,0 +1,170 @@
+"""
+Append-only journal of add and status events that could not be delivered.
+
+Each line is one JSON event:
+
+  {"kind": "add" | "status", "ts": <time.time()>, "device": <device_data>}
+
+Writers append and fsync in batches (every fsync_batch events or
+fsync_interval seconds, and on close). compact() rewrites the journal keeping,
+per (ip_addr, os_name), only the latest add and the latest status that came
+after it. replay() compacts, sends what is left over one keep-alive
+connection and keeps whatever still could not be delivered.
+
+All writers, compact() and replay() take an exclusive flock on the journal
+file currently at the path (see relock()), so several script invocations
+can share one.
+"""
+import os
+import json
+import time
+import fcntl
+import socket
+try:
+  import httplib
+except ImportError:
+  import http.client as httplib
+
+import ztp_client
+
+# Defaults
+path           = '/var/spool/ztp/journal.jsonl'
+fsync_batch    = 64
+fsync_interval = 1.0
+
+def relock(f, path, mode='a'):
+  """Takes an exclusive flock on the open journal f and returns it. compact()
+  and replay() replace the file, so a handle to an older one is swapped for
+  the current one (opened with mode) until the lock is on the file at path"""
+  while True:
+    fcntl.flock(f, fcntl.LOCK_EX)
+    try:
+      if os.fstat(f.fileno()).st_ino == os.stat(path).st_ino:
+        return f
+    except OSError:
+      pass
+    fcntl.flock(f, fcntl.LOCK_UN)
+    f.close()
+    f = open(path, mode)
+
+class Spool(object):
+  def __init__(self, path=path, fsync_batch=fsync_batch, fsync_interval=fsync_interval):
+    self.path = path
+    self.fsync_batch = fsync_batch
+    self.fsync_interval = fsync_interval
+    self.f = None
+    self.unsynced = 0
+    self.synced_at = time.time()
+
+  def lock(self):
+    """Opens and locks the journal, see relock()"""
+    if self.f is None:
+      directory = os.path.dirname(os.path.abspath(self.path))
+      if not os.path.isdir(directory):
+        os.makedirs(directory)
+      self.f = open(self.path, 'a')
+    self.f = relock(self.f, self.path)
+
+  def append(self, kind, device_data):
+    line = json.dumps(dict(kind=kind, ts=time.time(), device=device_data), sort_keys=True)
+    self.lock()
+    try:
+      self.f.write(line + '\n')
+      self.f.flush()
+    finally:
+      fcntl.flock(self.f, fcntl.LOCK_UN)
+    self.unsynced += 1
+    if self.unsynced >= self.fsync_batch or time.time() - self.synced_at >= self.fsync_interval:
+      self.sync()
+
+  def sync(self):
+    if self.f is not None and self.unsynced:
+      os.fsync(self.f.fileno())
+      self.unsynced = 0
+      self.synced_at = time.time()
+
+  def close(self):
+    self.sync()
+    if self.f is not None:
+      self.f.close()
+      self.f = None
+
+def read_events(f):
+  events = []
+  for line in f:
+    line = line.strip()
+    if not line:
+      continue
+    try:
+      events.append(json.loads(line))
+    except ValueError:
+      # A torn write from a crash; everything before it is still good
+      continue
+  return events
+
+def compacted(events):
+  """Keeps the latest add and the latest later status per (ip_addr, os_name), oldest first"""
+  latest = {}
+  for event in events:
+    device = event['device']
+    key = (device['ip_addr'], device['os_name'])
+    kinds = latest.setdefault(key, {})
+    if event['kind'] == 'add':
+      # A new registration carries its own state; earlier statuses are moot
+      kinds.pop('status', None)
+    kinds[event['kind']] = event
+  kept = [event for kinds in latest.values() for event in kinds.values()]
+  kept.sort(key=lambda event: event['ts'])
+  return kept
+
+def rewrite(f, events):
+  """Replaces the contents of the locked journal f with events"""
+  tmp = '{}.tmp'.format(f.name)
+  with open(tmp, 'w') as out:
+    for event in events:
+      out.write(json.dumps(event, sort_keys=True) + '\n')
+    out.flush()
+    os.fsync(out.fileno())
+  os.rename(tmp, f.name)
+
+def compact(path=path):
+  """Compacts the journal in place. Returns (events before, events after)"""
+  with relock(open(path, 'r+'), path, 'r+') as f:
+    events = read_events(f)
+    kept = compacted(events)
+    rewrite(f, kept)
+  return len(events), len(kept)
+
+def deliver(transport, event):
+  """Sends one journal event. Returns True if the ZTP server took it"""
+  device = event['device']
+  if event['kind'] == 'add':
+    outcome, r1 = ztp_client.add_device(transport, device)
+    return outcome != 'failed'
+  r1 = ztp_client.set_status(transport, device['ip_addr'], device['os_name'], device['state'], device.get('message') or "")
+  return r1.ok and r1.data['ok']
+
+def replay(transport, path=path, report=None):
+  """Compacts the journal and delivers it in order. Stops at the first
+  connection error, since the server is still unreachable; events the
+  server rejected are dropped. Returns (delivered, rejected, remaining)"""
+  delivered = rejected = 0
+  with relock(open(path, 'r+'), path, 'r+') as f:
+    events = compacted(read_events(f))
+    while delivered + rejected < len(events):
+      event = events[delivered + rejected]
+      try:
+        ok = deliver(transport, event)
+      except ValueError:
+        ok = False
+      except (socket.error, httplib.HTTPException):
+        break
+      if ok:
+        delivered += 1
+      else:
+        rejected += 1
+      if report:
+        report(event, ok)
+    remaining = events[delivered + rejected:]
+    rewrite(f, remaining)
+  return delivered, rejected, len(remaining)
@@ -0,0 +1,276 @@
+#!/usr/bin/python
+
+# A local stand-in for the AEON ZTP server. It implements only the part of the
+# API the clients in this repo use:
+#
+#   POST   /api/devices          -> "device added" / "device already exists"
+#   DELETE /api/devices?ip_addr= -> removes matching devices
+#   GET    /api/devices          -> {"ok", "count", "items"}, or 304 if unchanged
+#   PUT    /api/devices/status   -> {"ok", "message"}, found by (ip_addr, os_name)
+#
+# Devices are kept in memory. Every change bumps a generation counter that
+# GET sends as its ETag (with a Last-Modified), so conditional GETs with
+# If-None-Match or If-Modified-Since are answered 304 without a body. Latency
+# and errors can be injected to see how the clients behave against a slow or
+# failing server. With --certfile it serves HTTPS, for the clients' --ssl. It
+# answers in MessagePack or CBOR to clients that ask for it (and have the
+# library installed), see ztp_codec; --json_only makes it behave like the real
+# server. It runs on Python 2 and 3 and can be started from the command line
+# or in-process via StandinServer (used by ztp_bench.py).
+import sys
+import time
+import random
+import socket
+import argparse
+import threading
+from email.utils import formatdate, parsedate_tz, mktime_tz
+try:
+  import BaseHTTPServer
+  import SocketServer
+  from urlparse import urlparse, parse_qs
+except ImportError:
+  import http.server as BaseHTTPServer
+  import socketserver as SocketServer
+  from urllib.parse import urlparse, parse_qs
+
+import ztp_client
+import ztp_codec
+
+# Defaults
+hostname = 'localhost'
+port = 8080
+
+class UnsupportedMediaType(Exception):
+  pass
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    # Headers and body go out in separate writes; without this every response
+    # waits for the client's delayed ACK
+    self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.server.stats_add('connections')
+
+  def log_message(self, format, *args):
+    if self.server.verbose:
+      BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+  def reply(self, code, payload, headers={}):
+    codec = ztp_codec.JSON
+    if self.server.binary:
+      codec = ztp_codec.preferred(self.headers.get('Accept'))
+    body = codec.dumps(payload)
+    if not isinstance(body, bytes):
+      body = body.encode('utf-8')
+    self.send_response(code)
+    for name, value in headers.items():
+      self.send_header(name, value)
+    self.send_header('Content-Type', codec.content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def not_modified(self, etag, modified):
+    """True if the request's validators match: If-None-Match (weak
+    comparison) if it has one, If-Modified-Since otherwise"""
+    match = self.headers.get('If-None-Match')
+    if match:
+      tags = [tag.strip() for tag in match.split(',')]
+      return '*' in tags or etag.replace('W/', '') in [tag.replace('W/', '') for tag in tags]
+    since = parsedate_tz(self.headers.get('If-Modified-Since') or '')
+    return since is not None and int(modified) <= mktime_tz(since)
+
+  def reply_not_modified(self, headers):
+    self.send_response(304)
+    for name, value in headers.items():
+      self.send_header(name, value)
+    self.end_headers()
+
+  def read_body(self):
+    """The request body, decoded as its Content-Type says"""
+    body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+    try:
+      codec = ztp_codec.for_content_type(self.headers.get('Content-Type'))
+    except ImportError:
+      raise UnsupportedMediaType(self.headers.get('Content-Type'))
+    if codec is not ztp_codec.JSON and not self.server.binary:
+      raise UnsupportedMediaType(self.headers.get('Content-Type'))
+    return codec.loads(body)
+
+  def handle_one(self, handler):
+    self.server.stats_add('requests')
+    if self.server.latency:
+      time.sleep(self.server.latency * random.uniform(1 - self.server.jitter, 1 + self.server.jitter))
+    if self.server.error_rate and random.random() < self.server.error_rate:
+      self.server.stats_add('injected_errors')
+      # Drain the body so the connection stays usable
+      self.rfile.read(int(self.headers.get('Content-Length') or 0))
+      headers = {}
+      if self.server.retry_after is not None and self.server.error_code in [429, 503]:
+        headers['Retry-After'] = str(self.server.retry_after)
+      return self.reply(self.server.error_code, {'ok': False, 'message': 'injected error'}, headers)
+    url = urlparse(self.path)
+    try:
+      handler(url.path, dict((k, v[0]) for k, v in parse_qs(url.query).items()))
+    except UnsupportedMediaType as e:
+      self.reply(415, {'ok': False, 'message': 'unsupported media type: {}'.format(e)})
+    except (ValueError, KeyError) as e:
+      self.reply(400, {'ok': False, 'message': 'bad request: {}'.format(e)})
+
+  def do_POST(self):
+    self.handle_one(self.post)
+
+  def do_PUT(self):
+    self.handle_one(self.put)
+
+  def do_DELETE(self):
+    self.handle_one(self.delete)
+
+  def do_GET(self):
+    self.handle_one(self.get)
+
+  def post(self, path, query):
+    if path != ztp_client.DEVICES_URL:
+      return self.reply(404, {'ok': False, 'message': 'not found'})
+    device = self.read_body()
+    key = (device['ip_addr'], device['os_name'])
+    with self.server.lock:
+      if key in self.server.devices:
+        return self.reply(200, {'ok': False, 'message': 'device already exists'})
+      device.setdefault('state', 'START')
+      self.server.devices[key] = device
+      self.server.changed()
+    self.reply(201, {'ok': True, 'message': 'device added'})
+
+  def put(self, path, query):
+    if path != ztp_client.STATUS_URL:
+      return self.reply(404, {'ok': False, 'message': 'not found'})
+    update = self.read_body()
+    key = (update['ip_addr'], update['os_name'])
+    with self.server.lock:
+      device = self.server.devices.get(key)
+      if device is None:
+        return self.reply(200, {'ok': False, 'message': 'device not found'})
+      device['state'] = update['state']
+      device['message'] = update.get('message', '')
+      self.server.changed()
+    self.reply(200, {'ok': True, 'message': 'device status updated'})
+
+  def delete(self, path, query):
+    if path != ztp_client.DEVICES_URL:
+      return self.reply(404, {'ok': False, 'message': 'not found'})
+    with self.server.lock:
+      doomed = [key for key, device in self.server.devices.items() if self.server.matches(device, query)]
+      for key in doomed:
+        del self.server.devices[key]
+      if doomed:
+        self.server.changed()
+    self.reply(200, {'ok': True, 'count': len(doomed), 'message': '{} device(s) deleted'.format(len(doomed))})
+
+  def get(self, path, query):
+    if path != ztp_client.DEVICES_URL:
+      return self.reply(404, {'ok': False, 'message': 'not found'})
+    with self.server.lock:
+      etag = 'W/"{}"'.format(self.server.generation)
+      modified = self.server.modified
+      unchanged = self.not_modified(etag, modified)
+      if not unchanged:
+        items = [dict(device) for device in self.server.devices.values() if self.server.matches(device, query)]
+    validators = {'ETag': etag, 'Last-Modified': formatdate(modified, usegmt=True)}
+    if unchanged:
+      self.server.stats_add('not_modified')
+      return self.reply_not_modified(validators)
+    self.reply(200, {'ok': True, 'count': len(items), 'items': items}, validators)
+
+class StandinServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """The stand-in ZTP server. start() serves from a background thread"""
+  daemon_threads = True
+  allow_reuse_address = True
+  request_queue_size = 1024
+
+  def __init__(self, hostname=hostname, port=0, latency=0.0, jitter=0.0, error_rate=0.0, error_code=500, verbose=False, certfile=None, keyfile=None, retry_after=None, binary=True):
+    BaseHTTPServer.HTTPServer.__init__(self, (hostname, port), Handler)
+    self.tls = None
+    if certfile:
+      import ssl
+      self.tls = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+      self.tls.load_cert_chain(certfile, keyfile)
+    self.latency = latency
+    self.jitter = jitter
+    self.error_rate = error_rate
+    self.error_code = error_code
+    self.retry_after = retry_after
+    self.binary = binary
+    self.verbose = verbose
+    self.lock = threading.Lock()
+    self.devices = {}
+    self.generation = 0
+    self.modified = time.time()
+    self.stats = {}
+
+  def get_request(self):
+    conn, address = self.socket.accept()
+    if self.tls:
+      # The handshake happens in the handler thread, on the first read
+      conn = self.tls.wrap_socket(conn, server_side=True, do_handshake_on_connect=False)
+    return conn, address
+
+  @property
+  def port(self):
+    return self.server_address[1]
+
+  @staticmethod
+  def matches(device, query):
+    return all(device.get(k) == v for k, v in query.items())
+
+  def changed(self):
+    """Call with the lock held after changing devices"""
+    self.generation += 1
+    self.modified = time.time()
+
+  def stats_add(self, name):
+    with self.lock:
+      self.stats[name] = self.stats.get(name, 0) + 1
+
+  def reset_stats(self):
+    with self.lock:
+      stats, self.stats = self.stats, {}
+    return stats
+
+  def start(self):
+    thread = threading.Thread(target=self.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return self
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--host', help='Address to listen on. Default: {}'.format(hostname), default=hostname)
+  parser.add_argument('--port', help='Port to listen on. Default: {}'.format(port), type=int, default=port)
+  parser.add_argument('--latency', help='Seconds to wait before answering each request', type=float, default=0.0)
+  parser.add_argument('--jitter', help='Randomize the latency by +/- this fraction', type=float, default=0.0)
+  parser.add_argument('--error_rate', help='Fraction of requests answered with --error_code', type=float, default=0.0)
+  parser.add_argument('--error_code', help='HTTP status used for injected errors. Default: 500', type=int, default=500)
+  parser.add_argument('--retry_after', help='Retry-After seconds sent with injected 429 and 503 errors', type=int)
+  parser.add_argument('--json_only', help='Only speak JSON, like the AEON ZTP server: ignore MessagePack/CBOR in Accept and answer such request bodies with 415', action='store_true')
+  parser.add_argument('--certfile', help='Serve HTTPS with this PEM certificate (chain)')
+  parser.add_argument('--keyfile', help='Private key for --certfile, if it is not in the same file')
+  parser.add_argument('--verbose', help='Log every request', action='store_true')
+  args = parser.parse_args(argv)
+
+  server = StandinServer(args.host, args.port, args.latency, args.jitter, args.error_rate, args.error_code, args.verbose, args.certfile, args.keyfile, args.retry_after, not args.json_only)
+  print("Stand-in ZTP server listening on {}://{}:{}".format('https' if server.tls else 'http', args.host, server.port))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
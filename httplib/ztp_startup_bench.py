@@ -0,0 +1,182 @@
+#!/usr/bin/python
+
+# Cold-start benchmark for the ztp_* entry points. Each one is started as a
+# fresh process on the path that needs no ZTP server (--dry-run, or --help
+# where there is none) and timed end to end. The time of a bare interpreter
+# is subtracted, so what is reported is what the script itself costs:
+# imports, argument parsing and its dry-run work. The number of modules the
+# script has loaded by then is reported next to it; unlike the time it
+# doesn't vary between runs, so it is the first thing to look at when a
+# startup regression shows up.
+#
+# --zipapp times the same commands through a ztp_zipapp.py archive. The ONL
+# plugins are only measured (import time) where the onl package is importable.
+# --output writes the results as JSON, --compare checks them against an
+# earlier run and --budget_ms fails any entry point over an absolute budget.
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+
+import ztp_zipapp
+
+# Defaults
+runs      = 10
+tolerance = 0.20
+
+dry_run = {
+  'add':             ['--dry-run', '--device_ip', '10.0.0.1', '--device_os', 'ONL', '--device_status', 'START'],
+  'status':          ['START', '--dry-run', '--device_ip', '10.0.0.1', '--device_os', 'ONL'],
+  'replay':          ['--dry-run', '--spool', os.devnull],
+  'sync':            ['--help'],
+  'fleet':           ['--help'],
+  'phase-report':    [os.devnull],
+  'agent':           ['--help'],
+  'agent-client':    ['--help'],
+  'trace-replay':    ['--help'],
+  'query':           ['--help'],
+  'watch':           ['--help'],
+  'add-requests':    ['--dry-run'],
+  'status-requests': ['START', '--dry-run'],
+}
+
+plugins = ['onl_preinstall', 'onl_postinstall']
+
+# Runs a script the way the interpreter would and reports how many modules it loaded
+count_modules = '''import sys, runpy
+path = sys.argv.pop(1)
+sys.path.insert(0, __import__('os').path.dirname(path))
+try:
+  runpy.run_path(path, run_name='__main__')
+except SystemExit:
+  pass
+sys.stdout.flush()
+sys.stderr.write('modules={}\\n'.format(len(sys.modules)))
+'''
+
+def median(values):
+  ordered = sorted(values)
+  middle = len(ordered) // 2
+  if len(ordered) % 2:
+    return ordered[middle]
+  return (ordered[middle - 1] + ordered[middle]) / 2.0
+
+def timed(command, n):
+  """Runs command n times. Returns the wall clock time of each run in ms"""
+  times = []
+  with open(os.devnull, 'w') as devnull:
+    for _ in range(n):
+      started = time.time()
+      rc = subprocess.call(command, stdout=devnull, stderr=devnull)
+      times.append(1000.0 * (time.time() - started))
+      if rc:
+        raise RuntimeError('{} exited with {}'.format(' '.join(command), rc))
+  return times
+
+def modules(python, path, args):
+  p = subprocess.Popen([python, '-c', count_modules, path] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  out, err = p.communicate()
+  for line in err.decode('utf-8', 'replace').splitlines():
+    if line.startswith('modules='):
+      return int(line.split('=', 1)[1])
+  return None
+
+def runs_on(python, code):
+  with open(os.devnull, 'w') as devnull:
+    return subprocess.call([python, '-c', code], stdout=devnull, stderr=devnull) == 0
+
+def entries(python, zipapp=None):
+  """Yields (name, command, script, args) for every entry point this interpreter can run"""
+  for command, module, directory in ztp_zipapp.entry_points:
+    path = os.path.join(directory, module + '.py')
+    if not runs_on(python, 'compile(open({!r}).read(), {!r}, "exec")'.format(path, path)):
+      continue
+    yield module, [python, path] + dry_run[command], path, dry_run[command]
+    if zipapp:
+      yield '{} ({})'.format(command, os.path.basename(zipapp)), [python, zipapp, command] + dry_run[command], None, None
+  if runs_on(python, 'import onl.install.Plugin'):
+    for module in plugins:
+      path = os.path.join(ztp_zipapp.here, module + '.py')
+      code = 'import imp; imp.load_source({!r}, {!r})'.format(module, path)
+      yield module, [python, '-c', code], None, None
+
+def run(python, n, zipapp=None):
+  baseline = median(timed([python, '-c', 'pass'], n))
+  base_modules = modules(python, os.devnull, [])
+  results = []
+  for name, command, path, args in entries(python, zipapp):
+    times = timed(command, n)
+    result = dict(
+      entry_point = name,
+      runs        = n,
+      median_ms   = round(median(times) - baseline, 2),
+      min_ms      = round(min(times) - baseline, 2),
+      modules     = None,
+    )
+    if path:
+      count = modules(python, path, args)
+      if count is not None:
+        result['modules'] = count - base_modules
+    results.append(result)
+  return baseline, results
+
+def compare(results, baseline_path, tolerance):
+  """Returns a description of every entry point that starts slower than in the baseline run"""
+  with open(baseline_path) as f:
+    baseline = dict((r['entry_point'], r) for r in json.load(f)['results'])
+  regressions = []
+  for result in results:
+    old = baseline.get(result['entry_point'])
+    if not old:
+      continue
+    if result['median_ms'] > max(old['median_ms'], 1.0) * (1 + tolerance):
+      regressions.append('{}: startup {} -> {} ms'.format(result['entry_point'], old['median_ms'], result['median_ms']))
+    if old['modules'] is not None and result['modules'] is not None and result['modules'] > old['modules']:
+      regressions.append('{}: modules loaded {} -> {}'.format(result['entry_point'], old['modules'], result['modules']))
+  return regressions
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--python', help='Interpreter to start the entry points with. Default: {}'.format(sys.executable), default=sys.executable)
+  parser.add_argument('--runs', help='Starts per entry point. Default: {}'.format(runs), type=int, default=runs)
+  parser.add_argument('--zipapp', help='Also time the entry points through this ztp_zipapp.py archive')
+  parser.add_argument('--budget_ms', help='Fail if any entry point takes longer than this over a bare interpreter', type=float)
+  parser.add_argument('--output', help='Write the results to this JSON file')
+  parser.add_argument('--compare', help='JSON file of an earlier run; exit non-zero if an entry point regressed')
+  parser.add_argument('--tolerance', help='Allowed startup time regression against --compare, as a fraction. Default: {}'.format(tolerance), type=float, default=tolerance)
+  args = parser.parse_args(argv)
+
+  baseline, results = run(args.python, max(1, args.runs), args.zipapp)
+  print("{:<40} {:>8.2f}ms".format('bare interpreter', baseline))
+  over_budget = []
+  for result in results:
+    print("{entry_point:<40} {median_ms:>+8.2f}ms  min {min_ms:>+8.2f}ms  {} modules".format('-' if result['modules'] is None else result['modules'], **result))
+    if args.budget_ms is not None and result['median_ms'] > args.budget_ms:
+      over_budget.append(result)
+
+  if args.output:
+    report = dict(
+      timestamp   = time.time(),
+      python      = args.python,
+      platform    = platform.platform(),
+      baseline_ms = round(baseline, 2),
+      results     = results,
+    )
+    with open(args.output, 'w') as f:
+      json.dump(report, f, sort_keys=True, indent=2)
+
+  failed = False
+  for result in over_budget:
+    print("OVER BUDGET: {} {}ms > {}ms".format(result['entry_point'], result['median_ms'], args.budget_ms))
+    failed = True
+  if args.compare:
+    for regression in compare(results, args.compare, args.tolerance):
+      print("REGRESSION: {}".format(regression))
+      failed = True
+  return 1 if failed else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,266 @@
+#!/usr/bin/python
+
+# Brings the ZTP server in line with an inventory file (CSV or JSONL, see
+# ztp_inventory.py) without re-sending what is already there. The server's
+# device list is fetched once with GET /api/devices and indexed by
+# (ip_addr, os_name) and by serial_number; every inventory row is compared
+# against it and only the differences go out:
+#
+#   add      not on the server                         POST
+#   replace  serial_number/hw_model/os_version differ  DELETE + POST
+#   move     serial known under another ip/os          DELETE the old record + POST
+#   status   only the state differs                    PUT status
+#   delete   on the server but not in the inventory    DELETE (only with --delete)
+#
+# Only the fields a row actually gives are compared, so a column left out of
+# the inventory never causes a replace. A device the server has further along
+# its lifecycle than the inventory says is left alone: that is provisioning
+# progress, not drift. With --dry-run the plan is printed and nothing is sent.
+import sys
+import time
+import socket
+import httplib
+import argparse
+import threading
+import Queue
+
+import ztp_client
+import ztp_codec
+import ztp_inventory
+
+# Defaults
+hostname    = ztp_client.hostname
+port        = ztp_client.port
+concurrency = 4
+outputs     = ['text', 'jsonl']
+shard_keys  = ['ip', 'serial']
+
+# Compared between an inventory row and the server's record. The message is
+# left out: the server's is whatever the device reported last
+record_fields = ['serial_number', 'hw_model', 'os_version']
+
+def given_fields(row):
+  """The device fields an inventory row has a value for"""
+  fields = set()
+  for column, value in row.items():
+    key = ztp_inventory.columns.get((column or '').strip().lower())
+    if key and value not in (None, ''):
+      fields.add(key)
+  return fields
+
+class Index(object):
+  """The server's devices by (ip_addr, os_name) and by serial_number"""
+  def __init__(self, items):
+    self.by_key = {}
+    self.by_serial = {}
+    for item in items:
+      self.by_key[(item.get('ip_addr'), item.get('os_name'))] = item
+      if item.get('serial_number'):
+        self.by_serial.setdefault(item['serial_number'], []).append(item)
+
+def behind(state, current):
+  """True if state comes before the current one in the device lifecycle"""
+  order = ztp_client.lifecycle
+  state, current = state.upper(), '{}'.format(current).upper()
+  return state in order and current in order and order.index(state) < order.index(current)
+
+def diff(index, path, delete=False):
+  """Yields (op, device_data, server record or None, lineno) for every change
+  needed to make the server match the inventory at path"""
+  seen = set()
+  # Old records of devices that moved; they are replaced, not deleted
+  moved_away = set()
+  for lineno, row in ztp_inventory.read_inventory(path):
+    device = ztp_inventory.inventory_device(row)
+    key = (device['ip_addr'], device['os_name'])
+    if key in seen:
+      raise ValueError('line {}: {} {} is in the inventory more than once'.format(lineno, key[0], key[1]))
+    seen.add(key)
+    current = index.by_key.get(key)
+    if current is None:
+      moved = [item for item in index.by_serial.get(device.get('serial_number'), [])
+               if (item.get('ip_addr'), item.get('os_name')) not in moved_away | seen]
+      if moved:
+        moved_away.add((moved[0].get('ip_addr'), moved[0].get('os_name')))
+        yield 'move', device, moved[0], lineno
+      else:
+        yield 'add', device, None, lineno
+      continue
+    fields = given_fields(row)
+    if any(field in fields and '{}'.format(current.get(field)) != '{}'.format(device[field]) for field in record_fields):
+      yield 'replace', device, current, lineno
+    elif '{}'.format(current.get('state')).upper() != device['state'].upper() and not behind(device['state'], current.get('state')):
+      yield 'status', device, current, lineno
+  if delete:
+    for key in sorted(k for k in index.by_key if k not in seen and k not in moved_away):
+      yield 'delete', dict(ip_addr=key[0], os_name=key[1]), index.by_key[key], None
+
+def apply_change(transport, op, device, current):
+  """Sends one change. Returns (outcome, response)"""
+  if op == 'add':
+    return ztp_client.add_device(transport, device, replace=False)
+  if op in ['replace', 'move']:
+    # Not ztp_client.replace_device(): that deletes by the new ip_addr and
+    # overwrites the inventory's message
+    ztp_client.delete_device(transport, ip_addr=current['ip_addr'], os_name=current['os_name'])
+    outcome, r1 = ztp_client.add_device(transport, device, replace=False)
+    return ('replaced' if outcome == 'added' else outcome), r1
+  if op == 'status':
+    r1 = ztp_client.set_status(transport, device['ip_addr'], device['os_name'], device['state'], device.get('message', ''))
+    return ztp_client.status_outcome(r1), r1
+  r1 = ztp_client.delete_device(transport, ip_addr=device['ip_addr'], os_name=device['os_name'])
+  return ('deleted' if r1.ok and r1.data.get('ok') else 'failed'), r1
+
+def describe(op, device, current):
+  if op == 'add':
+    return "add {ip_addr} {os_name} ({state})".format(**device)
+  if op == 'status':
+    return "status {} {}: {} -> {}".format(device['ip_addr'], device['os_name'], current.get('state'), device['state'])
+  if op == 'move':
+    return "move {} {} from {} {}".format(device['ip_addr'], device['os_name'], current.get('ip_addr'), current.get('os_name'))
+  if op == 'replace':
+    changed = [field for field in record_fields if field in device and '{}'.format(current.get(field)) != '{}'.format(device[field])]
+    return "replace {} {} ({} changed)".format(device['ip_addr'], device['os_name'], ', '.join(changed))
+  return "delete {ip_addr} {os_name}".format(**device)
+
+def run(args, transport, changes):
+  """Sends the changes from a few worker threads. Returns the count per outcome"""
+  workers = max(1, args.concurrency)
+  pending = Queue.Queue(workers * 2)
+  results = Queue.Queue(workers * 2)
+
+  def worker():
+    # Every change reports an outcome and every worker its end, whatever goes
+    # wrong; otherwise the loop below waits for them forever
+    try:
+      while True:
+        item = pending.get()
+        if item is None:
+          return
+        op, device, current, lineno = item
+        started = time.time()
+        r1 = error = None
+        try:
+          outcome, r1 = apply_change(transport, op, device, current)
+        except ValueError as e:
+          outcome, error = 'failed', 'JSON parse error: {}'.format(e)
+        except (socket.error, httplib.HTTPException) as e:
+          outcome, error = 'failed', 'Socket error: {}'.format(e)
+        except Exception as e:
+          outcome, error = 'failed', '{}: {}'.format(type(e).__name__, e)
+        elapsed = time.time() - started
+        try:
+          if args.output == 'jsonl':
+            line = ztp_client.result_line(op, device, outcome, r1, elapsed, error)
+          else:
+            line = "{}: {} ({:.3f}s){}".format(describe(op, device, current), outcome, elapsed, ' ' + error if error else '')
+        except Exception as e:
+          outcome, error = 'failed', '{}: {}'.format(type(e).__name__, e)
+          line = ztp_client.result_line(op, {}, outcome, error=error) if args.output == 'jsonl' else "{}: {}".format(op, error)
+        results.put((outcome, line))
+    finally:
+      results.put(None)
+
+  def feeder():
+    for change in changes:
+      pending.put(change)
+    for _ in range(workers):
+      pending.put(None)
+
+  threads = [threading.Thread(target=feeder)] + [threading.Thread(target=worker) for _ in range(workers)]
+  for t in threads:
+    t.daemon = True
+    t.start()
+  outcomes = {}
+  running = workers
+  while running:
+    result = results.get()
+    if result is None:
+      running -= 1
+      continue
+    outcome, line = result
+    outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    print line
+  return outcomes
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('inventory', help='CSV or JSONL file with one device per row (columns: ip, os, sn, hw, message, state)')
+  parser.add_argument('--dry-run', help="Fetches the server's devices and prints the changes that would be made, but doesn't make them.", action='store_true')
+  parser.add_argument('--delete', help='Also delete the devices the server has and the inventory does not', action='store_true')
+  parser.add_argument('--ztp_host', help='Remote host against which to run. Default: {}'.format(hostname))
+  parser.add_argument('--ztp_port', help='Remote host port against which to run. Default: {}'.format(port))
+  parser.add_argument('--ztp_servers', help='Comma separated host[:port] list of ZTP servers devices are sharded over (consistent hashing, failing over to the next server). Replaces --ztp_host')
+  parser.add_argument('--shard_key', help='What devices are sharded on with --ztp_servers. Default: ip', choices=shard_keys, default='ip')
+  parser.add_argument('--ssl', help='Should the connection be treated as an SSL/TLS protected connection', action='store_true')
+  parser.add_argument('--verify', help='With --ssl: check the server certificate against the system CAs', action='store_true')
+  parser.add_argument('--ca_file', help='With --ssl: check the server certificate against the CAs in this PEM file')
+  parser.add_argument('--wire', help='Body format to negotiate with the ZTP server: msgpack or cbor if their library is installed and the server answers in it, JSON otherwise. Default: json', choices=ztp_codec.names, default='json')
+  parser.add_argument('--concurrency', help='Number of keep-alive connections/in-flight requests. Default: {}'.format(concurrency), type=int, default=concurrency)
+  parser.add_argument('--output', help='text: one line per change. jsonl: one compact JSON line per change for pipelines. Default: text', choices=outputs, default='text')
+  args = parser.parse_args(argv)
+
+  def report(lineno, error):
+    print "ERROR: {} line {}: {}".format(args.inventory, lineno, error)
+  rows, errors = ztp_inventory.validate_inventory(args.inventory, report)
+  if errors:
+    print "{} of {} inventory rows are invalid. Nothing was sent.".format(errors, rows + errors)
+    return 1
+
+  ztp_host = args.ztp_host or hostname
+  ztp_port = args.ztp_port or port
+  tls = dict(ssl=args.ssl, verify=args.verify, ca_file=args.ca_file)
+  size = max(1, args.concurrency)
+  if args.ztp_servers:
+    import ztp_shards
+    transport = ztp_shards.ShardedTransport(ztp_shards.parse_servers(args.ztp_servers, ztp_port), args.shard_key, size=size, **tls)
+  else:
+    transport = ztp_client.get_transport(ztp_host, ztp_port, size=size, **tls)
+  if args.wire != 'json':
+    try:
+      transport.wire = ztp_codec.get(args.wire)
+    except ImportError as e:
+      print >>sys.stderr, "WARN: Can't use {}, talking JSON: {}".format(args.wire, e)
+
+  started = time.time()
+  try:
+    index = Index(ztp_client.list_devices(transport))
+  except ValueError as e:
+    print "ERROR: Can't parse the device list from '{}': {}".format(transport.url_base, e)
+    return 1
+  except (socket.error, httplib.HTTPException) as e:
+    print "ERROR: Can't get the device list from '{}': {}".format(transport.url_base, e)
+    return 1
+  fetched = time.time() - started
+
+  try:
+    changes = list(diff(index, args.inventory, args.delete))
+  except ValueError as e:
+    print "ERROR: {}: {}".format(args.inventory, e)
+    return 1
+  planned = {}
+  for op, device, current, lineno in changes:
+    planned[op] = planned.get(op, 0) + 1
+
+  out = sys.stderr if args.output == 'jsonl' else sys.stdout
+  print >>out, "Server: {} devices (fetched in {:.2f}s). Inventory: {} devices. Changes: {}".format(
+    len(index.by_key), fetched, rows, ', '.join('{} {}'.format(planned[op], op) for op in sorted(planned)) or 'none')
+  if args.dry_run:
+    for op, device, current, lineno in changes:
+      if args.output == 'jsonl':
+        print ztp_client.result_line(op, device, 'dry-run', line=lineno)
+      else:
+        print "DRY-RUN: {}".format(describe(op, device, current))
+    return 0
+
+  outcomes = run(args, transport, changes)
+  elapsed = time.time() - started
+  print >>out, "Summary: {} change(s) for {} inventory devices in {:.2f}s over {} connection(s)".format(len(changes), rows, elapsed, transport.opened)
+  for outcome in sorted(outcomes):
+    print >>out, "|-> {}: {}".format(outcome, outcomes[outcome])
+  if args.ssl:
+    print >>out, ztp_client.tls_summary(transport)
+  return 1 if outcomes.get('failed') or outcomes.get('rejected') else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,108 @@
+"""
+Capture of the requests the ZTP clients send, for ztp_replay_trace.py.
+
+With a Tracer as .tracer, the ztp_client transports (and ShardedTransport)
+append every request they send to a trace file, one compact JSON line each:
+
+  {"body":"{\"ip_addr\": ...}","method":"PUT","ms":1.873,"status":200,
+   "ts":1500000000.123456,"url":"/api/devices/status"}
+
+url keeps the query string and body is the JSON body the client built (null
+for none), so the request can be re-issued with the same content. A transport
+with a msgpack or CBOR .wire (see ztp_codec.py) encodes the body after it is
+traced; the trace and its replay are JSON whatever the wire was. ms is the
+wall clock time of the request, retries included; a request that got no
+response has status null and an error. The ONL plugins write the same lines
+(?ztp_trace=1 in onie_exec_url), which the postinstall plugin keeps at
+/mnt/onl/data/ztp/trace.jsonl.
+
+Like ztp_metrics.Recorder, lines are formatted and written in batches, not on
+the request path.
+"""
+import json
+import threading
+
+try:
+  from urllib.parse import urlsplit, parse_qs
+except ImportError:
+  from urlparse import urlsplit, parse_qs
+
+# Defaults
+flush_every = 1000
+
+class Tracer(object):
+  """Collects the requests of any number of threads and appends them to path"""
+  def __init__(self, path, flush_every=flush_every):
+    self.path = path
+    self.flush_every = flush_every
+    self.lock = threading.Lock()
+    self.pending = []
+
+  def record(self, timing, url, body=None):
+    """timing is the request's finished ztp_metrics.Timing"""
+    if isinstance(body, bytes) and not isinstance(body, str):
+      body = body.decode('utf-8')
+    with self.lock:
+      self.pending.append((timing, url, body))
+      full = len(self.pending) >= self.flush_every
+    if full:
+      self.flush()
+
+  def flush(self):
+    with self.lock:
+      pending, self.pending = self.pending, []
+      if not pending:
+        return
+      with open(self.path, 'a') as f:
+        for timing, url, body in pending:
+          f.write(line(timing.started, timing.method, url, body, timing.status, timing.elapsed, timing.error) + '\n')
+
+  def close(self):
+    self.flush()
+
+def line(ts, method, url, body, status, elapsed, error=None):
+  record = dict(
+    ts     = round(ts, 6),
+    method = method,
+    url    = url,
+    body   = body,
+    status = status,
+    ms     = None if elapsed is None else round(1000.0 * elapsed, 3),
+  )
+  if error:
+    record['error'] = error
+  return json.dumps(record, sort_keys=True, separators=(',', ':'))
+
+def read_trace(paths):
+  """The requests of one or more trace files, merged in the order they were sent"""
+  records = []
+  for path in paths:
+    with open(path) as f:
+      for line in f:
+        line = line.strip()
+        if not line:
+          continue
+        try:
+          records.append(json.loads(line))
+        except ValueError:
+          # A torn write from a crash; everything before it is still good
+          continue
+  # sort() is stable: requests with the same ts keep their order in the file
+  records.sort(key=lambda record: record['ts'])
+  return records
+
+def device_key(record):
+  """The ip_addr of the device a request is about, or None for one that isn't
+  about a single device. The IP and not (ip_addr, os_name): a DELETE by IP has
+  to stay in order with the POSTs and PUTs of that device"""
+  if record.get('body'):
+    try:
+      device = json.loads(record['body'])
+    except ValueError:
+      device = None
+    if isinstance(device, dict) and device.get('ip_addr'):
+      return device['ip_addr']
+  query = parse_qs(urlsplit(record['url']).query)
+  if query.get('ip_addr'):
+    return query['ip_addr'][0]
+  return None
@@ -0,0 +1,126 @@
+"""
+Timestamped log of the status transitions devices report.
+
+Each line is one JSON event:
+
+  {"ts": <time.time()>, "ip_addr": ..., "os_name": ..., "state": ...,
+   "source": "preinstall" | "postinstall" | "ztp_set_device_status_httplib.py"}
+
+The ONL plugins write one on each switch (ztp/transitions.jsonl on ONL-DATA,
+/mnt/onl/data/ztp/transitions.jsonl at runtime); ztp_set_device_status_httplib.py
+--transitions writes one for the statuses it sends. ztp_phase_report.py reads
+any number of them and works out how long devices spend in each status.
+
+A TransitionLog also remembers the last state recorded per device, which is
+what ztp_client.set_status() checks a new state against.
+"""
+import os
+import json
+import time
+import threading
+
+import ztp_client
+
+# Defaults
+path = '/var/lib/ztp/transitions.jsonl'
+
+class TransitionLog(object):
+  def __init__(self, path=path, source=None):
+    self.path = path
+    self.source = source
+    self.lock = threading.Lock()
+    self.states = None
+    self.f = None
+
+  def load(self):
+    """Reads the last state of every device. Called on first use"""
+    self.states = {}
+    try:
+      with open(self.path) as f:
+        for event in read_events(f):
+          self.states[(event['ip_addr'], event['os_name'])] = event['state']
+    except IOError:
+      pass
+
+  def last(self, ip_addr, os_name):
+    with self.lock:
+      if self.states is None:
+        self.load()
+      return self.states.get((ip_addr, os_name))
+
+  def record(self, ip_addr, os_name, state, ts=None):
+    event = dict(ts=ts or time.time(), ip_addr=ip_addr, os_name=os_name, state=state.upper())
+    if self.source:
+      event['source'] = self.source
+    line = json.dumps(event, sort_keys=True, separators=(',', ':')) + '\n'
+    with self.lock:
+      if self.states is None:
+        self.load()
+      self.states[(ip_addr, os_name)] = event['state']
+      if self.f is None:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+          os.makedirs(directory)
+        self.f = open(self.path, 'a')
+      # One write per line, so concurrent writers don't interleave within one
+      self.f.write(line)
+      self.f.flush()
+
+  def close(self):
+    with self.lock:
+      if self.f is not None:
+        self.f.close()
+        self.f = None
+
+def read_events(f):
+  events = []
+  for line in f:
+    line = line.strip()
+    if not line:
+      continue
+    try:
+      event = json.loads(line)
+    except ValueError:
+      continue
+    if isinstance(event, dict) and event.get('ip_addr') and event.get('state') and event.get('ts'):
+      events.append(event)
+  return events
+
+def runs(events):
+  """Splits the events into provisioning runs: per device, in time order, a
+  new run starting at every restart (START, or OS-INSTALL not preceded by
+  START). Repeated reports of a state, e.g. the same transition seen by a
+  switch and by the ops host, count once. Returns [((ip_addr, os_name), [(state, ts)])]"""
+  by_device = {}
+  for event in sorted(events, key=lambda event: event['ts']):
+    by_device.setdefault((event['ip_addr'], event.get('os_name')), []).append(event)
+  result = []
+  for device in sorted(by_device):
+    run = []
+    for event in by_device[device]:
+      state = event['state'].upper()
+      if run and state == run[-1][0]:
+        continue
+      if run and state in ztp_client.restarts and not (state == 'OS-INSTALL' and run[-1][0] == 'START'):
+        result.append((device, run))
+        run = []
+      run.append((state, event['ts']))
+    if run:
+      result.append((device, run))
+  return result
+
+def phase_durations(runs):
+  """Returns ({state: [(seconds spent in it, device)]}, [(seconds to DONE, device)],
+  {state: seconds spent in it by runs that reached DONE})"""
+  phases = {}
+  to_done = []
+  done_share = {}
+  for device, run in runs:
+    reached_done = run[-1][0] == 'DONE'
+    for (state, ts), (next_state, next_ts) in zip(run, run[1:]):
+      phases.setdefault(state, []).append((next_ts - ts, device))
+      if reached_done:
+        done_share[state] = done_share.get(state, 0) + next_ts - ts
+    if reached_done and len(run) > 1:
+      to_done.append((run[-1][1] - run[0][1], device))
+  return phases, to_done, done_share
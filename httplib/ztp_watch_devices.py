@@ -0,0 +1,193 @@
+#!/usr/bin/python
+
+# Follows a rollout from the ZTP server's device list without pulling the
+# whole list every few seconds. GET /api/devices is polled with conditional
+# GETs (see ztp_devcache.py), so a poll while nothing changed costs a 304.
+# Each list that did change is compared with the previous one by
+# (ip_addr, os_name), and only the differences are reported:
+#
+#   --output jsonl    one compact JSON line per device that changed state,
+#                     appeared or disappeared:
+#                     {"from":"OS-INSTALL","ip_addr":...,"to":"AWAIT-ONLINE",...}
+#   --output summary  the number of devices per state, redrawn in place on a
+#                     terminal, one line per change of the counts otherwise
+#
+# The poll interval follows the fleet: back to --min_interval as soon as a
+# poll sees changes, doubling from there while nothing changes, up to
+# --busy_interval while devices are in OS-INSTALL, OS-REBOOTING or
+# AWAIT-ONLINE (they will move soon) and up to --max_interval once the fleet
+# is idle. Failed polls back off the same way. Polling samples the fleet: a
+# device that went through several states between two polls is reported once,
+# from the state it had at the first to the one it has at the second.
+import sys
+import json
+import time
+import socket
+import httplib
+import argparse
+
+import ztp_client
+import ztp_codec
+import ztp_devcache
+
+# Defaults
+hostname      = ztp_client.hostname
+port          = ztp_client.port
+min_interval  = 1.0
+busy_interval = 4.0
+max_interval  = 30.0
+backoff       = 2.0
+outputs       = ['summary', 'jsonl']
+
+# States devices leave on their own within minutes
+busy_states = ['OS-INSTALL', 'OS-REBOOTING', 'AWAIT-ONLINE']
+
+def snapshot(index):
+  """The devices of a ztp_devcache.DeviceIndex by (ip_addr, os_name)"""
+  return dict(((item.get('ip_addr'), item.get('os_name')), item) for item in index.items)
+
+def state_of(item):
+  return '{}'.format(item.get('state')).upper() if item is not None else None
+
+def diff(previous, current):
+  """The (key, old item or None, new item or None) of every device whose
+  state changed, that appeared or that disappeared between two snapshots"""
+  changes = []
+  for key, item in current.items():
+    old = previous.get(key)
+    if old is None or state_of(old) != state_of(item):
+      changes.append((key, old, item))
+  for key, old in previous.items():
+    if key not in current:
+      changes.append((key, old, None))
+  changes.sort(key=lambda change: (ztp_devcache.state_order(state_of(change[2] or change[1])), change[0]))
+  return changes
+
+def next_interval(interval, changed, busy, args):
+  """The wait before the next poll, from the one before and what this poll saw"""
+  if changed:
+    return args.min_interval
+  limit = args.busy_interval if busy else args.max_interval
+  return max(args.min_interval, min(interval * backoff, limit))
+
+def change_line(ts, key, old, new):
+  item = new or old
+  line = dict(
+    ts            = round(ts, 3),
+    ip_addr       = key[0],
+    os_name       = key[1],
+    serial_number = item.get('serial_number'),
+    hw_model      = item.get('hw_model'),
+    to            = state_of(new),
+    message       = item.get('message'),
+  )
+  line['from'] = state_of(old)
+  return json.dumps(line, sort_keys=True, separators=(',', ':'))
+
+def counts_line(ts, counts):
+  return "{} {}".format(time.strftime('%H:%M:%S', time.localtime(ts)),
+                        '  '.join('{} {}'.format(state, counts[state]) for state in sorted(counts, key=ztp_devcache.state_order)) or 'no devices')
+
+def draw(out, url_base, ts, counts, stats, interval, recent):
+  """Redraws the summary on a terminal"""
+  out.write('\x1b[H\x1b[J')
+  out.write("ZTP server {}  {}  next poll in {:.0f}s\n".format(url_base, time.strftime('%H:%M:%S', time.localtime(ts)), interval))
+  out.write("Polls: {polls}  unchanged (304): {not-modified}  fetched: {fetched}  failed: {failed}\n\n".format(**stats))
+  for state in sorted(counts, key=ztp_devcache.state_order):
+    out.write("{:<20} {:>7}\n".format(state, counts[state]))
+  out.write("{:<20} {:>7}\n".format('TOTAL', sum(counts.values())))
+  if recent:
+    out.write("\nLast changes:\n")
+    for line in recent:
+      out.write("  {}\n".format(line))
+  out.flush()
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--ztp_host', help='Remote host against which to run. Default: {}'.format(hostname))
+  parser.add_argument('--ztp_port', help='Remote host port against which to run. Default: {}'.format(port))
+  parser.add_argument('--ssl', help='Should the connection be treated as an SSL/TLS protected connection', action='store_true')
+  parser.add_argument('--verify', help='With --ssl: check the server certificate against the system CAs', action='store_true')
+  parser.add_argument('--ca_file', help='With --ssl: check the server certificate against the CAs in this PEM file')
+  parser.add_argument('--wire', help='Body format to negotiate with the ZTP server: msgpack or cbor if their library is installed and the server answers in it, JSON otherwise. Default: json', choices=ztp_codec.names, default='json')
+  parser.add_argument('--min_interval', help='Seconds between polls while devices are changing. Default: {}'.format(min_interval), type=float, default=min_interval)
+  parser.add_argument('--busy_interval', help='Longest wait between polls while devices are in {}. Default: {}'.format(', '.join(busy_states), busy_interval), type=float, default=busy_interval)
+  parser.add_argument('--max_interval', help='Longest wait between polls once the fleet is idle. Default: {}'.format(max_interval), type=float, default=max_interval)
+  parser.add_argument('--initial', help='Report every device once at start (as a change from nothing) instead of only what changes afterwards', action='store_true')
+  parser.add_argument('--duration', help='Stop after this many seconds. Default: run until interrupted', type=float)
+  parser.add_argument('--output', help='summary: devices per state, live on a terminal. jsonl: one compact JSON line per state change for pipelines. Default: summary', choices=outputs, default='summary')
+  args = parser.parse_args(argv)
+  if args.min_interval <= 0:
+    parser.error('--min_interval must be positive')
+  args.busy_interval = max(args.busy_interval, args.min_interval)
+  args.max_interval = max(args.max_interval, args.busy_interval)
+
+  ztp_host = args.ztp_host or hostname
+  ztp_port = args.ztp_port or port
+  transport = ztp_client.get_transport(ztp_host, ztp_port, ssl=args.ssl, verify=args.verify, ca_file=args.ca_file)
+  if args.wire != 'json':
+    try:
+      transport.wire = ztp_codec.get(args.wire)
+    except ImportError as e:
+      print >>sys.stderr, "WARN: Can't use {}, talking JSON: {}".format(args.wire, e)
+
+  live = args.output == 'summary' and sys.stdout.isatty()
+  cache = ztp_devcache.DeviceCache(None, ttl=0)
+  stats = {'polls': 0, 'not-modified': 0, 'fetched': 0, 'failed': 0, 'changes': 0}
+  previous = None
+  counts = None
+  shown = None
+  recent = []
+  interval = args.min_interval
+  started = time.time()
+  try:
+    while args.duration is None or time.time() - started < args.duration:
+      polled = time.time()
+      stats['polls'] += 1
+      changes = []
+      try:
+        index = cache.fetch(transport, refresh=True)
+      except (ValueError, socket.error, httplib.HTTPException) as e:
+        stats['failed'] += 1
+        print >>sys.stderr, "WARN: Can't get the device list from '{}': {}".format(transport.url_base, e)
+        interval = min(max(interval, args.min_interval) * backoff, args.max_interval)
+      else:
+        stats[cache.outcome] += 1
+        if cache.outcome == 'fetched':
+          current = snapshot(index)
+          if previous is not None or args.initial:
+            changes = diff(previous or {}, current)
+          previous = current
+          counts = index.counts('state')
+        busy = any(counts.get(state) for state in busy_states)
+        interval = next_interval(interval, bool(changes), busy, args)
+      stats['changes'] += len(changes)
+
+      if args.output == 'jsonl':
+        for key, old, new in changes:
+          print change_line(polled, key, old, new)
+        sys.stdout.flush()
+      elif live and counts is not None:
+        for key, old, new in changes:
+          recent.append("{} {} {}: {} -> {}".format(time.strftime('%H:%M:%S', time.localtime(polled)), key[0], key[1], state_of(old), state_of(new)))
+        recent = recent[-10:]
+        draw(sys.stdout, transport.url_base, polled, counts, stats, interval, recent)
+      elif counts is not None and counts != shown:
+        print counts_line(polled, counts)
+        sys.stdout.flush()
+        shown = counts
+
+      wait = polled + interval - time.time()
+      if args.duration is not None:
+        wait = min(wait, started + args.duration - time.time())
+      if wait > 0:
+        time.sleep(wait)
+  except KeyboardInterrupt:
+    pass
+  transport.close()
+  print >>sys.stderr, "Watched {} for {:.0f}s: {polls} polls, {not-modified} unchanged (304), {fetched} fetched, {failed} failed, {changes} state changes".format(
+    transport.url_base, time.time() - started, **stats)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,137 @@
+#!/usr/bin/python
+
+# Packs the ztp_* scripts into one executable zip (ztp.pyz) so a host only has
+# to copy, unpack and stat a single file:
+#
+#   ./ztp_zipapp.py --output /usr/local/bin/ztp.pyz
+#   ztp.pyz add --device_ip 172.31.0.50 --device_os ONL --device_status START
+#   ztp.pyz status DONE --device_ip 172.31.0.50 --device_os ONL
+#
+# A symlink named after an entry point (e.g. ztp_add_device_httplib ->
+# ztp.pyz) runs that entry point directly. Only the selected script and what
+# it imports are loaded.
+#
+# The modules are stored uncompressed and precompiled by the interpreter
+# running this script, so nothing is decompressed or compiled at startup.
+# The .pyc files only load on that Python version; build with the interpreter
+# the archive will run under, or pass --source to ship plain .py files.
+import os
+import sys
+import stat
+import shutil
+import zipfile
+import argparse
+import tempfile
+import py_compile
+
+here = os.path.dirname(os.path.abspath(__file__))
+request_dir = os.path.join(here, os.pardir, 'request')
+
+# Defaults
+output = 'ztp.pyz'
+python = '/usr/bin/python'
+
+# (command, module, directory)
+entry_points = [
+  ('add',             'ztp_add_device_httplib',         here),
+  ('status',          'ztp_set_device_status_httplib',  here),
+  ('replay',          'ztp_replay_spool_httplib',       here),
+  ('sync',            'ztp_sync',                       here),
+  ('fleet',           'ztp_fleet_async',                here),
+  ('phase-report',    'ztp_phase_report',               here),
+  ('agent',           'ztp_agent',                      here),
+  ('agent-client',    'ztp_agent_client',               here),
+  ('trace-replay',    'ztp_replay_trace',               here),
+  ('query',           'ztp_query_devices_httplib',      here),
+  ('watch',           'ztp_watch_devices',              here),
+  ('add-requests',    'ztp_add_device_request',         request_dir),
+  ('status-requests', 'ztp_set_device_status_request',  request_dir),
+]
+
+# Imported by the entry points
+libraries = ['ztp_client', 'ztp_codec', 'ztp_devcache', 'ztp_inventory', 'ztp_metrics', 'ztp_regcache', 'ztp_shards', 'ztp_spool', 'ztp_trace', 'ztp_transitions']
+
+main_template = '''import os
+import sys
+
+entry_points = {entry_points!r}
+
+def usage():
+  sys.stderr.write('usage: {{}} <command> [args]\\ncommands: {{}}\\n'.format(os.path.basename(sys.argv[0]), ', '.join(sorted(entry_points))))
+  return 2
+
+def main():
+  name = os.path.basename(sys.argv[0])
+  for suffix in ['.pyz', '.py']:
+    if name.endswith(suffix):
+      name = name[:-len(suffix)]
+  if name in entry_points.values():
+    module = name
+  elif len(sys.argv) > 1 and sys.argv[1] in entry_points:
+    module = entry_points[sys.argv.pop(1)]
+    sys.argv[0] = module
+  else:
+    return usage()
+  return __import__(module).main(sys.argv[1:])
+
+sys.exit(main())
+'''
+
+def compiled(source, workdir):
+  """Returns the path of the .pyc for source, or None if this interpreter can't compile it"""
+  cfile = os.path.join(workdir, os.path.basename(source) + 'c')
+  try:
+    py_compile.compile(source, cfile, doraise=True)
+  except py_compile.PyCompileError as e:
+    print("skipping {}: {}".format(os.path.basename(source), e.msg.strip().splitlines()[-1]))
+    return None
+  return cfile
+
+def build(path, interpreter=python, source=False):
+  """Writes the archive to path. Returns the commands it provides"""
+  workdir = tempfile.mkdtemp(prefix='ztp_zipapp')
+  try:
+    members = [(module, os.path.join(here, module + '.py')) for module in libraries]
+    members += [(module, os.path.join(directory, module + '.py')) for command, module, directory in entry_points]
+    main_py = os.path.join(workdir, '__main__.py')
+    included = {}
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'wb') as f:
+      f.write('#!{}\n'.format(interpreter).encode('ascii'))
+      with zipfile.ZipFile(f, 'w', zipfile.ZIP_STORED) as zf:
+        for module, filename in members:
+          if source:
+            zf.write(filename, module + '.py')
+          else:
+            cfile = compiled(filename, workdir)
+            if cfile is None:
+              continue
+            zf.write(cfile, module + '.pyc')
+          included[module] = True
+        commands = dict((command, module) for command, module, directory in entry_points if module in included)
+        with open(main_py, 'w') as out:
+          out.write(main_template.format(entry_points=commands))
+        if source:
+          zf.write(main_py, '__main__.py')
+        else:
+          zf.write(compiled(main_py, workdir), '__main__.pyc')
+    mode = os.stat(tmp).st_mode
+    os.chmod(tmp, mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    os.rename(tmp, path)
+  finally:
+    shutil.rmtree(workdir)
+  return sorted(commands)
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--output', help='Archive to write. Default: {}'.format(output), default=output)
+  parser.add_argument('--python', help='Interpreter for the #! line. Default: {}'.format(python), default=python)
+  parser.add_argument('--source', help="Ship .py files instead of .pyc compiled for this interpreter", action='store_true')
+  args = parser.parse_args(argv)
+
+  commands = build(args.output, args.python, args.source)
+  print("Wrote {} ({} bytes) for Python {}.{}: {}".format(args.output, os.path.getsize(args.output), sys.version_info[0], sys.version_info[1], ', '.join(commands)))
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -3,112 +3,164 @@ import sys
 import os
 import json
 import argparse
-import subprocess
-import logging
-import time
-import requests
 import socket
-from httplib import HTTPConnection
-from requests.packages.urllib3.exceptions import InsecureRequestWarning
-requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+import time
+
+# The shared client lives next to the httplib scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'httplib'))
+import ztp_client
+import ztp_metrics
+from ztp_client import statuses
 
 # Defaults
-hostname = 'localhost'
-port = '8080'
-
-httpSuccessCodes = [200, 201, 202, 204]
-
-statuses = [
-	'START', 'DONE', 'CONFIG', 'AWAIT-ONLINE', 'AWAIT-SYSTEM-READY', 'OS-INSTALL', 'OS-REBOOTING', 'FAILED'
-]
-
-parser = argparse.ArgumentParser()
-parser.add_argument('status', help='AEON ZTP status. Valid options are: {}'.format(statuses))
-parser.add_argument('--dry-run', help="Does input validation, prints what would be done, but doesn't actually do anything.", action='store_true')
-parser.add_argument('--host', help='Remote host against which to run. Default: localhost')
-parser.add_argument('--port', help='Remote host port against which to run. Default: 8080')
-parser.add_argument('--ssl', help='Should the connection be treated as an SSL/TLS protected connection', action='store_true')
-parser.add_argument('--user', help='Basic AUTH username')
-parser.add_argument('--verbose', help='Make things chatty. Implies --curl. Note: May display sensitive data like password', action='store_true')
-
-args = parser.parse_args()
-if args.verbose:
-  print "****** Verbose mode ****"
-  for arg in vars(args):
-     print "Argument: {}".format(arg)
-     print "|-> Value: {}".format(getattr(args, arg))
-
-status = args.status
-if status.upper() not in statuses:
-  print "ERROR: {} is not a valid ZTP status.".format(status)
-  print "Valid statuses are: {}".format(statuses)
-  exit(1)
-
-if args.host:
-  hostname = '{}'.format(args.host)
-if args.port:
-  port = '{}'.format(args.port)
-if args.ssl:
-  protocol="https"
-else:
-  protocol="http"
-
-URL_BASE = '{}:{}'.format(hostname, port)
-URL = '/api/devices/status'
-url_headers = {'Content-Type': 'application/json', 'Accept': 'application/json' }
-request_url="{}://{}{}".format(protocol, URL_BASE, URL)
-if args.verbose: print "Request_url: \"{}\"".format(request_url)
-
-if args.dry_run:
-  print "DRY-RUN: {} {} JSON:'{}'".format(request_url, method, blob)
-  exit(0)
-
-device_data = dict(
-  ip_addr="172.31.0.50",
-  serial_number="EC1713003123",
-  hw_model="accton_as4610_54",
-  os_version="2.0.0-2017-07-19.1529-40fc82b_armel",
-  os_name="ONL",
-  state="{}".format(status)
-)
-print device_data
-
-try:
-  # verify set to False because we are not ready to do SSL cert verification
-  if args.verbose: 
-    logging.basicConfig(level=logging.DEBUG)
-    HTTPConnection.debuglevel = 1
-  conn = requests.put(url=request_url, json=device_data)
+hostname = ztp_client.hostname
+port = ztp_client.port
+method = 'PUT'
+
+def parse_args(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('status', help='AEON ZTP status. Valid options are: {}'.format(statuses))
+  parser.add_argument('--dry-run', help="Does input validation, prints what would be done, but doesn't actually do anything.", action='store_true')
+  parser.add_argument('--host', help='Remote host against which to run. Default: localhost')
+  parser.add_argument('--port', help='Remote host port against which to run. Default: 8080')
+  parser.add_argument('--ssl', help='Should the connection be treated as an SSL/TLS protected connection', action='store_true')
+  parser.add_argument('--verify', help='With --ssl: check the server certificate against the system CAs. This is the default, see --insecure', action='store_true')
+  parser.add_argument('--insecure', help="With --ssl: don't check the server certificate, e.g. for a self-signed one", action='store_true')
+  parser.add_argument('--ca_file', help='With --ssl: check the server certificate against the CAs in this PEM file')
+  parser.add_argument('--user', help='Basic AUTH username')
+  parser.add_argument('--output', help='text: human readable, server responses pretty printed. jsonl: one compact JSON line (status code, timing, server message) for pipelines. Default: text', choices=['text', 'jsonl'], default='text')
+  parser.add_argument('--identity', help='Report for the device in the identity file the ONL preinstall plugin registered instead of the sample device. Default file: {}'.format(ztp_client.identity_path), nargs='?', const=ztp_client.identity_path)
+  parser.add_argument('--metrics', help='Record the ttfb/read/decode timings of every request to this file: a Prometheus textfile-collector file if it ends in .prom, JSONL events otherwise')
+  parser.add_argument('--trace', help='Append every request (method, URL, body, status, time) to this file for ztp_replay_trace.py')
+  parser.add_argument('--verbose', help='Make things chatty. Implies --curl. Note: May display sensitive data like password', action='store_true')
+  return parser.parse_args(argv)
+
+def main(argv=None):
+  args = parse_args(argv)
   if args.verbose:
-      print 'Response: {}, reason: {}'.format(conn.status_code, conn.reason)
-  if conn.status_code in httpSuccessCodes:
-    data = conn.text
-    print json.dumps(json.loads(data), sort_keys=True, indent=4)
+    print "****** Verbose mode ****"
+    for arg in vars(args):
+       print "Argument: {}".format(arg)
+       print "|-> Value: {}".format(getattr(args, arg))
+
+  status = args.status
+  if not ztp_client.valid_status(status):
+    print "ERROR: {} is not a valid ZTP status.".format(status)
+    print "Valid statuses are: {}".format(statuses)
+    return 1
+
+  ztp_host = args.host or hostname
+  ztp_port = args.port or port
+  if args.ssl:
+    protocol="https"
   else:
-    print 'Response: {}, reason: {}'.format(conn.status_code, conn.reason)
-    print 'Non-200 HTTP response seen. Something went awry.'
-    data = conn.text
-    print json.dumps(json.loads(data), sort_keys=True, indent=4)
-
-except ValueError as e:
-  print 'Got the following data back: {}'.format(data)
-  print 'JSON parse error: {}'.format(e)
-  exit(1)
-
-except requests.exceptions.ConnectionError as e:
-  print 'ERROR: Connection Error raised'
-  print "|-> Tried to access '{}'".format(request_url)
-  print '|-> Error text was:: {}'.format(e)
-  exit(1)
-
-except requests.exceptions.HTTPError as e:
-  print 'ERROR: HTTP Error raised'
-  print "|-> Tried to access '{}'".format(request_url)
-  print '|-> Error text was: {}'.format(e)
-  exit(1)
-
-except socket.error as e:
-  print 'ERROR: Socket Error'
-  print "|-> Tried to access '{}'".format(request_url)
-  print '|-> Error text was: {}'.format(e)
-  exit(1)
\ No newline at end of file
+    protocol="http"
+
+  URL_BASE = '{}:{}'.format(ztp_host, ztp_port)
+  request_url="{}://{}{}".format(protocol, URL_BASE, ztp_client.STATUS_URL)
+  if args.verbose: print "Request_url: \"{}\"".format(request_url)
+
+  device_data = dict(
+    ip_addr="172.31.0.50",
+    os_name="ONL",
+    state="{}".format(status),
+    message=""
+  )
+  if args.identity:
+    try:
+      identity = ztp_client.read_identity(args.identity)
+    except (IOError, ValueError) as e:
+      print "ERROR: Can't use the device identity {}: {}".format(args.identity, e)
+      return 1
+    device_data.update(identity['key'])
+  if args.output == 'text':
+    print device_data
+
+  if args.dry_run:
+    if args.output == 'jsonl':
+      print ztp_client.result_line('status', device_data, 'dry-run', state=device_data['state'])
+    else:
+      print "DRY-RUN: {} {} JSON:'{}'".format(request_url, method, json.dumps(device_data))
+    return 0
+
+  import requests
+  from httplib import HTTPConnection
+  from requests.packages.urllib3.exceptions import InsecureRequestWarning
+  requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+
+  def failed(error):
+    print ztp_client.result_line('status', device_data, 'failed', elapsed=time.time() - started, error=error, state=device_data['state'])
+    return 1
+
+  data = None
+  transport = None
+  started = time.time()
+  try:
+    # The certificate is checked (against --ca_file if given) unless --insecure
+    if args.verbose:
+      import logging
+      logging.basicConfig(level=logging.DEBUG)
+      HTTPConnection.debuglevel = 1
+    transport = ztp_client.get_transport(ztp_host, ztp_port, backend='requests', ssl=args.ssl, verify=not args.insecure, ca_file=args.ca_file)
+    if args.metrics:
+      transport.recorder = ztp_metrics.Recorder(args.metrics)
+    if args.trace:
+      import ztp_trace
+      transport.tracer = ztp_trace.Tracer(args.trace)
+    conn = ztp_client.set_status(transport, **device_data)
+    data = conn.body
+    if args.output == 'jsonl':
+      outcome = ztp_client.status_outcome(conn)
+      print ztp_client.result_line('status', device_data, outcome, conn, time.time() - started, state=device_data['state'])
+      return 0 if outcome == 'updated' else 1
+    if args.verbose:
+        print 'Response: {}, reason: {}'.format(conn.status, conn.reason)
+    if conn.ok:
+      print json.dumps(conn.data, sort_keys=True, indent=4)
+    else:
+      print 'Response: {}, reason: {}'.format(conn.status, conn.reason)
+      print 'Non-200 HTTP response seen. Something went awry.'
+      print json.dumps(conn.data, sort_keys=True, indent=4)
+
+  except ValueError as e:
+    if args.output == 'jsonl':
+      return failed('JSON parse error: {}'.format(e))
+    print 'Got the following data back: {}'.format(data)
+    print 'JSON parse error: {}'.format(e)
+    return 1
+
+  except requests.exceptions.ConnectionError as e:
+    if args.output == 'jsonl':
+      return failed('{}'.format(e))
+    print 'ERROR: Connection Error raised'
+    print "|-> Tried to access '{}'".format(request_url)
+    print '|-> Error text was:: {}'.format(e)
+    return 1
+
+  except requests.exceptions.HTTPError as e:
+    if args.output == 'jsonl':
+      return failed('{}'.format(e))
+    print 'ERROR: HTTP Error raised'
+    print "|-> Tried to access '{}'".format(request_url)
+    print '|-> Error text was: {}'.format(e)
+    return 1
+
+  except socket.error as e:
+    if args.output == 'jsonl':
+      return failed('{}'.format(e))
+    print 'ERROR: Socket Error'
+    print "|-> Tried to access '{}'".format(request_url)
+    print '|-> Error text was: {}'.format(e)
+    return 1
+
+  finally:
+    if transport and transport.recorder:
+      transport.recorder.close()
+    if transport and transport.tracer:
+      transport.tracer.close()
+    if transport and args.ssl and (args.verbose or args.output == 'jsonl'):
+      print >>(sys.stderr if args.output == 'jsonl' else sys.stdout), ztp_client.tls_summary(transport)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())